@@ -1,15 +1,27 @@
 import asyncio
 import logging
+import signal
 from aiogram import Bot, Dispatcher
 import sys
 import os
+from aiohttp import web
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums.parse_mode import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from database.models import create_tables
-from services.queue_manager import start_queue_updates
+from database.executor import shutdown_db_executor
+from database.write_buffer import write_buffer
+from services.queue_manager import queue_manager, start_queue_updates, start_queue_workers
+from services.coalescer import message_coalescer
+from services.openai_client import close_openai_client
+from services.outbound import outbound
+from services.fsm_storage import create_fsm_storage
+from services.metrics import start_metrics_server
 
-from config import TOKEN, OPENAI_API_KEY
+from config import (
+    TOKEN, OPENAI_API_KEY, BOT_MODE, WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    METRICS_HOST, METRICS_PORT, SHUTDOWN_DRAIN_TIMEOUT
+)
 from handlers import setup_routers
 
 import os
@@ -28,6 +40,175 @@ logger.setLevel(logging.INFO)
 # Отдельный логгер для нашего приложения
 app_logger = logging.getLogger('telegram_bot')
 
+# Фоновые задачи, которые нужно остановить при завершении
+background_tasks = []
+# Серверы, которые нужно остановить при завершении (метрики)
+background_runners = []
+# Когда истекает время на доработку при остановке: один срок на обновления вебхука и на запросы,
+# чтобы остановка укладывалась в TimeoutStopSec systemd
+shutdown_deadline = None
+
+
+def shutdown_time_left() -> float:
+    """Сколько секунд осталось доработать принятое; срок отсчитывается от первого вызова"""
+    global shutdown_deadline
+    loop = asyncio.get_running_loop()
+    if shutdown_deadline is None:
+        shutdown_deadline = loop.time() + SHUTDOWN_DRAIN_TIMEOUT
+    return max(0.0, shutdown_deadline - loop.time())
+
+
+class InFlightUpdates:
+    """Middleware: считает обновления, которые сейчас обрабатываются"""
+
+    def __init__(self):
+        self.count = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def __call__(self, handler, event, data):
+        self.count += 1
+        self.idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if not self.count:
+                self.idle.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """Дождаться, пока все обработаются (не дольше timeout). False - что-то осталось"""
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+async def on_startup(metrics_port: int = METRICS_PORT):
+    """Запуск фоновых задач"""
+    # Запускаем задачу обновления статуса очереди
+    background_tasks.append(asyncio.create_task(start_queue_updates()))
+
+    # Запускаем обработчики очереди запросов и фоновую отправку служебных сообщений
+    start_queue_workers()
+    outbound.start()
+
+    # Запускаем отложенную запись сообщений в БД
+    write_buffer.start()
+
+    # Отдаем метрики для Prometheus
+    try:
+        runner = await start_metrics_server(METRICS_HOST, metrics_port)
+        if runner is not None:
+            background_runners.append(runner)
+    except OSError as e:
+        # Бот работает и без метрик
+        logging.error(f"❌ Не удалось запустить сервер метрик на порту {metrics_port}: {str(e)}")
+
+
+async def drain_requests():
+    """Ждем, пока доработают принятые запросы: собираемые реплики, очередь и обработка"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + shutdown_time_left()
+    # Собранная реплика сразу уходит в очередь, поэтому сначала дожидаемся склейки
+    while message_coalescer.pending and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    drained = await queue_manager.drain(max(0.0, deadline - loop.time()))
+    if not drained:
+        logging.warning(
+            f"⚠️ Не дождались запросов за {SHUTDOWN_DRAIN_TIMEOUT:.0f} сек.: "
+            f"в очереди {len(queue_manager.queue)}, в обработке {len(queue_manager.active)}"
+        )
+
+
+async def on_shutdown(bot: Bot, dp: Dispatcher):
+    """
+    Корректная остановка. Новые обновления к этому моменту уже не принимаются:
+    дорабатываем принятые запросы и только потом закрываем все соединения
+    """
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    # Ответы, которые уже генерируются, не обрываем
+    await drain_requests()
+    await queue_manager.stop_workers()
+    for runner in background_runners:
+        await runner.cleanup()
+    background_runners.clear()
+    # Дожидаемся отправки уже поставленных уведомлений, пока сессия бота открыта
+    await outbound.stop()
+    # Закрываем соединения с OpenAI
+    await close_openai_client()
+    # Записываем накопленные сообщения и дожидаемся операций с БД
+    await write_buffer.close()
+    await dp.storage.close()
+    shutdown_db_executor()
+    await bot.session.close()
+
+
+async def health(request: web.Request) -> web.Response:
+    """Проверка живости для балансировщика"""
+    return web.json_response({
+        "status": "ok",
+        "queue": len(queue_manager.queue),
+        "active": len(queue_manager.active)
+    })
+
+
+async def run_polling(bot: Bot, dp: Dispatcher):
+    """Получение обновлений через long polling"""
+    await bot.delete_webhook(drop_pending_updates=True)
+    await dp.start_polling(bot, handle_signals=True, close_bot_session=False)
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Получение обновлений через вебхук на aiohttp-сервере"""
+    app = web.Application()
+    # Запросы без правильного секретного токена отклоняются с 401.
+    # Telegram получает ответ сразу, а обновление обрабатывается в фоне: иначе ответ вебхука
+    # ждал бы весь ход (склейку, очередь, стрим), и Telegram прислал бы обновление повторно
+    webhook_handler = SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=True
+    )
+    webhook_handler.register(app, path=WEBHOOK_PATH)
+    in_flight_updates = InFlightUpdates()
+    dp.update.outer_middleware(in_flight_updates)
+    setup_application(app, dp, bot=bot)
+    app.router.add_get("/health", health)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    # Несколько реплик регистрируют один и тот же адрес - это безопасно
+    await bot.set_webhook(
+        WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logging.info(f"🌐 Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    # Ждем SIGTERM (systemd) или SIGINT
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        logging.info("🛑 Остановка вебхук-сервера")
+        # Перестаем принимать новые обновления
+        await site.stop()
+        # Даем начаться фоновой обработке последних принятых обновлений и дожидаемся ее
+        await asyncio.sleep(0)
+        if not await in_flight_updates.wait(shutdown_time_left()):
+            logging.warning(f"⚠️ Не дождались обработки обновлений: {in_flight_updates.count}")
+        await runner.cleanup()
+
+
 async def main():
     """Основная функция запуска бота"""
     # Проверка наличия токенов
@@ -39,25 +220,32 @@ async def main():
         logging.error("❌ КРИТИЧЕСКАЯ ОШИБКА: Переменная окружения OPENAI_API_KEY не установлена")
         return
 
+    if BOT_MODE == "webhook" and not (WEBHOOK_BASE_URL and WEBHOOK_SECRET):
+        logging.error("❌ КРИТИЧЕСКАЯ ОШИБКА: Для режима webhook нужны WEBHOOK_BASE_URL и WEBHOOK_SECRET")
+        return
+
+    # Создаем таблицы в БД до подключения хранилища состояний
+    create_tables()
+
     # Инициализация бота и диспетчера
-    from aiogram.client.default import DefaultBotProperties
     bot = Bot(token=TOKEN) 
-    storage = MemoryStorage()
+    storage = create_fsm_storage()
     dp = Dispatcher(storage=storage)
     
     # Подключаем роутеры
     dp.include_router(setup_routers())
     
-    # Создаем таблицы в БД (если они не существуют)
-    create_tables()
-    
-    # Запускаем задачу обновления статуса очереди
-    asyncio.create_task(start_queue_updates())
+    await on_startup()
     
     # Запускаем бота
-    logging.info("🚀 Бот запущен")
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    logging.info(f"🚀 Бот запущен (режим: {BOT_MODE})")
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            await run_polling(bot, dp)
+    finally:
+        await on_shutdown(bot, dp)
 
 
 if __name__ == "__main__":
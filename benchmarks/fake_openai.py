@@ -0,0 +1,185 @@
+"""
+Заглушка OpenAI-совместимого API для нагрузочных тестов.
+
+Отдает /v1/chat/completions (обычный ответ и стрим) с настраиваемым временем
+до первого токена, скоростью генерации, долей ошибок 500/429 и обрывов стрима.
+Отдельный запуск из корня репозитория:
+    python -m benchmarks.fake_openai --port 8765 --ttft 0.5 --tps 60
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, Dict
+
+from aiohttp import web
+
+WORDS = ["Это", " ответ", " тестовой", " модели", ",", " он", " приходит", " по", " одному", " токену", "."]
+
+
+class FakeOpenAI:
+    def __init__(self, ttft: float = 0.5, tps: float = 60.0, output_tokens: int = 200,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, disconnect_rate: float = 0.0,
+                 seed: int = None):
+        self.ttft = ttft
+        self.tps = tps
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.disconnect_rate = disconnect_rate  # Доля стримов, обрывающихся на середине
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.disconnected = 0
+        self.active = 0
+        self.max_active = 0
+
+    def _chunk(self, model: str, delta: Dict[str, Any], finish_reason: str = None) -> bytes:
+        chunk = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+
+    @staticmethod
+    def _usage(prompt_tokens: int, completion_tokens: int) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+
+        # Ошибки до начала ответа, как у настоящего API
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            self.rate_limited += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429, headers={"retry-after": "1"}
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"message": "Internal error", "type": "server_error"}}, status=500)
+
+        model = body.get("model", "gpt-4.1-nano")
+        prompt_tokens = sum(len(message.get("content") or "") for message in body.get("messages", [])) // 4
+        completion_tokens = min(self.output_tokens, body.get("max_tokens") or self.output_tokens)
+
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.ttft)
+            if not body.get("stream"):
+                await asyncio.sleep(completion_tokens / self.tps)
+                text = "".join(WORDS[i % len(WORDS)] for i in range(completion_tokens))
+                return web.json_response({
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                 "finish_reason": "stop"}],
+                    "usage": self._usage(prompt_tokens, completion_tokens),
+                })
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+            start = time.monotonic()
+            disconnect_at = completion_tokens // 2 if self.random.random() < self.disconnect_rate else None
+            for i in range(completion_tokens):
+                if i == disconnect_at:
+                    # Соединение рвется посреди ответа, без завершающих чанков
+                    self.disconnected += 1
+                    request.transport.close()
+                    return response
+                # Токены идут с заданной скоростью, без накопления ошибки от sleep
+                delay = start + i / self.tps - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await response.write(self._chunk(model, {"content": WORDS[i % len(WORDS)]}))
+            await response.write(self._chunk(model, {}, "stop"))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                usage_chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [],
+                    "usage": self._usage(prompt_tokens, completion_tokens),
+                }
+                await response.write(f"data: {json.dumps(usage_chunk)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        finally:
+            self.active -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "disconnected": self.disconnected,
+            "max_concurrent": self.max_active,
+        }
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        return app
+
+
+async def start_server(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--ttft", type=float, default=0.5, help="Секунд до первого токена")
+    parser.add_argument("--tps", type=float, default=60.0, help="Токенов в секунду")
+    parser.add_argument("--output-tokens", type=int, default=200, help="Токенов в ответе (не больше max_tokens)")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument("--openai-429-rate", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--openai-disconnect-rate", type=float, default=0.0, help="Доля стримов, оборванных на середине")
+
+
+def from_arguments(args: argparse.Namespace) -> FakeOpenAI:
+    return FakeOpenAI(
+        ttft=args.ttft,
+        tps=args.tps,
+        output_tokens=args.output_tokens,
+        error_rate=args.openai_error_rate,
+        rate_limit_rate=args.openai_429_rate,
+        disconnect_rate=args.openai_disconnect_rate,
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    runner = await start_server(from_arguments(args).make_app(), args.port)
+    print(f"Заглушка OpenAI: http://127.0.0.1:{args.port}/v1")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
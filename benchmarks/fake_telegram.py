@@ -0,0 +1,144 @@
+"""
+Заглушка Telegram Bot API для нагрузочных тестов.
+
+Принимает запросы aiogram на /bot<token>/<method>, записывает отправки и правки
+сообщений с временем и отвечает 429 (случайно и при превышении лимита на чат).
+Отдельный запуск из корня репозитория:
+    python -m benchmarks.fake_telegram --port 8766 --telegram-429-rate 0.01
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import Any, Dict, List, Tuple
+
+from aiohttp import web
+
+# Методы, которые отправляют или меняют сообщения и учитываются в лимитах
+SEND_METHODS = {"sendMessage", "editMessageText", "sendDocument"}
+
+
+class FakeTelegram:
+    def __init__(self, rate_limit_rate: float = 0.0, chat_rate: float = 0.0, retry_after: int = 1,
+                 seed: int = None):
+        self.rate_limit_rate = rate_limit_rate
+        self.chat_rate = chat_rate  # Сообщений в секунду на чат, сверх - 429 (0 - без лимита)
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls: List[Dict[str, Any]] = []  # Все успешные отправки и правки по порядку
+        self.rejected = 0  # Ответов 429
+        self.not_modified = 0
+        self.next_message_id = 1
+        self.messages: Dict[Tuple[int, int], str] = {}
+        self.chat_sent: Dict[int, List[float]] = {}
+
+    def _message(self, chat_id: int, message_id: int, text: str = None, **extra) -> Dict[str, Any]:
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            **extra,
+        }
+        if text is not None:
+            message["text"] = text
+        return message
+
+    @staticmethod
+    def _error(code: int, description: str, **parameters) -> web.Response:
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body)
+
+    def _over_limit(self, chat_id: int, now: float) -> bool:
+        """Превышен ли лимит на чат за последнюю секунду"""
+        if self.chat_rate <= 0:
+            return False
+        sent = [ts for ts in self.chat_sent.get(chat_id, []) if now - ts < 1.0]
+        self.chat_sent[chat_id] = sent
+        return len(sent) >= self.chat_rate
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        now = time.monotonic()
+
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"
+            }})
+        if method == "getUpdates":
+            # Обновления в нагрузочном тесте подаются напрямую в диспетчер
+            await asyncio.sleep(float(data.get("timeout") or 0))
+            return web.json_response({"ok": True, "result": []})
+        if method not in SEND_METHODS:
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(data["chat_id"])
+        if self.random.random() < self.rate_limit_rate or self._over_limit(chat_id, now):
+            self.rejected += 1
+            return self._error(
+                429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after
+            )
+
+        text = data.get("text")
+        if method == "editMessageText":
+            message_id = int(data["message_id"])
+            if self.messages.get((chat_id, message_id)) == text:
+                self.not_modified += 1
+                return self._error(400, "Bad Request: message is not modified")
+        else:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+
+        self.chat_sent.setdefault(chat_id, []).append(now)
+        self.messages[(chat_id, message_id)] = text
+        self.calls.append({"time": now, "method": method, "chat_id": chat_id, "text": text or ""})
+
+        if method == "sendDocument":
+            document = {"file_id": f"file{message_id}", "file_unique_id": f"u{message_id}"}
+            return web.json_response({"ok": True, "result": self._message(chat_id, message_id, document=document)})
+        return web.json_response({"ok": True, "result": self._message(chat_id, message_id, text)})
+
+    def stats(self) -> Dict[str, int]:
+        counts = {method: 0 for method in SEND_METHODS}
+        for call in self.calls:
+            counts[call["method"]] += 1
+        counts["429"] = self.rejected
+        counts["not_modified"] = self.not_modified
+        return counts
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--telegram-429-rate", type=float, default=0.0, help="Доля случайных ответов 429")
+    parser.add_argument("--telegram-chat-rate", type=float, default=0.0,
+                        help="Лимит сообщений в секунду на чат, сверх него 429 (0 - без лимита)")
+
+
+def from_arguments(args: argparse.Namespace) -> FakeTelegram:
+    return FakeTelegram(rate_limit_rate=args.telegram_429_rate, chat_rate=args.telegram_chat_rate)
+
+
+async def main():
+    from .fake_openai import start_server
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8766)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    runner = await start_server(from_arguments(args).make_app(), args.port)
+    print(f"Заглушка Telegram Bot API: http://127.0.0.1:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,276 @@
+"""
+Нагрузочный тест всего конвейера: диспетчер aiogram -> handlers/chat.process_message
+-> очередь -> send_message_to_openai -> стрим правками в Telegram -> БД.
+
+OpenAI и Telegram заменены локальными заглушками (benchmarks.fake_openai, benchmarks.fake_telegram),
+БД - временная SQLite. Каждый пользователь отправляет --turns сообщений, дожидаясь ответа на предыдущее.
+
+Запуск из корня репозитория:
+    python -m benchmarks.load_test --users 50 --turns 3 --ttft 0.5 --tps 80 --output baseline.json
+    python -m benchmarks.load_test --users 50 --turns 3 --ttft 0.5 --tps 80 --baseline baseline.json
+
+Отчет: p50/p95/p99 времени до первого токена (первая правка сообщения), ожидания в очереди
+и всего хода, частота правок, ответы 429, время в БД.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from . import fake_openai, fake_telegram
+
+BOT_TOKEN = "123456:LOADTEST"
+FIRST_USER_ID = 10_000
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    from services.latency_stats import percentile
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+    }
+
+
+class DbTimer:
+    """Время запросов к БД по событиям движка SQLAlchemy"""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.durations: List[float] = []
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        self.durations.append(time.perf_counter() - conn.info["query_start"].pop())
+
+
+def make_update(update_id: int, tg_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": tg_id, "type": "private"},
+            "from": {"id": tg_id, "is_bot": False, "first_name": "Load", "username": f"load{tg_id}"},
+            "text": text,
+        },
+    }
+
+
+def turn_metrics(turns: List[Dict[str, Any]], calls: List[Dict[str, Any]]) -> Dict[str, List[float]]:
+    """Разбор записанных заглушкой Telegram отправок по ходам пользователей"""
+    by_chat: Dict[int, List[Dict[str, Any]]] = {}
+    for call in calls:
+        by_chat.setdefault(call["chat_id"], []).append(call)
+
+    result = {"ttft": [], "queue_wait": [], "turn": [], "edits": [], "errors": 0}
+    for turn in turns:
+        events = [call for call in by_chat.get(turn["chat_id"], []) if turn["start"] <= call["time"] <= turn["end"]]
+        result["turn"].append(turn["end"] - turn["start"])
+        started = next((call for call in events if call["text"].startswith("🔄")), None)
+        if started:
+            result["queue_wait"].append(started["time"] - turn["start"])
+        edits = [call for call in events if call["method"] == "editMessageText"]
+        if edits:
+            result["ttft"].append(edits[0]["time"] - turn["start"])
+        result["edits"].append(len(edits))
+        if turn["failed"] or any(call["text"].startswith("❌") for call in events):
+            result["errors"] += 1
+    return result
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    openai_stub = fake_openai.from_arguments(args)
+    telegram_stub = fake_telegram.from_arguments(args)
+    openai_runner = await fake_openai.start_server(openai_stub.make_app(), args.openai_port)
+    telegram_runner = await fake_openai.start_server(telegram_stub.make_app(), args.telegram_port)
+
+    # Конфиг читается при импорте - окружение задаем до импорта модулей бота
+    os.environ["OPENAI_API_KEY"] = "sk-load-test"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.openai_port}/v1"
+    os.environ["BOT_TOKEN"] = BOT_TOKEN
+    os.environ["COALESCE_WINDOW"] = str(args.coalesce_window)
+    os.environ["QUEUE_WORKERS"] = str(args.workers)
+    if args.fsm_storage:
+        os.environ["FSM_STORAGE"] = args.fsm_storage
+
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.fsm.storage.base import StorageKey
+
+    import app
+    from database.models import create_tables, engine
+    from database.operations import get_or_create_user, create_chat
+    from handlers import setup_routers
+    from handlers.chat import ChatStates
+    from services.fsm_storage import create_fsm_storage
+    from config import MODELS
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    create_tables()
+    db_timer = DbTimer(engine)
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.telegram_port}"))
+    bot = Bot(token=BOT_TOKEN, session=session)
+    dp = Dispatcher(storage=create_fsm_storage())
+    dp.include_router(setup_routers())
+    await app.on_startup(metrics_port=args.metrics_port)
+
+    # Пользователи уже в чате с моделью
+    rates = MODELS.get(args.model, {"input": 0, "output": 0})
+    for i in range(args.users):
+        tg_id = FIRST_USER_ID + i
+        user_id = await get_or_create_user(tg_id, f"load{i}")
+        chat_id = await create_chat(user_id, args.model)
+        key = StorageKey(bot_id=bot.id, chat_id=tg_id, user_id=tg_id)
+        await dp.storage.set_state(key, ChatStates.waiting_for_message)
+        await dp.storage.set_data(key, {
+            "model": args.model,
+            "chat_id": chat_id,
+            "max_tokens": args.max_tokens,
+            "model_rate_input": rates["input"],
+            "model_rate_output": rates["output"],
+        })
+    db_timer.durations.clear()
+
+    turns: List[Dict[str, Any]] = []
+    update_ids = iter(range(1, 10 ** 9))
+    rnd = random.Random(args.seed)
+
+    async def simulate_user(index: int):
+        tg_id = FIRST_USER_ID + index
+        await asyncio.sleep(rnd.uniform(0, args.ramp_up))
+        for turn in range(args.turns):
+            start = time.monotonic()
+            text = f"Вопрос {turn + 1} от пользователя {index}: расскажи что-нибудь интересное"
+            try:
+                await dp.feed_raw_update(bot, make_update(next(update_ids), tg_id, text))
+                failed = False
+            except Exception as e:
+                # Ошибка, которую бот не обработал сам (например, 429 на отправке уведомления)
+                logging.getLogger('telegram_bot').debug(f"Ход завершился ошибкой: {e!r}")
+                failed = True
+            turns.append({"chat_id": tg_id, "start": start, "end": time.monotonic(), "failed": failed})
+            await asyncio.sleep(rnd.uniform(0, args.think_time))
+
+    run_start = time.monotonic()
+    try:
+        await asyncio.gather(*(simulate_user(i) for i in range(args.users)))
+        duration = time.monotonic() - run_start
+    finally:
+        await app.on_shutdown(bot, dp)
+        await openai_runner.cleanup()
+        await telegram_runner.cleanup()
+
+    metrics = turn_metrics(turns, telegram_stub.calls)
+    edits_total = sum(metrics["edits"])
+    return {
+        "config": {
+            "users": args.users, "turns": args.turns, "model": args.model, "workers": args.workers,
+            "ttft": args.ttft, "tps": args.tps, "output_tokens": args.output_tokens,
+        },
+        "duration": duration,
+        "turns": len(turns),
+        "errors": metrics["errors"],
+        "ttft": summarize(metrics["ttft"]),
+        "queue_wait": summarize(metrics["queue_wait"]),
+        "turn": summarize(metrics["turn"]),
+        "edits_per_second": edits_total / duration if duration else 0.0,
+        "edits_per_turn": edits_total / len(turns) if turns else 0.0,
+        "db": {
+            "queries": len(db_timer.durations),
+            "total": sum(db_timer.durations),
+            "per_turn": sum(db_timer.durations) / len(turns) if turns else 0.0,
+            "query_p95": summarize(db_timer.durations)["p95"],
+        },
+        "openai": openai_stub.stats(),
+        "telegram": telegram_stub.stats(),
+    }
+
+
+def print_report(result: Dict[str, Any], baseline: Dict[str, Any] = None):
+    def delta(path: List[str]) -> str:
+        if baseline is None:
+            return ""
+        old = baseline
+        new = result
+        for key in path:
+            old, new = old.get(key, {}), new[key]
+        if not isinstance(old, (int, float)) or not old:
+            return ""
+        return f"   ({(new - old) / old * 100:+.1f}% к базовому)"
+
+    print(f"Ходов: {result['turns']} за {result['duration']:.1f} сек., ошибок: {result['errors']}")
+    for name, title in (("ttft", "До первого токена"), ("queue_wait", "Ожидание в очереди"), ("turn", "Весь ход")):
+        stats = result[name]
+        print(
+            f"{title:<20} p50 {stats['p50'] * 1000:8.0f} мс   p95 {stats['p95'] * 1000:8.0f} мс"
+            f"   p99 {stats['p99'] * 1000:8.0f} мс{delta([name, 'p95'])}"
+        )
+    print(f"Правок в секунду:    {result['edits_per_second']:.1f} (на ход {result['edits_per_turn']:.1f})"
+          f"{delta(['edits_per_second'])}")
+    db = result["db"]
+    print(f"БД: запросов {db['queries']}, всего {db['total'] * 1000:.0f} мс, на ход {db['per_turn'] * 1000:.1f} мс,"
+          f" p95 запроса {db['query_p95'] * 1000:.2f} мс{delta(['db', 'per_turn'])}")
+    print(f"OpenAI: {result['openai']}")
+    print(f"Telegram: {result['telegram']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="Одновременных пользователей")
+    parser.add_argument("--turns", type=int, default=3, help="Сообщений от каждого пользователя")
+    parser.add_argument("--model", default="gpt-4.1-nano")
+    parser.add_argument("--max-tokens", type=int, default=4000)
+    parser.add_argument("--workers", type=int, default=4, help="QUEUE_WORKERS")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Пауза пользователя между сообщениями, сек.")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="За сколько секунд подключаются все пользователи")
+    parser.add_argument("--coalesce-window", type=float, default=0.0, help="COALESCE_WINDOW")
+    parser.add_argument("--fsm-storage", default=None, help="FSM_STORAGE (по умолчанию из конфига)")
+    parser.add_argument("--openai-port", type=int, default=8765)
+    parser.add_argument("--telegram-port", type=int, default=8766)
+    parser.add_argument("--metrics-port", type=int, default=0, help="Отдавать метрики бота во время теста")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Сохранить результат в JSON")
+    parser.add_argument("--baseline", help="Сравнить с сохраненным ранее результатом")
+    parser.add_argument("--verbose", action="store_true", help="Не приглушать логи бота")
+    fake_openai.add_arguments(parser)
+    fake_telegram.add_arguments(parser)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # Временная БД в отдельном каталоге, чтобы не трогать рабочую openai_bot.db
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            result = asyncio.run(run(args))
+        finally:
+            os.chdir(cwd)
+
+    print_report(result, baseline)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Бенчмарк клиента OpenAI: новый клиент на каждый запрос против общего пула соединений.
+
+Запуск из корня репозитория:
+    python -m benchmarks.openai_client_bench --requests 50
+
+Поднимает локальную заглушку OpenAI-совместимого API и меряет время до первого токена
+для запросов, идущих друг за другом.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from aiohttp import web
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+
+
+async def chat_completions(request: web.Request) -> web.StreamResponse:
+    """Заглушка /v1/chat/completions: отдает короткий стрим"""
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    response.enable_chunked_encoding()  # Без chunked aiohttp закрывает соединение после ответа
+    await response.prepare(request)
+    for word in ["Привет", ",", " мир", "!"]:
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "gpt-4.1-nano",
+            "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}],
+        }
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def start_stub(port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def time_to_first_token(client) -> float:
+    start = time.perf_counter()
+    stream = await client.chat.completions.create(
+        model="gpt-4.1-nano",
+        messages=[{"role": "user", "content": "ping"}],
+        stream=True
+    )
+    ttft = None
+    async for chunk in stream:
+        if ttft is None:
+            ttft = time.perf_counter() - start
+    return ttft
+
+
+def report(name: str, samples):
+    from services.latency_stats import percentile
+    p95 = percentile(samples, 0.95)
+    print(f"{name:<22} avg {statistics.mean(samples) * 1000:7.2f} мс   p95 {p95 * 1000:7.2f} мс")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+    from openai import AsyncOpenAI
+    from services.openai_client import OpenAIClientManager
+
+    runner = await start_stub(args.port)
+    try:
+        # Новый клиент на каждый запрос (как было раньше)
+        fresh = []
+        for _ in range(args.requests):
+            client = AsyncOpenAI(api_key="sk-bench", base_url=os.environ["OPENAI_BASE_URL"], timeout=30.0)
+            fresh.append(await time_to_first_token(client))
+            await client.close()
+
+        # Общий клиент с пулом keep-alive соединений
+        manager = OpenAIClientManager()
+        pooled = [await time_to_first_token(manager.get_client()) for _ in range(args.requests)]
+        pool_stats = manager.get_pool_stats()
+        await manager.close()
+    finally:
+        await runner.cleanup()
+
+    report("Новый клиент", fresh)
+    report("Общий пул", pooled)
+    print(f"Статистика пула: {pool_stats}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+"""
+Микробенчмарк накопления стрима: конкатенация строки против StreamBuffer.
+
+Запуск из корня репозитория:
+    python -m benchmarks.stream_buffer_bench --tokens 16000
+
+Старый цикл на каждый кусок делал full_response += content, len() и strip().
+StreamBuffer копит куски и собирает строку только при отправке правки
+(здесь - раз в --edit-every кусков, как при правке раз в секунду).
+"""
+import argparse
+import time
+
+from services.stream_buffer import StreamBuffer
+
+
+def naive(chunks, edit_every: int) -> int:
+    full_response = ""
+    edits = 0
+    for i, content in enumerate(chunks):
+        full_response += content
+        if len(full_response) > 0 and full_response.strip() and i % edit_every == 0:
+            edits += 1
+    return edits
+
+
+def buffered(chunks, edit_every: int) -> int:
+    buffer = StreamBuffer()
+    edits = 0
+    for i, content in enumerate(chunks):
+        buffer.append(content)
+        if buffer.length > 0 and buffer.has_visible and i % edit_every == 0:
+            buffer.getvalue()
+            edits += 1
+    buffer.getvalue()
+    return edits
+
+
+def measure(func, chunks, edit_every: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(chunks, edit_every)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=16000)
+    parser.add_argument("--edit-every", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # Куски похожи на дельты модели: слово с пробелом, иногда перевод строки
+    words = ["Привет", " мир", ",", " это", " тест", "\n", " стрима", "."]
+    chunks = [words[i % len(words)] for i in range(args.tokens)]
+
+    for name, func in (("Конкатенация", naive), ("StreamBuffer", buffered)):
+        elapsed = measure(func, chunks, args.edit_every, args.repeat)
+        print(f"{name:<14} {elapsed * 1000:8.2f} мс всего   {elapsed / args.tokens * 1e6:6.3f} мкс/токен")
+
+
+if __name__ == "__main__":
+    main()
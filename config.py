@@ -8,6 +8,25 @@ load_dotenv(override=True)  # Принудительно перезагружа
 # Константы бота
 TOKEN = os.getenv("BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # Можно указать совместимый сервер (например, заглушку для бенчмарков)
+
+# Режим получения обновлений: "polling" (long polling) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Вебхук (для BOT_MODE=webhook), бот слушает WEBHOOK_HOST:WEBHOOK_PORT за обратным прокси
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Telegram присылает его в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 - выключены).
+# При запуске через supervisor.py процесс-обработчик N слушает METRICS_PORT + N
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Количество процессов-обработчиков при запуске через supervisor.py
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", str(os.cpu_count() or 1)))
 
 # ID главного админа (будет получать уведомления о запросах)
 MAIN_ADMIN_ID = 165879072  # Замени на ID главного админа
@@ -19,15 +38,132 @@ DEFAULT_MAX_TOKENS = 4000
 ADMIN_IDS = [165879072, 5237388776, 415595998, 838624082, 133252780, 1906674281]  # Замени своими ID
 
 # Модели и цены (за миллион токенов)
+# cached_input - цена входных токенов, которые OpenAI взял из кэша префиксов запроса
 MODELS: Dict[str, Dict[str, float]] = {
-    "gpt-4.1": {"input": 2.0, "output": 8.0},
-    "gpt-4.1-mini": {"input": 0.40, "output": 1.60},
-    "gpt-4.1-nano": {"input": 0.10, "output": 0.40},
-    "gpt-4o-mini": {"input": 0.15, "output": 0.60},
+    "gpt-4.1": {"input": 2.0, "cached_input": 0.50, "output": 8.0},
+    "gpt-4.1-mini": {"input": 0.40, "cached_input": 0.10, "output": 1.60},
+    "gpt-4.1-nano": {"input": 0.10, "cached_input": 0.025, "output": 0.40},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60},
 }
 
 # Курс конвертации
 USD_TO_RUB = 107
 
 # База данных
-DB_URL = "sqlite:///openai_bot.db"  # SQLite для начала
\ No newline at end of file
+DB_URL = "sqlite:///openai_bot.db"  # SQLite для начала
+DB_FLUSH_INTERVAL = 1.0  # Как часто сбрасывать накопленные сообщения и статистику в БД, сек.
+DB_FLUSH_MAX_PENDING = 100  # Сбрасывать раньше, если накопилось столько сообщений
+
+# Настройки SQLite, применяются к каждому новому соединению
+SQLITE_PRAGMAS: Dict[str, str] = {
+    "journal_mode": "WAL",  # Читатели не блокируют писателя
+    "synchronous": "NORMAL",  # В режиме WAL безопасно и без fsync на каждый коммит
+    "busy_timeout": "5000",  # Ждать освобождения блокировки до 5 сек. вместо ошибки
+    "cache_size": "-65536",  # 64 МБ кэша страниц
+    "mmap_size": "268435456",  # 256 МБ файла БД читаем через mmap
+    "temp_store": "MEMORY",
+}
+
+# Очередь запросов
+QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", "4"))  # Количество параллельных обработчиков очереди
+# Сколько секунд при остановке ждать, пока доработают принятые обновления и запросы (всего).
+# Вместе с OUTBOUND_DRAIN_TIMEOUT и записью в БД должно укладываться в TimeoutStopSec systemd (90 сек.)
+SHUTDOWN_DRAIN_TIMEOUT = 50.0
+
+# Склейка сообщений: сообщения, отправленные подряд, уходят модели одним запросом
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "1.5"))  # Сколько секунд ждать следующего сообщения (0 - не ждать)
+COALESCE_MAX_DELAY = 5.0  # Дольше этого реплику не задерживаем, даже если сообщения продолжают приходить
+
+# Оценка времени ожидания в очереди
+LATENCY_WINDOW = 100  # По скольким последним запросам к модели считать статистику
+QUEUE_DEFAULT_SERVICE_TIME = 60.0  # Оценка времени обработки запроса, пока статистики по модели нет, сек.
+
+# Максимум одновременных запросов к каждой модели (модели без лимита ограничены только QUEUE_WORKERS)
+MODEL_CONCURRENCY: Dict[str, int] = {
+    "gpt-4.1": 2,
+    "gpt-4.1-mini": 4,
+    "gpt-4.1-nano": 4,
+    "gpt-4o-mini": 4,
+}
+
+# Лимиты OpenAI на запросы и токены в минуту (по уровню аккаунта). Запросы сверх них ждут в очереди
+MODEL_RATE_LIMITS: Dict[str, Dict[str, float]] = {
+    "gpt-4.1": {"rpm": 500, "tpm": 30_000},
+    "gpt-4.1-mini": {"rpm": 500, "tpm": 200_000},
+    "gpt-4.1-nano": {"rpm": 500, "tpm": 200_000},
+    "gpt-4o-mini": {"rpm": 500, "tpm": 200_000},
+}
+
+# Повторы запросов к OpenAI после временных ошибок (сеть, таймаут, 5xx, 429)
+OPENAI_RETRIES = 3
+OPENAI_RETRY_BASE_DELAY = 0.5  # Пауза перед повтором - случайная до base * 2^попытка, сек.
+OPENAI_RETRY_MAX_DELAY = 8.0
+
+# Предохранитель: после стольких сбоев модели подряд запросы к ней не отправляются CIRCUIT_RESET_TIMEOUT сек.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30.0
+
+# Резервные модели на время, пока предохранитель модели открыт (пустой словарь - без замены)
+MODEL_FALLBACKS: Dict[str, str] = {
+    "gpt-4.1": "gpt-4.1-mini",
+    "gpt-4.1-mini": "gpt-4.1-nano",
+    "gpt-4o-mini": "gpt-4.1-nano",
+}
+
+# Пул HTTP-соединений к OpenAI API
+OPENAI_TIMEOUT = 30.0  # Таймаут запроса и ожидания очередного куска стрима, сек.
+OPENAI_CONNECT_TIMEOUT = 5.0  # Таймаут установки соединения - недоступный сервер быстрее уходит в повтор
+OPENAI_MAX_CONNECTIONS = 100  # Максимум одновременных соединений
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 20  # Сколько простаивающих соединений держать открытыми
+OPENAI_KEEPALIVE_EXPIRY = 120.0  # Через сколько секунд закрывать простаивающее соединение
+
+# Подсчет токенов
+TOKEN_CACHE_SIZE = 20000  # Сколько посчитанных текстов держать в LRU-кэше
+TOKEN_COUNT_THREADS = 4  # Потоков tiktoken для пакетного подсчета
+
+# Окно контекста: сколько токенов истории отправлять модели за один запрос
+CONTEXT_TOKEN_BUDGET: Dict[str, int] = {
+    "gpt-4.1": 32000,
+    "gpt-4.1-mini": 32000,
+    "gpt-4.1-nano": 16000,
+    "gpt-4o-mini": 16000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 16000
+
+# Размер контекстного окна моделей (вход + выход)
+MODEL_CONTEXT_WINDOW: Dict[str, int] = {
+    "gpt-4.1": 1_047_576,
+    "gpt-4.1-mini": 1_047_576,
+    "gpt-4.1-nano": 1_047_576,
+    "gpt-4o-mini": 128_000,
+}
+
+CONTEXT_TRIM_STEP = 4  # Историю обрезаем блоками по столько сообщений, чтобы начало запроса менялось реже
+
+# Краткое содержание отброшенной части истории
+CONTEXT_SUMMARY_ENABLED = os.getenv("CONTEXT_SUMMARY_ENABLED", "0") == "1"
+CONTEXT_SUMMARY_MODEL = "gpt-4.1-nano"
+CONTEXT_SUMMARY_MAX_TOKENS = 500
+
+# Фоновая отправка служебных сообщений (статус запроса, позиция в очереди, уведомления админу)
+OUTBOUND_QUEUE_SIZE = 1000  # Сверх этого сообщения отбрасываются
+OUTBOUND_WORKERS = 4
+OUTBOUND_MAX_ATTEMPTS = 3  # Попыток отправки с учетом ответов 429
+OUTBOUND_DRAIN_TIMEOUT = 5.0  # Сколько секунд при остановке дожидаться отправки накопленного
+
+# Ограничения Telegram на отправку и редактирование сообщений
+TELEGRAM_GLOBAL_RATE = 25.0  # Запросов в секунду на всего бота (лимит Telegram ~30)
+TELEGRAM_CHAT_RATE = 1.0  # Правок в секунду в личном чате
+TELEGRAM_GROUP_RATE = 20 / 60  # Правок в секунду в группе (лимит Telegram 20 в минуту)
+
+# Хранилище состояний FSM: "sqlite" (в той же БД), "redis" (нужен пакет redis) или "memory"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+FSM_CACHE_SIZE = 10000  # Сколько состояний пользователей держать в памяти процесса
+
+# Кэш ответов: одинаковые вопросы с тем же промптом и моделью не отправляются в OpenAI повторно.
+# Кэш общий для всех пользователей, поэтому включается явно
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1"
+RESPONSE_CACHE_TTL = 24 * 60 * 60  # Сколько секунд ответ считается актуальным
+RESPONSE_CACHE_MAX_ENTRIES = 5000  # Сверх этого удаляются давно не использованные ответы
+RESPONSE_CACHE_CONTEXT_MESSAGES = 4  # Сколько последних сообщений истории входит в ключ
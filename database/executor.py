@@ -0,0 +1,40 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Coroutine
+
+from services.metrics import DB_OPERATION_DURATION, DB_OPERATION_ERRORS
+
+# Все операции с БД выполняются в одном отдельном потоке:
+# event loop не блокируется, а SQLite все равно пишет последовательно
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+def db_operation(func: Callable[..., Any]) -> Callable[..., Coroutine[Any, Any, Any]]:
+    """Превращает синхронную операцию с БД в корутину, выполняемую в потоке БД"""
+    duration = DB_OPERATION_DURATION.labels(func.__name__)
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            DB_OPERATION_ERRORS.labels(func.__name__).inc()
+            raise
+        finally:
+            duration.observe(time.perf_counter() - start)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(timed, *args, **kwargs))
+
+    # Синхронная версия для вызова из самого потока БД
+    wrapper.sync = func
+    return wrapper
+
+
+def shutdown_db_executor():
+    """Дожидается завершения всех операций с БД"""
+    _executor.shutdown(wait=True)
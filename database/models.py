@@ -1,14 +1,30 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Text, create_engine
+from datetime import datetime
+
+from sqlalchemy import (
+    Column, Integer, String, Float, ForeignKey, Text, Date, DateTime, Index, UniqueConstraint,
+    create_engine, event, inspect, text
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 
-from config import DB_URL
+from config import DB_URL, SQLITE_PRAGMAS
 
 Base = declarative_base()
 engine = create_engine(DB_URL)
 Session = sessionmaker(bind=engine)
 
 
+@event.listens_for(engine, "connect")
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Применяет настройки производительности SQLite к новому соединению"""
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
 class User(Base):
     __tablename__ = "users"
     
@@ -34,8 +50,16 @@ class Chat(Base):
     tokens_input = Column(Integer, default=0)
     tokens_output = Column(Integer, default=0)
     cost_usd = Column(Float, default=0.0)
+    context_tokens = Column(Integer, default=0)  # Сумма токенов всех сообщений чата (размер истории)
+    cached_tokens = Column(Integer, default=0)  # Входные токены, оплаченные по цене кэша OpenAI
+    created_at = Column(DateTime, default=datetime.now)
     
     messages = relationship("Message", back_populates="chat")
+    
+    __table_args__ = (
+        Index("ix_chats_user_id", "user_id"),
+        Index("ix_chats_model", "model"),
+    )
 
 
 class Message(Base):
@@ -45,11 +69,19 @@ class Message(Base):
     chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
     chat = relationship("Chat", back_populates="messages")
     
-    role = Column(String(20), nullable=False)  # user или assistant
+    role = Column(String(20), nullable=False)  # user, assistant или system (смена промпта)
     content = Column(Text, nullable=False)
     
     tokens = Column(Integer, default=0)
     cost_usd = Column(Float, default=0.0)
+    context_tokens = Column(Integer, default=0)  # Токены самого текста сообщения в истории
+    cached_tokens = Column(Integer, default=0)  # Сколько из tokens OpenAI взял из кэша префиксов
+    created_at = Column(DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        Index("ix_messages_chat_id_id", "chat_id", "id"),  # История чата по порядку
+        Index("ix_messages_chat_role_id", "chat_id", "role", "id"),  # Последнее сообщение роли в чате
+    )
 
 
 class Prompt(Base):
@@ -61,10 +93,105 @@ class Prompt(Base):
     
     name = Column(String(100), nullable=False)
     content = Column(Text, nullable=False)
+    
+    __table_args__ = (
+        Index("ix_prompts_user_id", "user_id"),
+    )
+
+
+class UsageDaily(Base):
+    """Дневная сводка расхода по пользователю и модели (для отчетов за период)"""
+    __tablename__ = "usage_daily"
+    
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    model = Column(String(50), nullable=False)
+    
+    tokens_input = Column(Integer, default=0)
+    tokens_output = Column(Integer, default=0)
+    cost_usd = Column(Float, default=0.0)
+    messages_count = Column(Integer, default=0)
+    cache_hits = Column(Integer, default=0)  # Ответов, выданных из кэша
+    cache_saved_usd = Column(Float, default=0.0)  # Сколько стоили бы эти ответы без кэша
+    
+    __table_args__ = (
+        UniqueConstraint("day", "user_id", "model", name="uq_usage_daily_day_user_model"),
+    )
+
+
+class FsmRecord(Base):
+    """Состояние FSM aiogram (переживает перезапуск бота)"""
+    __tablename__ = "fsm_states"
+    
+    key = Column(String(255), primary_key=True)
+    state = Column(String(255))
+    data = Column(Text, nullable=False, default="{}")  # JSON
+
+
+class ResponseCache(Base):
+    """Кэш ответов модели по ключу (модель, промпт, последние сообщения)"""
+    __tablename__ = "response_cache"
+    
+    key = Column(String(64), primary_key=True)  # sha256 нормализованного запроса
+    model = Column(String(50), nullable=False)
+    content = Column(Text, nullable=False)
+    
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+    cost_usd = Column(Float, default=0.0)  # Стоимость исходного запроса
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+    last_used_at = Column(DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        Index("ix_response_cache_last_used_at", "last_used_at"),  # Вытеснение давно не использованных
+    )
+
+
+# Колонки, добавленные после первого релиза: (таблица, колонка, DDL, SQL для заполнения старых строк)
+COLUMN_MIGRATIONS = [
+    (
+        "messages", "context_tokens", "INTEGER DEFAULT 0",
+        # Для старых сообщений точное число токенов неизвестно - берем оценку 1 токен ≈ 4 символа
+        "UPDATE messages SET context_tokens = LENGTH(content) / 4"
+    ),
+    (
+        "chats", "context_tokens", "INTEGER DEFAULT 0",
+        "UPDATE chats SET context_tokens = "
+        "(SELECT COALESCE(SUM(context_tokens), 0) FROM messages WHERE messages.chat_id = chats.id)"
+    ),
+    # Для старых строк дата неизвестна - они учитываются только в отчете за все время
+    ("chats", "created_at", "DATETIME", None),
+    ("messages", "created_at", "DATETIME", None),
+    ("usage_daily", "cache_hits", "INTEGER DEFAULT 0", None),
+    ("messages", "cached_tokens", "INTEGER DEFAULT 0", None),
+    ("chats", "cached_tokens", "INTEGER DEFAULT 0", None),
+    ("usage_daily", "cache_saved_usd", "FLOAT DEFAULT 0", None),
+]
+
+
+def migrate():
+    """Добавляет в существующую базу недостающие колонки и индексы без потери данных"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table, column, ddl, backfill in COLUMN_MIGRATIONS:
+            columns = {col["name"] for col in inspector.get_columns(table)}
+            if column in columns:
+                continue
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            if backfill:
+                conn.execute(text(backfill))
+        
+        # create_all не добавляет индексы к уже существующим таблицам
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
 
 
 def create_tables():
     Base.metadata.create_all(engine)
+    migrate()
 
 
 if __name__ == "__main__":
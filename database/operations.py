@@ -1,9 +1,17 @@
+import json
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.exc import NoResultFound
+from datetime import date, datetime, time, timedelta
 from typing import Optional, List, Dict, Any
 
-from .models import Session, User, Chat, Message, Prompt
+from .models import Session, User, Chat, Message, Prompt, UsageDaily, FsmRecord, ResponseCache
+from .rollup import record_daily_usage
+from .executor import db_operation
+from .write_buffer import write_buffer
 
 
+@db_operation
 def get_or_create_user(tg_id: int, username: Optional[str] = None) -> int:
     """Получить существующего пользователя или создать нового"""
     session = Session()
@@ -17,6 +25,7 @@ def get_or_create_user(tg_id: int, username: Optional[str] = None) -> int:
     return user_id
 
 
+@db_operation
 def create_chat(user_id: int, model: str) -> int:
     """Создать новый чат"""
     session = Session()
@@ -30,6 +39,7 @@ def create_chat(user_id: int, model: str) -> int:
     session.close()
     return result
 
+@db_operation
 def get_prompt_by_id(prompt_id: int) -> Optional[Prompt]:
     """Получить промпт по ID"""
     session = Session()
@@ -42,66 +52,69 @@ def get_prompt_by_id(prompt_id: int) -> Optional[Prompt]:
         session.close()
         return None
 
-def add_message(chat_id: int, role: str, content: str, tokens: int, cost_usd: float) -> Message:
-    """Добавить сообщение в чат"""
-    session = Session()
-    
-    message = Message(
-        chat_id=chat_id,
-        role=role,
-        content=content,
-        tokens=tokens,
-        cost_usd=cost_usd
-    )
-    
-    session.add(message)
-    
-    # Обновляем статистику чата
-    chat = session.query(Chat).filter(Chat.id == chat_id).one()
-    if role == "user":
-        chat.tokens_input += tokens
-    else:
-        chat.tokens_output += tokens
-    chat.cost_usd += cost_usd
-    
-    # Обновляем статистику пользователя
-    user = chat.user
-    if role == "user":
-        user.total_tokens_input += tokens
-    else:
-        user.total_tokens_output += tokens
-    user.total_cost_usd += cost_usd
-    
-    session.commit()
-    result = message
-    session.close()
-    return result
+async def add_message(chat_id: int, role: str, content: str, tokens: int, cost_usd: float,
+                      context_tokens: Optional[int] = None, cached_tokens: int = 0) -> None:
+    """
+    Добавить сообщение в чат
+    context_tokens - токены самого текста (по умолчанию равны tokens),
+    tokens - токены, за которые выставлен счет (из них cached_tokens - по цене кэша OpenAI)
+    Сообщение и статистика записываются в БД отложенно (см. write_buffer)
+    """
+    if context_tokens is None:
+        context_tokens = tokens
+    write_buffer.add_message(chat_id, role, content, tokens, cost_usd, context_tokens, cached_tokens)
+
+
+def record_cache_hit(chat_id: int, saved_usd: float) -> None:
+    """Учесть ответ, выданный из кэша, в дневной сводке"""
+    write_buffer.add_usage(chat_id, cache_hits=1, cache_saved_usd=saved_usd)
 
 
+def record_service_usage(chat_id: int, tokens_input: int, tokens_output: int, cost_usd: float,
+                         cached_tokens: int = 0) -> None:
+    """Учесть служебный запрос к модели (сжатие истории) в расходах чата, не добавляя сообщений"""
+    write_buffer.add_usage(chat_id, tokens_input=tokens_input, tokens_output=tokens_output,
+                           cost_usd=cost_usd, cached_tokens=cached_tokens)
+
+
+@db_operation
 def get_chat_messages(chat_id: int) -> List[Dict[str, Any]]:
-    """Получить все сообщения чата в формате для API OpenAI"""
+    """Получить все сообщения чата с сохраненным количеством токенов каждого"""
     session = Session()
-    messages = session.query(Message).filter(Message.chat_id == chat_id).all()
+    messages = session.query(Message).filter(Message.chat_id == chat_id).order_by(Message.id).all()
     
-    result = [{"role": msg.role, "content": msg.content} for msg in messages]
+    result = [
+        {"role": msg.role, "content": msg.content, "tokens": msg.context_tokens or 0}
+        for msg in messages
+    ]
+    # Сообщения, которые еще не записаны из буфера
+    result.extend(
+        {"role": msg["role"], "content": msg["content"], "tokens": msg["context_tokens"]}
+        for msg in write_buffer.pending_messages(chat_id)
+    )
     session.close()
     return result
 
 
+@db_operation
 def get_chat_stats(chat_id: int) -> Dict[str, Any]:
     """Получить статистику чата"""
     session = Session()
     chat = session.query(Chat).filter(Chat.id == chat_id).one()
+    pending = write_buffer.pending_delta(chat_id)
     
     result = {
-        "tokens_input": chat.tokens_input,
-        "tokens_output": chat.tokens_output,
-        "cost_usd": chat.cost_usd,
+        "tokens_input": chat.tokens_input + pending["tokens_input"],
+        "tokens_output": chat.tokens_output + pending["tokens_output"],
+        "cost_usd": chat.cost_usd + pending["cost_usd"],
+        "context_tokens": (chat.context_tokens or 0) + pending["context_tokens"],
+        "cached_tokens": (chat.cached_tokens or 0) + pending["cached_tokens"],
     }
     session.close()
     return result
 
 
+@db_operation
 def save_prompt(user_id: int, name: str, content: str) -> Prompt:
     """Сохранить промпт"""
     session = Session()
@@ -115,6 +128,7 @@ def save_prompt(user_id: int, name: str, content: str) -> Prompt:
     return result
 
 
+@db_operation
 def get_user_prompts(user_id: int) -> List[Prompt]:
     """Получить все промпты пользователя"""
     session = Session()
@@ -125,6 +139,7 @@ def get_user_prompts(user_id: int) -> List[Prompt]:
     return result
 
 
+@db_operation
 def delete_prompt(prompt_id: int) -> bool:
     """Удалить промпт"""
     session = Session()
@@ -139,52 +154,150 @@ def delete_prompt(prompt_id: int) -> bool:
         return False
 
 
-def get_admin_stats() -> Dict[str, Any]:
-    """Получить админскую статистику"""
+@db_operation
+def get_admin_stats(date_from: Optional[date] = None, date_to: Optional[date] = None) -> Dict[str, Any]:
+    """
+    Получить админскую статистику (агрегаты считаются в SQL)
+    Без дат - за все время по итоговым счетчикам, с датами - по дневной сводке usage_daily
+    """
+    # Сначала записываем накопленное, чтобы статистика была актуальной
+    write_buffer.flush_sync()
     session = Session()
     
-    users = session.query(User).all()
-    user_stats = []
-    
-    for user in users:
-        user_stat = {
-            "tg_id": user.tg_id,
-            "username": user.username,
-            "total_tokens_input": user.total_tokens_input,
-            "total_tokens_output": user.total_tokens_output,
-            "total_cost_usd": user.total_cost_usd,
-            "chats_count": len(user.chats)
+    if date_from is None and date_to is None:
+        # Количество чатов по пользователям одним запросом вместо ленивой загрузки user.chats
+        chats_count = func.count(Chat.id).label("chats_count")
+        user_rows = session.query(
+            User.tg_id, User.username, User.total_tokens_input, User.total_tokens_output,
+            User.total_cost_usd, chats_count
+        ).outerjoin(Chat, Chat.user_id == User.id).group_by(User.id).all()
+        
+        model_rows = session.query(
+            Chat.model,
+            func.coalesce(func.sum(Chat.tokens_input), 0),
+            func.coalesce(func.sum(Chat.tokens_output), 0),
+            func.coalesce(func.sum(Chat.cost_usd), 0.0),
+            func.count(Chat.id)
+        ).group_by(Chat.model).all()
+    else:
+        # Фильтр по периоду для сводки и для даты создания чатов
+        usage_filters = []
+        chat_filters = []
+        if date_from is not None:
+            usage_filters.append(UsageDaily.day >= date_from)
+            chat_filters.append(Chat.created_at >= datetime.combine(date_from, time.min))
+        if date_to is not None:
+            usage_filters.append(UsageDaily.day <= date_to)
+            chat_filters.append(Chat.created_at <= datetime.combine(date_to, time.max))
+        
+        usage = session.query(
+            UsageDaily.user_id.label("user_id"),
+            func.sum(UsageDaily.tokens_input).label("tokens_input"),
+            func.sum(UsageDaily.tokens_output).label("tokens_output"),
+            func.sum(UsageDaily.cost_usd).label("cost_usd")
+        ).filter(*usage_filters).group_by(UsageDaily.user_id).subquery()
+        chats = session.query(
+            Chat.user_id.label("user_id"),
+            func.count(Chat.id).label("chats_count")
+        ).filter(*chat_filters).group_by(Chat.user_id).subquery()
+        
+        user_rows = session.query(
+            User.tg_id, User.username,
+            func.coalesce(usage.c.tokens_input, 0),
+            func.coalesce(usage.c.tokens_output, 0),
+            func.coalesce(usage.c.cost_usd, 0.0),
+            func.coalesce(chats.c.chats_count, 0)
+        ).outerjoin(usage, usage.c.user_id == User.id) \
+            .outerjoin(chats, chats.c.user_id == User.id) \
+            .filter((usage.c.user_id.isnot(None)) | (chats.c.user_id.isnot(None))).all()
+        
+        model_chats = dict(
+            session.query(Chat.model, func.count(Chat.id)).filter(*chat_filters).group_by(Chat.model).all()
+        )
+        model_rows = [
+            (model, tokens_input, tokens_output, cost_usd, model_chats.get(model, 0))
+            for model, tokens_input, tokens_output, cost_usd in session.query(
+                UsageDaily.model,
+                func.sum(UsageDaily.tokens_input),
+                func.sum(UsageDaily.tokens_output),
+                func.sum(UsageDaily.cost_usd)
+            ).filter(*usage_filters).group_by(UsageDaily.model).all()
+        ]
+    
+    user_stats = [
+        {
+            "tg_id": tg_id,
+            "username": username,
+            "total_tokens_input": tokens_input,
+            "total_tokens_output": tokens_output,
+            "total_cost_usd": cost_usd,
+            "chats_count": count
         }
-        user_stats.append(user_stat)
+        for tg_id, username, tokens_input, tokens_output, cost_usd, count in user_rows
+    ]
     
     # Статистика по моделям
-    model_stats = {}
-    chats = session.query(Chat).all()
-    for chat in chats:
-        if chat.model not in model_stats:
-            model_stats[chat.model] = {
-                "tokens_input": 0,
-                "tokens_output": 0,
-                "cost_usd": 0.0,
-                "chats_count": 0
-            }
-        
-        model_stats[chat.model]["tokens_input"] += chat.tokens_input
-        model_stats[chat.model]["tokens_output"] += chat.tokens_output
-        model_stats[chat.model]["cost_usd"] += chat.cost_usd
-        model_stats[chat.model]["chats_count"] += 1
+    model_stats = {
+        model: {
+            "tokens_input": tokens_input,
+            "tokens_output": tokens_output,
+            "cost_usd": cost_usd,
+            "chats_count": count
+        }
+        for model, tokens_input, tokens_output, cost_usd, count in model_rows
+    }
+    
+    # Ответы из кэша (только по дневной сводке - за все время это тоже полная картина)
+    cache_filters = usage_filters if date_from is not None or date_to is not None else []
+    cache_hits, cache_saved_usd = session.query(
+        func.coalesce(func.sum(UsageDaily.cache_hits), 0),
+        func.coalesce(func.sum(UsageDaily.cache_saved_usd), 0.0)
+    ).filter(*cache_filters).one()
     
     result = {
         "users": user_stats,
-        "models": model_stats
+        "models": model_stats,
+        "cache": {"hits": cache_hits, "saved_usd": cache_saved_usd},
+        "date_from": date_from,
+        "date_to": date_to
     }
     
     session.close()
     return result
 
-def update_message_tokens(chat_id: int, is_user_message: bool, new_tokens: int, old_tokens: int, model: str) -> None:
-    """Обновить количество токенов в последнем сообщении и пересчитать статистику"""
+async def update_message_tokens(chat_id: int, is_user_message: bool, new_tokens: int, old_tokens: int, model: str,
+                                cached_tokens: int = 0) -> None:
+    """
+    Обновить количество токенов в последнем сообщении и пересчитать статистику
+    cached_tokens - сколько из new_tokens OpenAI взял из кэша (для входных токенов)
+    """
     from services.token_counter import calculate_cost
+    
+    # Определяем роль сообщения
+    role = "user" if is_user_message else "assistant"
+    
+    # Если сообщение еще в буфере, правим его там и копим разницу в статистике
+    new_cost = calculate_cost(new_tokens, model, is_user_message, cached_tokens)
+    previous = write_buffer.update_last_message(chat_id, role, new_tokens, new_cost, cached_tokens)
+    if previous is not None:
+        tokens_diff = new_tokens - old_tokens
+        cost_diff = new_cost - previous["cost_usd"]
+        if is_user_message:
+            write_buffer.add_usage(chat_id, tokens_input=tokens_diff, cost_usd=cost_diff,
+                                   cached_tokens=cached_tokens - previous["cached_tokens"])
+        else:
+            write_buffer.add_usage(chat_id, tokens_output=tokens_diff, cost_usd=cost_diff)
+        return
+    
+    await _update_stored_message_tokens(chat_id, is_user_message, new_tokens, old_tokens, model, cached_tokens)
+
+
+@db_operation
+def _update_stored_message_tokens(chat_id: int, is_user_message: bool, new_tokens: int, old_tokens: int, model: str,
+                                  cached_tokens: int = 0) -> None:
+    """Обновить токены последнего уже записанного в БД сообщения"""
+    from services.token_counter import calculate_cost
+    write_buffer.flush_sync()
     session = Session()
     
     # Определяем роль сообщения
@@ -199,16 +312,20 @@ def update_message_tokens(chat_id: int, is_user_message: bool, new_tokens: int,
     if last_message:
         # Вычисляем разницу между оценкой и реальным количеством
         tokens_diff = new_tokens - old_tokens
-        cost_diff = calculate_cost(tokens_diff, model, is_user_message)
+        new_cost = calculate_cost(new_tokens, model, is_user_message, cached_tokens)
+        cost_diff = new_cost - (last_message.cost_usd or 0.0)
+        cached_diff = cached_tokens - (last_message.cached_tokens or 0)
         
         # Обновляем запись сообщения
         last_message.tokens = new_tokens
-        last_message.cost_usd = calculate_cost(new_tokens, model, is_user_message)
+        last_message.cost_usd = new_cost
+        last_message.cached_tokens = cached_tokens
         
         # Обновляем статистику чата
         chat = session.query(Chat).filter(Chat.id == chat_id).one()
         if is_user_message:
             chat.tokens_input += tokens_diff
+            chat.cached_tokens = (chat.cached_tokens or 0) + cached_diff
         else:
             chat.tokens_output += tokens_diff
         chat.cost_usd += cost_diff
@@ -221,5 +338,108 @@ def update_message_tokens(chat_id: int, is_user_message: bool, new_tokens: int,
             user.total_tokens_output += tokens_diff
         user.total_cost_usd += cost_diff
         
+        # Обновляем дневную сводку
+        record_daily_usage(
+            session, user.id, chat.model,
+            tokens_input=tokens_diff if is_user_message else 0,
+            tokens_output=0 if is_user_message else tokens_diff,
+            cost_usd=cost_diff
+        )
+        
         session.commit()
-    session.close()
\ No newline at end of file
+    session.close()
+
+
+@db_operation
+def get_fsm_record(key: str) -> Dict[str, Any]:
+    """Получить состояние и данные FSM по ключу"""
+    session = Session()
+    record = session.query(FsmRecord).filter(FsmRecord.key == key).first()
+    if record:
+        result = {"state": record.state, "data": json.loads(record.data)}
+    else:
+        result = {"state": None, "data": {}}
+    session.close()
+    return result
+
+
+@db_operation
+def save_fsm_state(key: str, state: Optional[str]) -> None:
+    """Сохранить состояние FSM по ключу"""
+    session = Session()
+    stmt = insert(FsmRecord).values(key=key, state=state, data="{}")
+    stmt = stmt.on_conflict_do_update(index_elements=["key"], set_={"state": state})
+    session.execute(stmt)
+    session.commit()
+    session.close()
+
+
+@db_operation
+def save_fsm_data(key: str, data: Dict[str, Any]) -> None:
+    """Сохранить данные FSM по ключу"""
+    session = Session()
+    data_json = json.dumps(data, ensure_ascii=False)
+    stmt = insert(FsmRecord).values(key=key, state=None, data=data_json)
+    stmt = stmt.on_conflict_do_update(index_elements=["key"], set_={"data": data_json})
+    session.execute(stmt)
+    session.commit()
+    session.close()
+
+
+@db_operation
+def get_cached_response(key: str, ttl: int) -> Optional[Dict[str, Any]]:
+    """Найти ответ в кэше и отметить его использование (устаревший ответ удаляется)"""
+    session = Session()
+    entry = session.query(ResponseCache).filter(ResponseCache.key == key).first()
+    result = None
+    if entry:
+        now = datetime.now()
+        if entry.created_at < now - timedelta(seconds=ttl):
+            session.delete(entry)
+        else:
+            entry.hits += 1
+            entry.last_used_at = now
+            result = {
+                "content": entry.content,
+                "input_tokens": entry.input_tokens,
+                "output_tokens": entry.output_tokens,
+                "cost_usd": entry.cost_usd,
+            }
+        session.commit()
+    session.close()
+    return result
+
+
+@db_operation
+def save_cached_response(key: str, model: str, content: str, input_tokens: int, output_tokens: int,
+                         cost_usd: float, ttl: int, max_entries: int) -> None:
+    """Сохранить ответ в кэш и вытеснить устаревшие и давно не использованные ответы"""
+    session = Session()
+    now = datetime.now()
+    values = {
+        "model": model,
+        "content": content,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cost_usd": cost_usd,
+        "created_at": now,
+        "last_used_at": now,
+    }
+    stmt = insert(ResponseCache).values(key=key, hits=0, **values)
+    stmt = stmt.on_conflict_do_update(index_elements=["key"], set_=values)
+    session.execute(stmt)
+    
+    session.query(ResponseCache).filter(
+        ResponseCache.created_at < now - timedelta(seconds=ttl)
+    ).delete(synchronize_session=False)
+    
+    # LRU: оставляем max_entries последних использованных
+    stale = session.query(ResponseCache.key).order_by(
+        ResponseCache.last_used_at.desc()
+    ).offset(max_entries).subquery()
+    session.query(ResponseCache).filter(
+        ResponseCache.key.in_(session.query(stale.c.key))
+    ).delete(synchronize_session=False)
+    
+    session.commit()
+    session.close()
@@ -0,0 +1,35 @@
+from datetime import date
+from typing import Optional
+
+from sqlalchemy.dialects.sqlite import insert
+
+from .models import UsageDaily
+
+
+def record_daily_usage(session, user_id: int, model: str, tokens_input: int = 0, tokens_output: int = 0,
+                       cost_usd: float = 0.0, messages_count: int = 0, cache_hits: int = 0,
+                       cache_saved_usd: float = 0.0, day: Optional[date] = None) -> None:
+    """Прибавить расход к дневной сводке (в рамках транзакции переданной сессии)"""
+    stmt = insert(UsageDaily).values(
+        day=day or date.today(),
+        user_id=user_id,
+        model=model,
+        tokens_input=tokens_input,
+        tokens_output=tokens_output,
+        cost_usd=cost_usd,
+        messages_count=messages_count,
+        cache_hits=cache_hits,
+        cache_saved_usd=cache_saved_usd
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["day", "user_id", "model"],
+        set_={
+            "tokens_input": UsageDaily.tokens_input + stmt.excluded.tokens_input,
+            "tokens_output": UsageDaily.tokens_output + stmt.excluded.tokens_output,
+            "cost_usd": UsageDaily.cost_usd + stmt.excluded.cost_usd,
+            "messages_count": UsageDaily.messages_count + stmt.excluded.messages_count,
+            "cache_hits": UsageDaily.cache_hits + stmt.excluded.cache_hits,
+            "cache_saved_usd": UsageDaily.cache_saved_usd + stmt.excluded.cache_saved_usd,
+        }
+    )
+    session.execute(stmt)
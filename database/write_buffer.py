@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from config import DB_FLUSH_INTERVAL, DB_FLUSH_MAX_PENDING
+from .executor import db_operation
+from .models import Session, Chat, Message, User
+from .rollup import record_daily_usage
+
+logger = logging.getLogger('telegram_bot')
+
+# Поля статистики, которые копятся в буфере и прибавляются к строкам чатов и пользователей
+DELTA_FIELDS = (
+    "tokens_input", "tokens_output", "cost_usd", "context_tokens", "messages_count",
+    "cache_hits", "cache_saved_usd", "cached_tokens"
+)
+
+
+class WriteBehindBuffer:
+    """
+    Буфер отложенной записи: новые сообщения и изменения статистики копятся в памяти
+    и записываются в БД одной транзакцией раз в DB_FLUSH_INTERVAL секунд
+    или при накоплении DB_FLUSH_MAX_PENDING сообщений.
+    Чтения из operations.py дополняют данные из БД тем, что еще лежит в буфере.
+    """
+
+    def __init__(self, flush_interval: float = DB_FLUSH_INTERVAL, max_pending: int = DB_FLUSH_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._messages: List[Dict[str, Any]] = []
+        self._chat_deltas: Dict[int, Dict[str, float]] = {}
+        self._lock = threading.Lock()  # Буфер читается и из event loop, и из потока БД
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _add_delta(self, chat_id: int, **values: float) -> None:
+        delta = self._chat_deltas.setdefault(chat_id, dict.fromkeys(DELTA_FIELDS, 0))
+        for field, value in values.items():
+            delta[field] += value
+
+    def add_message(self, chat_id: int, role: str, content: str, tokens: int,
+                    cost_usd: float, context_tokens: int, cached_tokens: int = 0) -> None:
+        """Поставить сообщение в очередь на запись и учесть его в статистике чата"""
+        with self._lock:
+            self._messages.append({
+                "chat_id": chat_id,
+                "role": role,
+                "content": content,
+                "tokens": tokens,
+                "cost_usd": cost_usd,
+                "context_tokens": context_tokens,
+                "cached_tokens": cached_tokens,
+                "created_at": datetime.now(),
+            })
+            if role == "user":
+                self._add_delta(chat_id, tokens_input=tokens, cost_usd=cost_usd,
+                                context_tokens=context_tokens, messages_count=1, cached_tokens=cached_tokens)
+            else:
+                self._add_delta(chat_id, tokens_output=tokens, cost_usd=cost_usd,
+                                context_tokens=context_tokens, messages_count=1)
+            pending = len(self._messages)
+
+        if pending >= self.max_pending and self._wakeup is not None:
+            self._wakeup.set()
+
+    def add_usage(self, chat_id: int, tokens_input: int = 0, tokens_output: int = 0, cost_usd: float = 0.0,
+                  cache_hits: int = 0, cache_saved_usd: float = 0.0, cached_tokens: int = 0) -> None:
+        """Учесть изменение статистики чата (и его пользователя)"""
+        with self._lock:
+            self._add_delta(chat_id, tokens_input=tokens_input, tokens_output=tokens_output, cost_usd=cost_usd,
+                            cache_hits=cache_hits, cache_saved_usd=cache_saved_usd, cached_tokens=cached_tokens)
+
+    def update_last_message(self, chat_id: int, role: str, tokens: int, cost_usd: float,
+                            cached_tokens: int = 0) -> Optional[Dict[str, Any]]:
+        """
+        Обновить токены последнего сообщения роли, если оно еще не записано в БД
+        Возвращает прежние значения сообщения или None, если его в буфере нет
+        """
+        with self._lock:
+            for message in reversed(self._messages):
+                if message["chat_id"] == chat_id and message["role"] == role:
+                    previous = dict(message)
+                    message["tokens"] = tokens
+                    message["cost_usd"] = cost_usd
+                    message["cached_tokens"] = cached_tokens
+                    return previous
+        return None
+
+    def pending_messages(self, chat_id: int) -> List[Dict[str, Any]]:
+        """Еще не записанные сообщения чата"""
+        with self._lock:
+            return [dict(message) for message in self._messages if message["chat_id"] == chat_id]
+
+    def pending_delta(self, chat_id: int) -> Dict[str, float]:
+        """Еще не записанные изменения статистики чата"""
+        with self._lock:
+            return dict(self._chat_deltas.get(chat_id) or dict.fromkeys(DELTA_FIELDS, 0))
+
+    def flush_sync(self) -> int:
+        """Записать все накопленное одной транзакцией (вызывать в потоке БД)"""
+        with self._lock:
+            messages, self._messages = self._messages, []
+            deltas, self._chat_deltas = self._chat_deltas, {}
+        if not messages and not deltas:
+            return 0
+
+        session = Session()
+        try:
+            if messages:
+                session.bulk_insert_mappings(Message, messages)
+
+            # Статистика чатов и дневная сводка
+            user_deltas: Dict[int, Dict[str, float]] = {}
+            owners = {
+                chat_id: (user_id, model)
+                for chat_id, user_id, model in session.query(Chat.id, Chat.user_id, Chat.model)
+                .filter(Chat.id.in_(list(deltas))).all()
+            }
+            for chat_id, delta in deltas.items():
+                session.query(Chat).filter(Chat.id == chat_id).update({
+                    Chat.tokens_input: Chat.tokens_input + delta["tokens_input"],
+                    Chat.tokens_output: Chat.tokens_output + delta["tokens_output"],
+                    Chat.cost_usd: Chat.cost_usd + delta["cost_usd"],
+                    Chat.context_tokens: Chat.context_tokens + delta["context_tokens"],
+                    Chat.cached_tokens: Chat.cached_tokens + delta["cached_tokens"],
+                }, synchronize_session=False)
+
+                if chat_id not in owners:
+                    continue
+                user_id, model = owners[chat_id]
+                record_daily_usage(
+                    session, user_id, model,
+                    tokens_input=delta["tokens_input"],
+                    tokens_output=delta["tokens_output"],
+                    cost_usd=delta["cost_usd"],
+                    messages_count=delta["messages_count"],
+                    cache_hits=delta["cache_hits"],
+                    cache_saved_usd=delta["cache_saved_usd"]
+                )
+                user_delta = user_deltas.setdefault(user_id, dict.fromkeys(DELTA_FIELDS, 0))
+                for field in DELTA_FIELDS:
+                    user_delta[field] += delta[field]
+
+            # Статистика пользователей
+            for user_id, delta in user_deltas.items():
+                session.query(User).filter(User.id == user_id).update({
+                    User.total_tokens_input: User.total_tokens_input + delta["tokens_input"],
+                    User.total_tokens_output: User.total_tokens_output + delta["tokens_output"],
+                    User.total_cost_usd: User.total_cost_usd + delta["cost_usd"],
+                }, synchronize_session=False)
+
+            session.commit()
+        except Exception:
+            session.rollback()
+            # Возвращаем данные в буфер, чтобы записать их при следующем сбросе
+            with self._lock:
+                self._messages = messages + self._messages
+                for chat_id, delta in deltas.items():
+                    self._add_delta(chat_id, **delta)
+            raise
+        finally:
+            session.close()
+        return len(messages)
+
+    async def flush(self) -> int:
+        """Записать все накопленное в БД"""
+        return await _flush(self)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка при записи буфера в БД: {str(e)}")
+
+    def start(self):
+        """Запускает периодическую запись буфера"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает периодическую запись и сбрасывает все, что осталось"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        written = await self.flush()
+        logger.info(f"💾 Буфер записи сброшен при остановке, сообщений: {written}")
+
+
+@db_operation
+def _flush(buffer: WriteBehindBuffer) -> int:
+    return buffer.flush_sync()
+
+
+# Глобальный буфер отложенной записи
+write_buffer = WriteBehindBuffer()
@@ -1,22 +1,43 @@
 from aiogram import Router, F
 from aiogram.types import Message
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 
 from database.operations import get_admin_stats
+from services.queue_manager import queue_manager
+from services.resilience import resilience
+from services.openai_client import client_manager
 from config import ADMIN_IDS, USD_TO_RUB
+from datetime import date
 
 router = Router()
 
 
+def parse_period(args: str):
+    """Разбор периода из аргументов команды: /admin [с YYYY-MM-DD] [по YYYY-MM-DD]"""
+    parts = (args or "").split()
+    if len(parts) > 2:
+        raise ValueError("слишком много аргументов")
+    dates = [date.fromisoformat(part) for part in parts]
+    date_from = dates[0] if dates else None
+    date_to = dates[1] if len(dates) > 1 else None
+    return date_from, date_to
+
+
 @router.message(Command("admin"))
-async def admin_command(message: Message):
+async def admin_command(message: Message, command: CommandObject):
     """Обработка админской команды"""
     if message.from_user.id not in ADMIN_IDS:
         return
     
+    try:
+        date_from, date_to = parse_period(command.args)
+    except ValueError:
+        await message.answer("❌ Формат: /admin [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]")
+        return
+    
     # Получаем статистику
-    stats = get_admin_stats()
+    stats = await get_admin_stats(date_from, date_to)
     
     # Рассчитываем общую стоимость
     total_cost_usd = 0.0
@@ -49,9 +70,63 @@ async def admin_command(message: Message):
     
     # Добавляем общую статистику
     total_stats = f"📊 Общая статистика:\n\n"
+    if date_from or date_to:
+        total_stats += f"📅 Период: {date_from or '...'} — {date_to or '...'}\n"
     total_stats += f"💰 Общая стоимость всех запросов: {total_cost_rub:.2f}₽\n"
+    if stats["cache"]["hits"]:
+        cache_saved_rub = stats["cache"]["saved_usd"] * USD_TO_RUB
+        total_stats += f"♻️ Ответов из кэша: {stats['cache']['hits']} • сэкономлено {cache_saved_rub:.2f}₽\n"
     
     # Отправляем статистику
     await message.answer(total_stats)
     await message.answer(users_text)
-    await message.answer(models_text)
\ No newline at end of file
+    await message.answer(models_text)
+
+
+@router.message(Command("queue_stats"))
+async def queue_stats_command(message: Message):
+    """Статистика времени обработки запросов по моделям и текущей очереди"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    report = await queue_manager.get_latency_report()
+    
+    text = (
+        f"⏱️ Очередь:\n\n"
+        f"⏳ Ждут: {report['queued']}, в обработке: {report['active']}, обработчиков: {report['workers']}\n"
+        f"🕐 Дольше всех ждать: {report['max_wait']:.0f} сек.\n\n"
+    )
+    if not report["models"]:
+        text += "Обработанных запросов пока нет.\n\n"
+    for model_name, stats in report["models"].items():
+        text += (
+            f"Модель: {model_name}\n"
+            f"📈 Запросов: {stats['total']} (в окне {stats['samples']})\n"
+            f"⚡ До первого токена: p50 {stats['ttft_p50']:.1f} / p95 {stats['ttft_p95']:.1f} сек.\n"
+            f"🔤 Скорость: {stats['tokens_per_second']:.0f} токенов/сек.\n"
+            f"🏁 Обработка: p50 {stats['service_p50']:.1f} / p95 {stats['service_p95']:.1f} сек.\n"
+            f"🔮 Оценка на запрос: {stats['estimate']:.1f} сек.\n\n"
+        )
+    for model_name, limits in report["rate_limits"].items():
+        if not limits["admitted"]:
+            continue
+        text += (
+            f"🚦 Лимиты {model_name}: запросов {limits['requests_available']:.0f}/{limits['rpm']:.0f}, "
+            f"токенов {limits['tokens_available']:.0f}/{limits['tpm']:.0f} в минуту\n"
+            f"Отправлено {limits['admitted']}, ждали лимитов {limits['throttled']}, "
+            f"ответов 429: {limits['rate_limited']}\n"
+        )
+    pool = client_manager.get_pool_stats()
+    text += (
+        f"🔌 OpenAI: запросов в работе {pool['requests_in_flight']}, всего {pool['requests_total']}, "
+        f"новых соединений {pool['connections_opened']}\n"
+    )
+    breaker_states = {"closed": "✅ работает", "open": "⛔ отключена", "half_open": "🔍 проверяется"}
+    for model_name, stats in resilience.snapshot().items():
+        text += (
+            f"🛡 {model_name}: {breaker_states[stats['state']]}, сбоев {stats['failures']}, "
+            f"повторов {stats['retries']}, в резервную модель {stats['fallbacks']}, "
+            f"оборванных ответов {stats['partial']}, отключений {stats['opens']}\n"
+        )
+    
+    await message.answer(text)
@@ -3,19 +3,34 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.enums.parse_mode import ParseMode
+import asyncio
 import logging
 import time
+from typing import Dict
 
-from database.operations import get_or_create_user, create_chat, add_message, get_chat_messages, get_chat_stats, get_prompt_by_id
-from services.openai_service import send_message_to_openai
+from database.operations import get_or_create_user, create_chat, add_message, get_chat_messages, get_chat_stats, get_prompt_by_id, record_cache_hit
+from services.openai_service import send_message_to_openai, iterate_stream
 from services.token_counter import calculate_cost, format_stats
+from services.context_window import fit_history
+from services.stream_renderer import StreamRenderer
 from services.queue_manager import queue_manager
+from services.coalescer import message_coalescer, merge_texts
+from services.latency_stats import format_wait
+from services import response_cache
+from services.resilience import resilience
+from services.outbound import outbound, PRIORITY_ADMIN
 from keyboards.keyboards import chat_keyboard, models_keyboard, main_menu_keyboard
 from config import MAIN_ADMIN_ID
 from user_mapping import get_user_name
 
 router = Router()
 
+# Так смена промпта в начатом чате попадает в историю
+PROMPT_CHANGE_PREFIX = "Новая инструкция, она заменяет все предыдущие:\n"
+
+# Дописывается к показанному ответу, если стрим оборвался (в историю не сохраняется)
+PARTIAL_RESPONSE_NOTICE = "\n\n⚠️ Ответ прервался из-за сбоя OpenAI, показана полученная часть."
+
 
 class ChatStates(StatesGroup):
     waiting_for_message = State()
@@ -41,7 +56,7 @@ async def select_model(callback: CallbackQuery, state: FSMContext):
     system_instruction = None
     if selected_prompt_id:
         # Добавляем проверку на существование промпта
-        prompt = get_prompt_by_id(selected_prompt_id)
+        prompt = await get_prompt_by_id(selected_prompt_id)
         if prompt:
             print(f"Применяем промпт {prompt.name} при создании чата")
             system_instruction = prompt.content
@@ -62,13 +77,13 @@ async def select_model(callback: CallbackQuery, state: FSMContext):
     )
     
     # Получаем или создаем пользователя
-    user_id = get_or_create_user(
+    user_id = await get_or_create_user(
         callback.from_user.id, 
         callback.from_user.username
     )
     
     # Создаем новый чат
-    chat_id = create_chat(user_id, model)
+    chat_id = await create_chat(user_id, model)
     
     # Сохраняем ID чата в состоянии
     await state.update_data(chat_id=chat_id)
@@ -76,7 +91,7 @@ async def select_model(callback: CallbackQuery, state: FSMContext):
     # Сообщение о начале чата
     message_text = f"Чат с моделью {model} начат!"
     if selected_prompt_id:
-        prompt = get_prompt_by_id(selected_prompt_id)
+        prompt = await get_prompt_by_id(selected_prompt_id)
         message_text += f"\n\n🔮 Промпт \"{prompt.name}\" применён к чату."
     message_text += f"\n\n🔢 Лимит выходных токенов: {max_tokens}"
     message_text += "\n\nОтправь сообщение, и я передам его модели."
@@ -94,14 +109,25 @@ async def select_model(callback: CallbackQuery, state: FSMContext):
 @router.message(ChatStates.waiting_for_message)
 async def process_message(message: Message, state: FSMContext):
     """Обработка сообщения в чате"""
-    # Проверяем, не находится ли пользователь уже в очереди
-    if queue_manager.is_user_in_queue(message.from_user.id):
+    # Пользователь еще дописывает реплику - добавляем сообщение к ней
+    if message_coalescer.join(message):
+        return
+
+    # Предыдущая реплика еще ждет в очереди - дописываем сообщение к ней
+    position = queue_manager.append_to_queued(message.from_user.id, message.text)
+    if position is not None:
         await message.answer(
-            "⏳ Ваш предыдущий запрос еще в очереди. Пожалуйста, дождитесь его обработки.",
+            f"➕ Сообщение добавлено к вашему запросу в очереди. Позиция: {position}",
             reply_markup=chat_keyboard()
         )
         return
 
+    # Ждем, не отправит ли пользователь еще сообщения, чтобы ответить на все сразу.
+    # Реплика открывается до первого await, поэтому следующие сообщения точно попадут в нее
+    messages = await message_coalescer.collect(message)
+    if len(messages) > 1:
+        logging.info(f"Склеено сообщений пользователя {message.from_user.id}: {len(messages)}")
+
     # Получаем данные из состояния
     data = await state.get_data()
     model = data.get("model")
@@ -116,19 +142,8 @@ async def process_message(message: Message, state: FSMContext):
         )
         return
 
-    # Добавляем запрос в очередь
-    position = await queue_manager.add_to_queue(message)
-
-    # Отправляем уведомление о постановке в очередь
-    if position > 1:
-        await message.answer(
-            f"⏳ Ваш запрос поставлен в очередь. Позиция: {position}\n"
-            f"Вы получите уведомление, когда начнется обработка вашего запроса.",
-            reply_markup=chat_keyboard()
-        )
-
-    # Обрабатываем очередь
-    async for request in queue_manager.process_queue():
+    async def handle_request(request: Dict):
+        """Обработка запроса, взятого из очереди"""
         # Получаем данные из состояния для текущего запроса
         current_data = await state.get_data()
         current_model = current_data.get("model")
@@ -137,143 +152,163 @@ async def process_message(message: Message, state: FSMContext):
 
         # Добавляем сообщение пользователя в БД
         from services.token_counter import get_token_count
-        user_tokens = get_token_count(request['message'].text, current_model)
+        user_tokens = get_token_count(request['text'], current_model)
         user_cost = user_tokens * (current_data.get("model_rate_input", 0) / 1_000_000)
-        add_message(current_chat_id, "user", request['message'].text, int(user_tokens), user_cost)
-
-        # Получаем историю чата
-        chat_messages = get_chat_messages(current_chat_id)
+        await add_message(current_chat_id, "user", request['text'], int(user_tokens), user_cost)
+
+        # Получаем историю чата и уже посчитанный размер истории
+        chat_messages = await get_chat_messages(current_chat_id)
+        history_tokens = (await get_chat_stats(current_chat_id))["context_tokens"]
+
+        # Подгоняем историю под бюджет токенов модели
+        context = await fit_history(
+            current_chat_id,
+            chat_messages,
+            current_model,
+            system_instruction=current_system_instruction,
+            max_tokens=current_data.get("max_tokens", None),
+            history_tokens=history_tokens
+        )
 
-        # Отправляем уведомление главному админу
+        # Уведомляем главного админа в фоне, запрос к модели его не ждет
         if request['user_id'] != MAIN_ADMIN_ID:
             user_name = get_user_name(request['user_id']) or f"ID: {request['user_id']}"
             admin_notification = (
                 f"🆕 Новый запрос от пользователя:\n"
                 f"👤 {user_name}\n"
-                f"📝 Текст: {request['message'].text}\n"
+                f"📝 Текст: {request['text']}\n"
                 f"🤖 Модель: {current_model}"
             )
-            await request['bot'].send_message(MAIN_ADMIN_ID, admin_notification)
+            outbound.send(request['bot'], MAIN_ADMIN_ID, admin_notification, priority=PRIORITY_ADMIN)
 
         try:
+            # Такой же вопрос с тем же промптом уже задавали - отвечаем из кэша
+            cache_key = response_cache.make_cache_key(
+                current_model,
+                context["messages"],
+                system_instruction=current_system_instruction,
+                max_tokens=current_data.get("max_tokens", None)
+            )
+            cached = await response_cache.lookup(cache_key)
+            if cached:
+                await answer_from_cache(request['message'], current_chat_id, current_model, cached,
+                                        user_tokens, context["saved_tokens"])
+                return
+
             # Отправляем запрос в OpenAI
+            request_start = time.monotonic()
             response = await send_message_to_openai(
                 model=current_model,
-                input_text=request['message'].text,
-                messages=chat_messages,
+                input_text=request['text'],
+                messages=context["messages"],
                 system_instruction=current_system_instruction,
                 max_tokens=current_data.get("max_tokens", None),
-                stream=True  # Включаем стриминг
+                stream=True,  # Включаем стриминг
+                history_tokens=context["history_tokens"],
+                reservation=request.get('reservation')
             )
 
             if response["success"]:
-                # Обновляем данные о токенах
+                # Если основная модель недоступна, ответ дает резервная (и лимиты взяты под нее)
+                answer_model = response["model"]
+                request['reservation'] = response["reservation"]
+                # Создаем сообщение для редактирования
+                bot_message = await request['message'].answer("⌛ Генерирую ответ...")
+                usage = {}
+                first_token_at = None
+                stream_error = None
+
+                # Обрабатываем стрим: правки сообщения идут с учетом лимитов Telegram
+                async with StreamRenderer(bot_message) as renderer:
+                    try:
+                        async for content in iterate_stream(response["stream"], usage):
+                            if first_token_at is None:
+                                first_token_at = time.monotonic()
+                            renderer.feed(content)
+                    except Exception as e:
+                        # Стрим оборвался: если что-то уже пришло, оставляем и сохраняем эту часть
+                        resilience.record_partial(answer_model, e)
+                        if not renderer.text.strip():
+                            raise
+                        stream_error = e
+                    stream_end = time.monotonic()
+                    full_response = renderer.text
+                    if stream_error is not None:
+                        renderer.feed(PARTIAL_RESPONSE_NOTICE)
+                    rendered = await renderer.finish()
+
+                # Реальный расход из последнего чанка; если его нет - считаем токенизатором
+                input_tokens = usage.get("prompt_tokens", response["input_tokens"])
+                cached_tokens = usage.get("cached_tokens", 0)
+                output_tokens = usage.get("completion_tokens")
+                if output_tokens is None:
+                    output_tokens = get_token_count(full_response, answer_model)
+
+                # Возвращаем в лимиты OpenAI то, что зарезервировали сверх реального расхода
+                if request.get('reservation') is not None:
+                    request['reservation'].settle(input_tokens + output_tokens, input_tokens)
+
+                # Замеры для оценки времени ожидания в очереди
+                if first_token_at is not None:
+                    request['latency'] = {
+                        "ttft": first_token_at - request_start,
+                        "output_tokens": output_tokens,
+                        "generation_time": stream_end - first_token_at,
+                    }
+
+                # Обновляем данные о токенах запроса
                 from database.operations import update_message_tokens
-                update_message_tokens(
+                await update_message_tokens(
                     chat_id=current_chat_id,
                     is_user_message=True,
-                    new_tokens=response["input_tokens"],
+                    new_tokens=input_tokens,
                     old_tokens=user_tokens,
-                    model=current_model
+                    model=answer_model,
+                    cached_tokens=cached_tokens
                 )
 
-                # Создаем сообщение для редактирования
-                bot_message = await request['message'].answer("⌛ Генерирую ответ...")
-                full_response = ""
-                output_tokens = 0
-                last_update_length = 0
-                use_file = False  # Флаг для переключения на отправку файлом
-                last_update_time = 0  # Время последнего обновления
-                update_interval = 1.0  # Уменьшаем интервал обновления
-                min_length_for_streaming = 50  # Минимальная длина для начала стриминга
-                initial_streaming_delay = 0.5  # Задержка перед первым обновлением для коротких ответов
-
-                # Обрабатываем стрим
-                async for chunk in response["stream"]:
-                    if chunk.choices[0].delta.content is not None:
-                        content = chunk.choices[0].delta.content
-                        full_response += content
-                        output_tokens += 1  # Примерная оценка токенов
-
-                        current_time = time.time()
-                        
-                        # Для коротких ответов используем меньшую задержку
-                        if len(full_response) < min_length_for_streaming:
-                            if current_time - last_update_time >= initial_streaming_delay:
-                                try:
-                                    # Проверяем, что текст не пустой
-                                    if full_response.strip():
-                                        await bot_message.edit_text(full_response)
-                                        last_update_time = current_time
-                                    else:
-                                        # Если текст пустой, просто пропускаем обновление
-                                        continue
-                                except Exception as e:
-                                    logging.warning(f"Ошибка при обновлении короткого сообщения: {str(e)}")
-                            continue
-
-                        # Если сообщение стало слишком длинным, переключаемся на файл
-                        if len(full_response) > 4000:  # Увеличиваем порог для переключения на файл
-                            use_file = True
-                            await bot_message.edit_text("📄 Ответ слишком длинный, отправляю файлом...")
-                            continue
-
-                        # Если используем файл, пропускаем обновления
-                        if use_file:
-                            continue
-
-                        # Отправляем обновление только если прошло достаточно времени
-                        if current_time - last_update_time >= update_interval:
-                            try:
-                                await bot_message.edit_text(full_response)
-                                last_update_length = len(full_response)
-                                last_update_time = current_time
-                            except Exception as e:
-                                if "Flood control" in str(e):
-                                    # При ошибке flood control увеличиваем интервал
-                                    update_interval = min(update_interval * 1.5, 5.0)
-                                    logging.warning(f"Flood control detected, increasing interval to {update_interval}")
-                                else:
-                                    # При других ошибках переключаемся на файл
-                                    use_file = True
-                                    await bot_message.edit_text("📄 Ответ слишком длинный, отправляю файлом...")
-                                    logging.warning(f"Ошибка при обновлении сообщения: {str(e)}")
-
-                # Если использовали файл, отправляем его
-                if use_file:
-                    await send_chunked_message(request['message'], full_response, reply_markup=chat_keyboard())
-                else:
-                    # Обновляем финальный текст, если он не пустой
-                    if full_response.strip():
-                        try:
-                            await bot_message.edit_text(full_response)
-                        except Exception as e:
-                            logging.error(f"Не удалось обновить финальное сообщение: {str(e)}")
-                            # Если не удалось отредактировать, отправляем новое сообщение
-                            await request['message'].answer(full_response)
+                # Если ответ не поместился в сообщение, отправляем его файлом
+                if renderer.use_file:
+                    await send_chunked_message(request['message'], renderer.text, reply_markup=chat_keyboard())
+                elif not rendered and renderer.text.strip():
+                    logging.error("Не удалось обновить финальное сообщение")
+                    # Если не удалось отредактировать, отправляем новое сообщение
+                    await request['message'].answer(renderer.text)
 
                 # Добавляем ответ ассистента в БД
-                output_cost = calculate_cost(output_tokens, current_model, is_input=False)
-                add_message(
+                output_cost = calculate_cost(output_tokens, answer_model, is_input=False)
+                await add_message(
                     current_chat_id,
                     "assistant",
                     full_response,
                     output_tokens,
                     output_cost
                 )
+                # Оборванный ответ и ответ резервной модели в кэш не кладем
+                if stream_error is None and answer_model == current_model:
+                    await response_cache.store(
+                        cache_key, current_model, full_response, input_tokens, output_tokens,
+                        calculate_cost(input_tokens, current_model, cached_tokens=cached_tokens) + output_cost
+                    )
 
                 # Получаем статистику чата
-                chat_stats = get_chat_stats(current_chat_id)
+                chat_stats = await get_chat_stats(current_chat_id)
 
                 # Форматируем статистику
                 stats_text = format_stats(
-                    response["input_tokens"],
+                    input_tokens,
                     output_tokens,
-                    current_model,
+                    answer_model,
                     chat_stats["tokens_input"],
-                    chat_stats["tokens_output"]
+                    chat_stats["tokens_output"],
+                    saved_tokens=context["saved_tokens"],
+                    cached_tokens=cached_tokens,
+                    total_cost_usd=chat_stats["cost_usd"]
                 )
 
+                if answer_model != current_model:
+                    stats_text = f"\n🔀 Модель {current_model} временно недоступна, ответила {answer_model}" + stats_text
+
                 # Отправляем статистику
                 await request['message'].answer(
                     f"📊 Статистика:{stats_text}",
@@ -295,6 +330,35 @@ async def process_message(message: Message, state: FSMContext):
             # Логируем ошибку
             logging.error(f"Error processing message: {str(e)}")
 
+    # Добавляем запрос в очередь
+    position, done = await queue_manager.submit(
+        message, model, handle_request, text=merge_texts([msg.text for msg in messages]),
+        max_tokens=data.get("max_tokens", None)
+    )
+
+    # Отправляем уведомление о постановке в очередь
+    if position > 0:
+        wait = await queue_manager.estimate_wait(message.from_user.id)
+        wait_text = f"Примерное время ожидания: {format_wait(wait)}\n" if wait is not None else ""
+        outbound.send(
+            message.bot,
+            message.chat.id,
+            f"⏳ Ваш запрос поставлен в очередь. Позиция: {position}\n"
+            f"{wait_text}"
+            f"Вы получите уведомление, когда начнется обработка вашего запроса.",
+            coalesce_key="queue_position",
+            reply_markup=chat_keyboard()
+        )
+
+    # Ждем, пока обработчик очереди выполнит запрос
+    try:
+        await done
+    except asyncio.CancelledError:
+        # Запрос убрали из очереди - это не отмена самого хендлера
+        if not done.cancelled():
+            raise
+        logging.info(f"Запрос пользователя {message.from_user.id} удален из очереди")
+
 
 @router.callback_query(F.data.startswith("use_prompt:"))
 async def use_prompt_in_chat(callback: CallbackQuery, state: FSMContext):
@@ -307,7 +371,7 @@ async def use_prompt_in_chat(callback: CallbackQuery, state: FSMContext):
 
     # Получаем промпт из БД
     from database.operations import get_prompt_by_id
-    prompt = get_prompt_by_id(prompt_id)
+    prompt = await get_prompt_by_id(prompt_id)
 
     # Проверяем, находимся ли мы в чате
     if current_state is None or current_state != "ChatStates:waiting_for_message":
@@ -318,7 +382,7 @@ async def use_prompt_in_chat(callback: CallbackQuery, state: FSMContext):
     
     if prompt:
         print(f"Применяем промпт {prompt.name} к чату")
-        await state.update_data(system_instruction=prompt.content)
+        await apply_prompt_to_chat(state, prompt.content)
         await callback.message.edit_text(
             f"🔮 Промпт \"{prompt.name}\" успешно применен к текущему чату!\n"
             f"Теперь все сообщения будут обрабатываться согласно этому промпту.",
@@ -333,6 +397,67 @@ async def use_prompt_in_chat(callback: CallbackQuery, state: FSMContext):
     
     await callback.answer()
 
+
+async def apply_prompt_to_chat(state: FSMContext, prompt_text: str):
+    """
+    Применяет промпт к чату. Пока в чате нет сообщений, промпт становится системной инструкцией.
+    В начатом чате инструкция не меняется (иначе у всех следующих запросов поменяется начало
+    и OpenAI перестанет брать его из кэша) - новый промпт добавляется в историю системным сообщением.
+    """
+    data = await state.get_data()
+    chat_id = data.get("chat_id")
+    if not chat_id or not (await get_chat_stats(chat_id))["context_tokens"]:
+        await state.update_data(system_instruction=prompt_text)
+        return
+
+    from services.token_counter import get_token_count
+    content = PROMPT_CHANGE_PREFIX + prompt_text
+    await add_message(chat_id, "system", content, 0, 0.0, context_tokens=get_token_count(content, data.get("model")))
+
+
+async def answer_from_cache(message: Message, chat_id: int, model: str, cached: Dict,
+                            user_tokens: int, saved_tokens: int):
+    """Показывает ответ из кэша так же, как стримящийся ответ модели"""
+    from database.operations import update_message_tokens
+
+    bot_message = await message.answer("⌛ Генерирую ответ...")
+    async with StreamRenderer(bot_message) as renderer:
+        renderer.feed(cached["content"])
+        rendered = await renderer.finish()
+
+    if renderer.use_file:
+        await send_chunked_message(message, cached["content"], reply_markup=chat_keyboard())
+    elif not rendered:
+        await message.answer(cached["content"])
+
+    # Вопрос в OpenAI не отправлялся - платить за него не нужно, но в истории он остается
+    await update_message_tokens(
+        chat_id=chat_id,
+        is_user_message=True,
+        new_tokens=0,
+        old_tokens=user_tokens,
+        model=model
+    )
+    await add_message(chat_id, "assistant", cached["content"], 0, 0.0, context_tokens=cached["output_tokens"])
+    record_cache_hit(chat_id, cached["cost_usd"])
+
+    chat_stats = await get_chat_stats(chat_id)
+    stats_text = format_stats(
+        0,
+        0,
+        model,
+        chat_stats["tokens_input"],
+        chat_stats["tokens_output"],
+        saved_tokens=saved_tokens,
+        total_cost_usd=chat_stats["cost_usd"],
+        cache_saved_input=cached["input_tokens"],
+        cache_saved_output=cached["output_tokens"]
+    )
+    await message.answer(
+        f"📊 Статистика:{stats_text}",
+        reply_markup=chat_keyboard()
+    )
+
 async def send_chunked_message(message: Message, text: str, reply_markup=None, parse_mode=None):
     """Отправляет длинный текст частями, если он превышает лимит Telegram"""
     MAX_LENGTH = 4096  # Максимальная длина сообщения в Telegram
@@ -443,7 +568,7 @@ async def process_prompt_file(message: Message, state: FSMContext):
         prompt_text = file_content.read().decode('utf-8')
         
         # Сохраняем промпт в состоянии
-        await state.update_data(system_instruction=prompt_text)
+        await apply_prompt_to_chat(state, prompt_text)
         
         # Получаем данные о модели
         data = await state.get_data()
@@ -5,7 +5,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
 from database.operations import get_or_create_user, get_user_prompts, save_prompt, delete_prompt
-from handlers.chat import ChatStates
+from handlers.chat import ChatStates, apply_prompt_to_chat
 from keyboards.keyboards import chat_keyboard, models_keyboard, prompts_keyboard, prompt_actions_keyboard, main_menu_keyboard
 
 router = Router()
@@ -20,12 +20,12 @@ class PromptStates(StatesGroup):
 @router.callback_query(F.data == "prompts")
 async def show_prompts(callback: CallbackQuery, state: FSMContext):
     """Показать список промптов пользователя"""
-    user_id = get_or_create_user(
+    user_id = await get_or_create_user(
         callback.from_user.id, 
         callback.from_user.username
     )
     
-    prompts = get_user_prompts(user_id)
+    prompts = await get_user_prompts(user_id)
     
     if not prompts:
         await callback.message.edit_text(
@@ -74,10 +74,10 @@ async def process_prompt_content(message: Message, state: FSMContext):
     data = await state.get_data()
     prompt_name = data.get("prompt_name")
     
-    user_id = get_or_create_user(message.from_user.id, message.from_user.username)
+    user_id = await get_or_create_user(message.from_user.id, message.from_user.username)
     
     # Сохраняем промпт
-    prompt = save_prompt(user_id, prompt_name, message.text)
+    prompt = await save_prompt(user_id, prompt_name, message.text)
     
     await message.answer(
         f"✅ Промпт \"{prompt_name}\" успешно сохранен!\n\n"
@@ -97,7 +97,7 @@ async def show_prompt_actions(callback: CallbackQuery, state: FSMContext):
     
     # Получаем промпт из БД
     from database.operations import get_prompt_by_id
-    prompt = get_prompt_by_id(prompt_id)
+    prompt = await get_prompt_by_id(prompt_id)
     
     if not prompt:
         await callback.message.edit_text(
@@ -125,7 +125,7 @@ async def delete_prompt_action(callback: CallbackQuery, state: FSMContext):
     prompt_id = int(callback.data.split(":")[1])
     
     # Удаляем промпт
-    success = delete_prompt(prompt_id)
+    success = await delete_prompt(prompt_id)
     
     if success:
         await callback.message.edit_text(
@@ -152,7 +152,7 @@ async def redirect_use_prompt(callback: CallbackQuery, state: FSMContext):
     
     # Проверяем промпт перед сохранением
     from database.operations import get_prompt_by_id
-    prompt = get_prompt_by_id(prompt_id)
+    prompt = await get_prompt_by_id(prompt_id)
     if not prompt:
         await callback.message.edit_text(
             "❌ Ошибка: Промпт не найден. Попробуйте выбрать другой.",
@@ -176,7 +176,7 @@ async def redirect_use_prompt(callback: CallbackQuery, state: FSMContext):
         
         if chat_id:
             # Устанавливаем системную инструкцию
-            await state.update_data(system_instruction=prompt.content)
+            await apply_prompt_to_chat(state, prompt.content)
             await callback.message.edit_text(
                 f"🔮 Промпт \"{prompt.name}\" успешно применен к текущему чату!\n"
                 f"Теперь все сообщения будут обрабатываться согласно этому промпту.",
@@ -0,0 +1,60 @@
+import asyncio
+from typing import Dict, List
+
+from aiogram.types import Message
+
+from config import COALESCE_WINDOW, COALESCE_MAX_DELAY
+
+
+class MessageCoalescer:
+    """
+    Склейка сообщений, которые пользователь отправляет одно за другим.
+    Первое сообщение открывает реплику, и она ждет COALESCE_WINDOW секунд тишины
+    (но не дольше COALESCE_MAX_DELAY), а сообщения, пришедшие за это время,
+    добавляются к ней. В очередь реплика уходит одним запросом к модели.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW, max_delay: float = COALESCE_MAX_DELAY):
+        self.window = window
+        self.max_delay = max_delay
+        self.pending: Dict[int, Dict] = {}  # Собираемые реплики по user_id
+
+    def join(self, message: Message) -> bool:
+        """Добавляет сообщение к собираемой реплике пользователя. False - реплика не собирается"""
+        batch = self.pending.get(message.from_user.id)
+        if batch is None:
+            return False
+        batch['messages'].append(message)
+        batch['event'].set()
+        return True
+
+    async def collect(self, message: Message) -> List[Message]:
+        """Открывает реплику с этого сообщения и ждет, пока пользователь допишет"""
+        user_id = message.from_user.id
+        batch = {'messages': [message], 'event': asyncio.Event()}
+        self.pending[user_id] = batch
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        try:
+            while True:
+                timeout = min(self.window, deadline - loop.time())
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(batch['event'].wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch['event'].clear()
+        finally:
+            self.pending.pop(user_id, None)
+        return batch['messages']
+
+
+def merge_texts(texts: List[str]) -> str:
+    """Текст одной реплики из нескольких сообщений"""
+    return "\n\n".join(text for text in texts if text)
+
+
+# Глобальный склейщик сообщений
+message_coalescer = MessageCoalescer()
@@ -0,0 +1,168 @@
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import (
+    CONTEXT_TOKEN_BUDGET, DEFAULT_CONTEXT_TOKEN_BUDGET, MODEL_CONTEXT_WINDOW, DEFAULT_MAX_TOKENS,
+    CONTEXT_TRIM_STEP, CONTEXT_SUMMARY_ENABLED, CONTEXT_SUMMARY_MODEL, CONTEXT_SUMMARY_MAX_TOKENS
+)
+from .token_counter import get_token_count, calculate_cost
+from .rate_limiter import rate_limiter
+
+logger = logging.getLogger('telegram_bot')
+
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+SUMMARY_INSTRUCTION = (
+    "Кратко перескажи диалог ниже, сохранив факты, договоренности и важные детали, "
+    "которые понадобятся для продолжения разговора. Пиши на языке диалога."
+)
+
+# Последнее краткое содержание по чатам: chat_id -> (сколько сообщений покрыто, текст)
+_summaries: "OrderedDict[int, Tuple[int, str]]" = OrderedDict()
+_SUMMARIES_LIMIT = 1000
+
+
+def get_history_budget(model: str, system_instruction: Optional[str] = None,
+                       max_tokens: Optional[int] = None) -> int:
+    """Сколько токенов истории можно отправить модели"""
+    if max_tokens is None:
+        max_tokens = DEFAULT_MAX_TOKENS
+    budget = CONTEXT_TOKEN_BUDGET.get(model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+    # Бюджет не может превышать то, что реально помещается в окно модели
+    window = MODEL_CONTEXT_WINDOW.get(model)
+    if window is not None:
+        system_tokens = get_token_count(system_instruction, model) if system_instruction else 0
+        budget = min(budget, window - max_tokens - system_tokens)
+    return max(0, budget)
+
+
+def _find_cut(messages: List[Dict[str, Any]], budget: int) -> int:
+    """
+    Индекс первого сообщения, которое остается в истории.
+    Закрепленные (системные) сообщения и последнее сообщение остаются всегда.
+    """
+    used = sum(msg["tokens"] for msg in messages if msg["role"] == "system")
+    used += messages[-1]["tokens"] if messages[-1]["role"] != "system" else 0
+
+    cut = len(messages) - 1
+    for i in range(len(messages) - 2, -1, -1):
+        if messages[i]["role"] == "system":
+            continue
+        if used + messages[i]["tokens"] > budget:
+            break
+        used += messages[i]["tokens"]
+        cut = i
+
+    # Двигаем границу блоками, чтобы она не менялась на каждом ходу
+    if cut > 0 and CONTEXT_TRIM_STEP > 1:
+        cut = min(-(-cut // CONTEXT_TRIM_STEP) * CONTEXT_TRIM_STEP, len(messages) - 1)
+    return cut
+
+
+async def _summarize(chat_id: int, messages: List[Dict[str, Any]], cut: int) -> Optional[str]:
+    """
+    Краткое содержание сообщений до cut (инкрементально от предыдущего).
+    Запрос идет в пределах лимитов модели сжатия, а его стоимость записывается в расходы чата
+    """
+    from database.operations import record_service_usage
+    from .openai_service import send_message_to_openai
+
+    covered, summary = _summaries.get(chat_id, (0, ""))
+    if covered == cut and summary:
+        _summaries.move_to_end(chat_id)
+        return summary
+    if covered > cut:
+        covered, summary = 0, ""
+
+    parts = []
+    if summary:
+        parts.append(SUMMARY_PREFIX + summary)
+    for msg in messages[covered:cut]:
+        if msg["role"] != "system":
+            parts.append(f"{msg['role']}: {msg['content']}")
+
+    reservation = await rate_limiter.reserve(CONTEXT_SUMMARY_MODEL, CONTEXT_SUMMARY_MAX_TOKENS)
+    try:
+        response = await send_message_to_openai(
+            model=CONTEXT_SUMMARY_MODEL,
+            input_text="\n\n".join(parts),
+            system_instruction=SUMMARY_INSTRUCTION,
+            max_tokens=CONTEXT_SUMMARY_MAX_TOKENS,
+            reservation=reservation
+        )
+    finally:
+        if reservation is not None:
+            reservation.release()
+    if not response["success"]:
+        logger.warning(f"⚠️ Не удалось сжать историю чата {chat_id}: {response['error']}")
+        return None
+
+    input_cost = calculate_cost(response["input_tokens"], response["model"],
+                                cached_tokens=response["cached_tokens"])
+    record_service_usage(chat_id, response["input_tokens"], response["output_tokens"],
+                         input_cost + response["output_cost"], response["cached_tokens"])
+
+    _summaries[chat_id] = (cut, response["output_text"])
+    _summaries.move_to_end(chat_id)
+    while len(_summaries) > _SUMMARIES_LIMIT:
+        _summaries.popitem(last=False)
+    return response["output_text"]
+
+
+async def fit_history(chat_id: int, messages: List[Dict[str, Any]], model: str,
+                      system_instruction: Optional[str] = None, max_tokens: Optional[int] = None,
+                      history_tokens: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Подогнать историю чата под бюджет токенов модели.
+    Оставляет самые свежие сообщения и закрепленные системные, отброшенное начало
+    по желанию заменяет кратким содержанием.
+    Возвращает messages, history_tokens (размер итоговой истории), saved_tokens и dropped.
+    """
+    if history_tokens is None:
+        history_tokens = sum(msg["tokens"] for msg in messages)
+
+    budget = get_history_budget(model, system_instruction, max_tokens)
+    result = {
+        "messages": messages,
+        "history_tokens": history_tokens,
+        "saved_tokens": 0,
+        "dropped": 0,
+    }
+
+    # Быстрый путь: вся история помещается, ничего не перебираем
+    if not messages or history_tokens <= budget:
+        return result
+
+    if CONTEXT_SUMMARY_ENABLED:
+        budget = max(0, budget - CONTEXT_SUMMARY_MAX_TOKENS)
+
+    cut = _find_cut(messages, budget)
+    pinned = [msg for msg in messages[:cut] if msg["role"] == "system"]
+    dropped = [msg for msg in messages[:cut] if msg["role"] != "system"]
+
+    summary_messages = []
+    if CONTEXT_SUMMARY_ENABLED and dropped:
+        summary = await _summarize(chat_id, messages, cut)
+        if summary:
+            summary_messages.append({
+                "role": "system",
+                "content": SUMMARY_PREFIX + summary,
+                "tokens": get_token_count(SUMMARY_PREFIX + summary, model)
+            })
+
+    # Закрепленные сообщения не двигаются, краткое содержание идет после них,
+    # чтобы начало запроса оставалось прежним для кэша префиксов OpenAI
+    fitted = pinned + summary_messages + messages[cut:]
+    fitted_tokens = sum(msg["tokens"] for msg in fitted)
+    result.update(
+        messages=fitted,
+        history_tokens=fitted_tokens,
+        saved_tokens=max(0, history_tokens - fitted_tokens),
+        dropped=len(dropped)
+    )
+    logger.info(
+        f"✂️ История чата {chat_id} обрезана: отброшено {len(dropped)} сообщений, "
+        f"сэкономлено {result['saved_tokens']} токенов"
+    )
+    return result
@@ -0,0 +1,124 @@
+import asyncio
+import copy
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import FSM_STORAGE, REDIS_URL, FSM_CACHE_SIZE
+from database.operations import get_fsm_record, save_fsm_state, save_fsm_data
+
+logger = logging.getLogger('telegram_bot')
+
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM в таблице fsm_states основной БД"""
+
+    def __init__(self, key_builder: Optional[KeyBuilder] = None):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await save_fsm_state(self.key_builder.build(key), _state_name(state))
+
+    async def get_record(self, key: StorageKey) -> Dict[str, Any]:
+        """Состояние и данные одним запросом"""
+        return await get_fsm_record(self.key_builder.build(key))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self.get_record(key))["state"]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await save_fsm_data(self.key_builder.build(key), dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self.get_record(key))["data"]
+
+    async def close(self) -> None:
+        pass
+
+
+class CachedStorage(BaseStorage):
+    """
+    Кэш в памяти поверх постоянного хранилища: чтения обслуживаются из памяти,
+    записи сразу уходят в хранилище.
+    Рассчитан на то, что пользователя обслуживает один процесс (один экземпляр бота
+    или шардированный запуск supervisor.py), иначе кэш другого процесса устареет.
+    """
+
+    def __init__(self, storage: BaseStorage, max_size: int = FSM_CACHE_SIZE):
+        self.storage = storage
+        self.max_size = max_size
+        self._cache: "OrderedDict[StorageKey, Dict[str, Any]]" = OrderedDict()
+        self._loading: Dict[StorageKey, asyncio.Task] = {}  # Ключи, которые сейчас читаются из хранилища
+
+    async def _read(self, key: StorageKey) -> Dict[str, Any]:
+        if isinstance(self.storage, SQLiteStorage):
+            return await self.storage.get_record(key)
+        return {
+            "state": await self.storage.get_state(key),
+            "data": await self.storage.get_data(key)
+        }
+
+    async def _load(self, key: StorageKey) -> Dict[str, Any]:
+        try:
+            entry = await self._read(key)
+            self._cache[key] = entry
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+            return entry
+        finally:
+            self._loading.pop(key, None)
+
+    async def _entry(self, key: StorageKey) -> Dict[str, Any]:
+        entry = self._cache.get(key)
+        if entry is None:
+            # Промах: ключ читается из хранилища один раз, остальные обращения ждут этого чтения,
+            # иначе запись, сделанная между двумя чтениями, потеряется
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = self._loading[key] = asyncio.ensure_future(self._load(key))
+            entry = await asyncio.shield(loading)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        return entry
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(key)
+        entry["state"] = _state_name(state)
+        await self.storage.set_state(key, state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(key))["state"]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        entry = await self._entry(key)
+        entry["data"] = copy.copy(dict(data))
+        await self.storage.set_data(key, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._entry(key))["data"].copy()
+
+    async def close(self) -> None:
+        self._cache.clear()
+        await self.storage.close()
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Создает хранилище FSM по настройке FSM_STORAGE"""
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "redis":
+        # Пакет redis нужен только для этого режима
+        from aiogram.fsm.storage.redis import RedisStorage
+        storage = RedisStorage.from_url(REDIS_URL, key_builder=DefaultKeyBuilder(with_destiny=True))
+    else:
+        storage = SQLiteStorage()
+    logger.info(f"🗄️ Хранилище FSM: {FSM_STORAGE}")
+    return CachedStorage(storage)
@@ -0,0 +1,102 @@
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from config import LATENCY_WINDOW, QUEUE_DEFAULT_SERVICE_TIME, DEFAULT_MAX_TOKENS
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0..1) по отсортированной копии значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class ModelLatency:
+    """Скользящее окно последних LATENCY_WINDOW обработанных запросов к одной модели"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.samples: Deque[Dict[str, float]] = deque(maxlen=window)
+        self.total = 0  # Сколько запросов учтено за все время
+
+    def record(self, service_time: float, ttft: Optional[float] = None, output_tokens: int = 0,
+               generation_time: float = 0.0):
+        self.samples.append({
+            "service_time": service_time,
+            "ttft": ttft if ttft is not None else service_time,
+            "output_tokens": output_tokens,
+            "generation_time": generation_time,
+        })
+        self.total += 1
+
+    def tokens_per_second(self) -> float:
+        """Скорость генерации: все токены окна на все время генерации"""
+        tokens = sum(sample["output_tokens"] for sample in self.samples if sample["generation_time"] > 0)
+        seconds = sum(sample["generation_time"] for sample in self.samples if sample["generation_time"] > 0)
+        return tokens / seconds if seconds > 0 else 0.0
+
+    def estimate(self, max_tokens: Optional[int] = None) -> float:
+        """
+        Ожидаемое время обработки запроса: время до первого токена, генерация
+        ожидаемого числа токенов (не больше max_tokens) и все остальное (БД, Telegram)
+        """
+        if not self.samples:
+            return QUEUE_DEFAULT_SERVICE_TIME
+        count = len(self.samples)
+        ttft = sum(sample["ttft"] for sample in self.samples) / count
+        output_tokens = sum(sample["output_tokens"] for sample in self.samples) / count
+        overhead = sum(
+            max(0.0, sample["service_time"] - sample["ttft"] - sample["generation_time"])
+            for sample in self.samples
+        ) / count
+
+        tps = self.tokens_per_second()
+        if tps <= 0:
+            # Стрима не было - опираемся только на общее время обработки
+            return sum(sample["service_time"] for sample in self.samples) / count
+        expected_tokens = min(output_tokens, max_tokens or DEFAULT_MAX_TOKENS)
+        return ttft + expected_tokens / tps + overhead
+
+    def snapshot(self) -> Dict[str, Any]:
+        ttft = [sample["ttft"] for sample in self.samples]
+        service = [sample["service_time"] for sample in self.samples]
+        return {
+            "samples": len(self.samples),
+            "total": self.total,
+            "ttft_p50": percentile(ttft, 0.5),
+            "ttft_p95": percentile(ttft, 0.95),
+            "service_p50": percentile(service, 0.5),
+            "service_p95": percentile(service, 0.95),
+            "tokens_per_second": self.tokens_per_second(),
+            "estimate": self.estimate(),
+        }
+
+
+class LatencyStats:
+    """Статистика времени обработки по моделям"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self.models: Dict[str, ModelLatency] = {}
+
+    def record(self, model: str, service_time: float, ttft: Optional[float] = None,
+               output_tokens: int = 0, generation_time: float = 0.0):
+        model_stats = self.models.get(model)
+        if model_stats is None:
+            model_stats = self.models[model] = ModelLatency(self.window)
+        model_stats.record(service_time, ttft, output_tokens, generation_time)
+
+    def estimate(self, model: str, max_tokens: Optional[int] = None) -> float:
+        model_stats = self.models.get(model)
+        return model_stats.estimate(max_tokens) if model_stats else QUEUE_DEFAULT_SERVICE_TIME
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {model: model_stats.snapshot() for model, model_stats in self.models.items()}
+
+
+def format_wait(seconds: float) -> str:
+    """Время ожидания для пользователя"""
+    if seconds < 60:
+        return "меньше минуты"
+    return f"≈ {round(seconds / 60)} мин."
@@ -0,0 +1,222 @@
+"""
+Метрики горячего пути в текстовом формате Prometheus.
+
+Запись метрики - это поиск корзины и пара сложений под коротким lock
+(часть метрик пишется из потока БД). Текст для Prometheus собирается
+только при запросе /metrics, а размеры очереди читаются в этот же момент.
+"""
+import bisect
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger('telegram_bot')
+
+# Корзины по умолчанию, сек.: от быстрых запросов к БД до долгих ответов модели
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+THROUGHPUT_BUCKETS = (5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Метрика с конкретными значениями меток (создается один раз)"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for values, child in list(self._children.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}")
+        return lines
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total_sum = child.sum
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                labels = _format_labels(self.labelnames, values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total_sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Значение, которое читается функцией в момент запроса /metrics"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.read = read
+
+    def render(self) -> List[str]:
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать метрику {self.name}: {str(e)}")
+            return []
+        return self._header() + [f"{self.name} {_format_value(value)}"]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Очередь запросов
+QUEUE_WAIT = registry.register(Histogram(
+    "bot_queue_wait_seconds", "Время ожидания запроса в очереди", ["model"]))
+REQUEST_DURATION = registry.register(Histogram(
+    "bot_request_duration_seconds", "Время обработки запроса после очереди", ["model"]))
+
+# OpenAI
+OPENAI_REQUESTS = registry.register(Counter(
+    "bot_openai_requests_total", "Запросы к OpenAI по результату", ["model", "status"]))
+OPENAI_RETRIES = registry.register(Counter(
+    "bot_openai_retries_total", "Повторы запросов к OpenAI после временных ошибок", ["model", "reason"]))
+OPENAI_FALLBACKS = registry.register(Counter(
+    "bot_openai_fallbacks_total", "Запросы, отправленные в резервную модель", ["model", "fallback"]))
+OPENAI_TTFT = registry.register(Histogram(
+    "bot_openai_ttft_seconds", "Время до первого токена стрима", ["model"]))
+OPENAI_TOKENS_PER_SECOND = registry.register(Histogram(
+    "bot_openai_tokens_per_second", "Скорость генерации стрима", ["model"], buckets=THROUGHPUT_BUCKETS))
+
+# Telegram
+TELEGRAM_EDIT_DURATION = registry.register(Histogram(
+    "bot_telegram_edit_seconds", "Время запроса editMessageText при стриме"))
+TELEGRAM_EDITS = registry.register(Counter(
+    "bot_telegram_edits_total", "Правки сообщений при стриме по результату", ["status"]))
+TELEGRAM_OUTBOUND = registry.register(Counter(
+    "bot_telegram_outbound_total", "Служебные сообщения по результату отправки", ["status"]))
+
+# БД
+DB_OPERATION_DURATION = registry.register(Histogram(
+    "bot_db_operation_seconds", "Время выполнения операции с БД в потоке БД", ["operation"]))
+DB_OPERATION_ERRORS = registry.register(Counter(
+    "bot_db_operation_errors_total", "Операции с БД, завершившиеся ошибкой", ["operation"]))
+
+
+def register_gauge(name: str, documentation: str, read: Callable[[], float]):
+    """Метрика-снимок (например, длина очереди), читается только при запросе /metrics"""
+    registry.register(Gauge(name, documentation, read))
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(
+        body=registry.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+async def start_metrics_server(host: str, port: int) -> Optional[web.AppRunner]:
+    """Поднимает /metrics на отдельном порту (port=0 - выключено)"""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,153 @@
+import importlib.util
+import logging
+from typing import Any, Dict, Optional
+
+import httpx
+from openai import AsyncOpenAI
+
+from config import (
+    OPENAI_API_KEY, OPENAI_BASE_URL, OPENAI_TIMEOUT, OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS, OPENAI_KEEPALIVE_EXPIRY, OPENAI_CONNECT_TIMEOUT
+)
+from . import metrics
+
+logger = logging.getLogger('telegram_bot')
+
+
+class CountedStream(httpx.AsyncByteStream):
+    """Тело ответа, при закрытии которого запрос перестает считаться выполняющимся"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close):
+        self.stream = stream
+        self.on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+                self.on_close = None
+
+
+class CountingTransport(httpx.AsyncBaseTransport):
+    """
+    Считает запросы, которые сейчас выполняются: от отправки до закрытия ответа
+    (для стрима - до последнего чанка) или до ошибки соединения, и новые соединения
+    (через расширение trace httpx) - остальные запросы шли по уже открытым
+    """
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport, manager: "OpenAIClientManager"):
+        self.transport = transport
+        self.manager = manager
+
+    def _finished(self):
+        self.manager.requests_in_flight -= 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        trace = request.extensions.get("trace")
+
+        async def on_trace(event: str, info: Dict[str, Any]):
+            if event == "connection.connect_tcp.complete":
+                self.manager.connections_opened += 1
+            if trace is not None:
+                await trace(event, info)
+
+        request.extensions["trace"] = on_trace
+        self.manager.requests_total += 1
+        self.manager.requests_in_flight += 1
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self._finished()
+            raise
+        response.stream = CountedStream(response.stream, self._finished)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class OpenAIClientManager:
+    """Один клиент OpenAI на весь процесс с общим пулом keep-alive соединений"""
+
+    def __init__(self):
+        self._client: Optional[AsyncOpenAI] = None
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self.http2 = importlib.util.find_spec("h2") is not None  # HTTP/2 доступен только с пакетом h2
+        self.requests_total = 0
+        self.requests_in_flight = 0
+        self.connections_opened = 0
+        self.clients_created = 0
+
+    def get_client(self) -> AsyncOpenAI:
+        """Возвращает общий клиент, создавая его при первом обращении"""
+        if self._client is None:
+            transport = httpx.AsyncHTTPTransport(
+                http2=self.http2,
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+                )
+            )
+            self._http_client = httpx.AsyncClient(
+                transport=CountingTransport(transport, self),
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+            )
+            self._client = AsyncOpenAI(
+                api_key=OPENAI_API_KEY,
+                base_url=OPENAI_BASE_URL,
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+                # Повторы делает сам бот (services.resilience): ответы 429 должны доходить до ограничителя лимитов
+                max_retries=0,
+                http_client=self._http_client
+            )
+            self.clients_created += 1
+            logger.info(f"🔌 Создан клиент OpenAI (HTTP/2: {'да' if self.http2 else 'нет'})")
+        return self._client
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """
+        Статистика пула соединений. Запросов в работе по HTTP/1.1 столько же, сколько занятых
+        соединений; новых соединений намного меньше запросов, если keep-alive работает
+        """
+        return {
+            "http2": self.http2,
+            "clients_created": self.clients_created,
+            "requests_total": self.requests_total,
+            "requests_in_flight": self.requests_in_flight,
+            "connections_opened": self.connections_opened,
+        }
+
+    async def close(self):
+        """Закрывает клиент и все соединения пула"""
+        if self._client is not None:
+            await self._client.close()
+            logger.info("🔌 Клиент OpenAI закрыт")
+        self._client = None
+        self._http_client = None
+
+
+# Глобальный менеджер клиента OpenAI
+client_manager = OpenAIClientManager()
+
+
+def get_openai_client() -> AsyncOpenAI:
+    return client_manager.get_client()
+
+
+async def close_openai_client():
+    await client_manager.close()
+
+
+metrics.register_gauge("bot_openai_requests_in_flight", "Запросов к OpenAI в работе",
+                       lambda: client_manager.requests_in_flight)
+metrics.register_gauge("bot_openai_requests", "Запросов к OpenAI отправлено",
+                       lambda: client_manager.requests_total)
+metrics.register_gauge("bot_openai_connections_opened", "Новых соединений с OpenAI",
+                       lambda: client_manager.connections_opened)
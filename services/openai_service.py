@@ -1,41 +1,52 @@
 import json
 from datetime import datetime
-from typing import Dict, Any, List, Optional
-from openai import AsyncOpenAI
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
 from dotenv import load_dotenv
 load_dotenv()  # Загружаем переменные окружения из .env
-from config import OPENAI_API_KEY, DEFAULT_MAX_TOKENS
+from config import OPENAI_API_KEY, DEFAULT_MAX_TOKENS, OPENAI_RETRIES
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY не установлен. Убедитесь, что файл .env создан и содержит правильный API ключ.")
-from .token_counter import get_token_count, calculate_cost
+from .token_counter import get_token_count, count_tokens_many, calculate_cost
+from .openai_client import get_openai_client
+from .rate_limiter import Reservation, rate_limiter, is_rate_limit_error, retry_after_from_error
+from .resilience import resilience, is_retriable, backoff_delay
+from . import metrics
 import asyncio
 
 import logging
 
 logger = logging.getLogger('telegram_bot')
 
-async def send_message_to_openai(
-    model: str, 
-    input_text: str, 
-    messages: List[Dict[str, str]] = None,
-    system_instruction: Optional[str] = None,
-    max_tokens: Optional[int] = None,
-    stream: bool = False
-) -> Dict[str, Any]:
-    """Отправить сообщение в OpenAI API и получить ответ"""
 
-    # Инициализируем клиент здесь, чтобы быть уверенными, что переменные окружения загружены
-    client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=30.0)
+def extract_usage(usage: Any) -> Dict[str, int]:
+    """Реальный расход токенов из ответа API"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cached_tokens": getattr(details, "cached_tokens", None) or 0,
+    }
 
-    # Если max_tokens не указан, используем значение по умолчанию из конфига
-    if max_tokens is None:
-        max_tokens = DEFAULT_MAX_TOKENS
-    
-    # Если нет истории сообщений, создаем новую
-    if messages is None:
-        messages = []
-    
-    # Формируем запрос в новом формате
+
+async def iterate_stream(stream: Any, usage: Dict[str, int]) -> AsyncIterator[str]:
+    """
+    Отдает куски текста из стрима OpenAI.
+    Последний чанк (include_usage) без choices содержит расход токенов - он записывается в usage.
+    """
+    async for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage.update(extract_usage(chunk.usage))
+        if chunk.choices and chunk.choices[0].delta.content is not None:
+            yield chunk.choices[0].delta.content
+
+def build_request_messages(input_text: str, messages: Optional[List[Dict[str, Any]]] = None,
+                           system_instruction: Optional[str] = None) -> Tuple[List[Dict[str, str]], bool]:
+    """
+    Собрать сообщения запроса с неизменным началом, чтобы OpenAI мог взять его из кэша префиксов:
+    системная инструкция чата, затем история в порядке хранения (уже отправленные сообщения
+    не меняются, смена промпта добавляется в историю системным сообщением), в конце новый вопрос.
+    Возвращает сообщения для API и признак, что новый вопрос уже есть в истории.
+    """
     api_messages = []
     
     # Если есть системная инструкция, добавляем её как инструкцию для модели
@@ -45,13 +56,49 @@ async def send_message_to_openai(
             "content": system_instruction
         })
     
-    # Добавляем историю сообщений
+    # Добавляем историю сообщений (в API уходят только роль и текст)
+    messages = messages or []
     for message in messages:
-        api_messages.append(message)
+        api_messages.append({"role": message["role"], "content": message["content"]})
     
     # Добавляем новый запрос пользователя, если его нет в истории
-    if not messages or messages[-1]["role"] != "user" or messages[-1]["content"] != input_text:
+    input_in_history = bool(messages) and messages[-1]["role"] == "user" and messages[-1]["content"] == input_text
+    if not input_in_history:
         api_messages.append({"role": "user", "content": input_text})
+    return api_messages, input_in_history
+
+
+async def send_message_to_openai(
+    model: str, 
+    input_text: str, 
+    messages: List[Dict[str, str]] = None,
+    system_instruction: Optional[str] = None,
+    max_tokens: Optional[int] = None,
+    stream: bool = False,
+    history_tokens: Optional[int] = None,
+    reservation: Optional[Reservation] = None
+) -> Dict[str, Any]:
+    """
+    Отправить сообщение в OpenAI API и получить ответ
+    history_tokens - уже известная сумма токенов истории (Chat.context_tokens),
+    если передана, заново считаются только системная инструкция и новое сообщение
+    reservation - резерв лимитов OpenAI из очереди: уточняется по оценке входа,
+    а для обычного ответа сразу пересчитывается по реальному расходу
+    (для стрима это делает вызывающий с резервом из поля "reservation", когда получит usage)
+    Временные ошибки повторяются; если предохранитель модели открыт, запрос уходит
+    в резервную модель - она возвращается в поле "model" ответа. Под резервную модель
+    лимиты резервируются заново, резерв основной модели возвращается
+    """
+
+    # Общий клиент с пулом keep-alive соединений
+    client = get_openai_client()
+
+    # Если max_tokens не указан, используем значение по умолчанию из конфига
+    if max_tokens is None:
+        max_tokens = DEFAULT_MAX_TOKENS
+    
+    # Формируем запрос: неизменное начало, затем новый вопрос
+    api_messages, input_in_history = build_request_messages(input_text, messages, system_instruction)
     
     try:
         start_time = datetime.now()
@@ -62,26 +109,76 @@ async def send_message_to_openai(
             logger.info(f"🔮 Используется системная инструкция (промпт): {system_instruction[:50]}...")
 
         # Оценка токенов перед запросом
-        from .token_counter import get_token_count
-        estimated_input_tokens = 0
-        for msg in api_messages:
-            estimated_input_tokens += get_token_count(msg["content"], model)
+        if history_tokens is None:
+            estimated_input_tokens = sum(count_tokens_many([msg["content"] for msg in api_messages], model))
+        else:
+            # История уже посчитана - токенизируем только то, чего в ней нет
+            estimated_input_tokens = history_tokens
+            if system_instruction:
+                estimated_input_tokens += get_token_count(system_instruction, model)
+            if not input_in_history:
+                estimated_input_tokens += get_token_count(input_text, model)
         logger.info(f"📊 Примерная оценка токенов в запросе: {estimated_input_tokens}")
+        if reservation is not None:
+            reservation.adjust(estimated_input_tokens)
 
         # Отправляем запрос в API
         try:
             logger.info(f"⏱️ Начало запроса к OpenAI API")
-            response = await client.chat.completions.create(
-                model=model,
-                messages=api_messages,
-                max_tokens=max_tokens,
-                stream=stream
-            )
+            request_params = {}
+            if stream:
+                # Просим прислать реальный расход токенов последним чанком стрима
+                request_params["stream_options"] = {"include_usage": True}
+            reserved_model = model
+            for attempt in range(OPENAI_RETRIES + 1):
+                used_model = resilience.select_model(model)
+                if used_model is None:
+                    raise RuntimeError(f"Модель {model} временно недоступна, попробуйте позже")
+                if used_model != reserved_model:
+                    # Резерв сделан под другую модель - возвращаем его и ждем лимитов этой
+                    if reservation is not None:
+                        reservation.release()
+                    reservation = await rate_limiter.reserve(used_model, max_tokens, estimated_input_tokens)
+                    reserved_model = used_model
+                if reservation is not None:
+                    reservation.sent = True
+                try:
+                    response = await client.chat.completions.create(
+                        model=used_model,
+                        messages=api_messages,
+                        max_tokens=max_tokens,
+                        stream=stream,
+                        **request_params
+                    )
+                    resilience.record_success(used_model)
+                    metrics.OPENAI_REQUESTS.labels(used_model, "ok").inc()
+                    break
+                except Exception as error:
+                    resilience.record_failure(used_model, error)
+                    metrics.OPENAI_REQUESTS.labels(used_model, "error").inc()
+                    if not is_retriable(error) or attempt == OPENAI_RETRIES:
+                        raise
+                    resilience.record_retry(used_model, error)
+                    if is_rate_limit_error(error):
+                        # Лимит все же превышен (например, ключ используют и другие) - ждем, пока он пополнится
+                        rate_limiter.penalize(used_model, retry_after_from_error(error))
+                        delay = rate_limiter.wait_time(used_model, max_tokens)
+                    else:
+                        delay = backoff_delay(attempt)
+                    logger.warning(
+                        f"🔁 Повтор запроса к {used_model} через {delay:.1f} сек. "
+                        f"(попытка {attempt + 2} из {OPENAI_RETRIES + 1}): {str(error)}"
+                    )
+                    await asyncio.sleep(delay)
             end_time = datetime.now()
             elapsed = (end_time - start_time).total_seconds()
             logger.info(f"✅ Получен ответ от OpenAI API за {elapsed:.2f} сек.")
-        except Exception as api_error:
-            logger.error(f"⚠️ Ошибка при выполнении запроса к API: {str(api_error)}")
+        except BaseException as api_error:
+            if reservation is not None:
+                # Резерв резервной модели вызывающий не видит - возвращаем его здесь
+                reservation.release()
+            if isinstance(api_error, Exception):
+                logger.error(f"⚠️ Ошибка при выполнении запроса к API: {str(api_error)}")
             raise  # Пробрасываем ошибку дальше для основного блока try/except
 
         if stream:
@@ -89,20 +186,29 @@ async def send_message_to_openai(
             return {
                 "success": True,
                 "stream": response,
+                "model": used_model,
+                "reservation": reservation,
                 "input_tokens": estimated_input_tokens
             }
         else:
             # Для обычного ответа возвращаем полный текст
             output_text = response.choices[0].message.content
-            output_tokens = response.usage.completion_tokens
-            output_cost = calculate_cost(output_tokens, model, is_input=False)
+            usage = extract_usage(response.usage)
+            if usage["cached_tokens"]:
+                logger.info(f"🗄 Из кэша OpenAI: {usage['cached_tokens']} из {usage['prompt_tokens']} входных токенов")
+            output_tokens = usage["completion_tokens"]
+            if reservation is not None:
+                reservation.settle(usage["prompt_tokens"] + output_tokens, usage["prompt_tokens"])
+            output_cost = calculate_cost(output_tokens, used_model, is_input=False)
             
             return {
                 "success": True,
+                "model": used_model,
                 "output_text": output_text,
                 "output_tokens": output_tokens,
                 "output_cost": output_cost,
-                "input_tokens": estimated_input_tokens
+                "input_tokens": usage["prompt_tokens"],
+                "cached_tokens": usage["cached_tokens"]
             }
     except Exception as e:
         logger.error(f"❌ Ошибка при обработке запроса: {str(e)}")
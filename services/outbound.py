@@ -0,0 +1,185 @@
+"""
+Фоновая отправка служебных сообщений в Telegram (статус запроса, позиция
+в очереди, уведомления админу).
+
+Отправитель только кладет сообщение в ограниченную очередь и сразу идет
+дальше - запрос к модели не ждет Telegram, а сбой уведомления не ломает
+ответ. Обработчики отправляют сообщения по приоритету в пределах лимитов
+Telegram, после 429 повторяют через retry_after. Сообщение в чат, который
+пока нельзя трогать, откладывается и возвращается в очередь позже, а
+обработчик берет следующее - пауза одного чата не задерживает остальные.
+Статус, который еще не успели отправить, заменяется новым статусом того же вида.
+"""
+import asyncio
+import itertools
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import OUTBOUND_QUEUE_SIZE, OUTBOUND_WORKERS, OUTBOUND_MAX_ATTEMPTS, OUTBOUND_DRAIN_TIMEOUT
+from .stream_renderer import edit_scheduler
+from . import metrics
+
+logger = logging.getLogger('telegram_bot')
+
+# Приоритеты: меньше - раньше
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+
+
+class OutboundDispatcher:
+    def __init__(self, queue_size: int = OUTBOUND_QUEUE_SIZE, workers: int = OUTBOUND_WORKERS):
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue(maxsize=queue_size)
+        self.workers_count = workers
+        self.workers: List[asyncio.Task] = []
+        self.seq = itertools.count()
+        # Еще не отправленные статусы по (чат, вид) - новый статус заменяет текст старого
+        self.pending: Dict[Tuple[int, str], Dict[str, Any]] = {}
+        # Отложенные до открытия своего чата: таймер -> сообщение
+        self.delayed: Dict[asyncio.TimerHandle, Dict[str, Any]] = {}
+        self.stats = {"sent": 0, "coalesced": 0, "retried": 0, "deferred": 0, "dropped": 0, "failed": 0}
+
+    def send(self, bot: Bot, chat_id: int, text: str, priority: int = PRIORITY_USER,
+             coalesce_key: Optional[str] = None, **kwargs) -> bool:
+        """
+        Поставить сообщение в очередь на отправку, не дожидаясь ее.
+        coalesce_key - вид статуса: неотправленное сообщение того же вида в этот чат
+        заменяется новым. kwargs передаются в bot.send_message.
+        Возвращает False, если очередь переполнена и сообщение отброшено.
+        """
+        if coalesce_key is not None:
+            pending = self.pending.get((chat_id, coalesce_key))
+            if pending is not None:
+                pending["text"] = text
+                pending["kwargs"] = kwargs
+                self.stats["coalesced"] += 1
+                metrics.TELEGRAM_OUTBOUND.labels("coalesced").inc()
+                return True
+
+        item = {
+            "bot": bot,
+            "chat_id": chat_id,
+            "text": text,
+            "kwargs": kwargs,
+            "priority": priority,
+            "coalesce_key": coalesce_key,
+            "attempts": 0,
+        }
+        if not self._put(item):
+            return False
+        if coalesce_key is not None:
+            self.pending[(chat_id, coalesce_key)] = item
+        return True
+
+    def _put(self, item: Dict[str, Any]) -> bool:
+        try:
+            self.queue.put_nowait((item["priority"], next(self.seq), item))
+            return True
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            metrics.TELEGRAM_OUTBOUND.labels("dropped").inc()
+            logger.warning(f"Очередь исходящих сообщений переполнена, сообщение в чат {item['chat_id']} отброшено")
+            return False
+
+    def _forget(self, item: Dict[str, Any]):
+        """Сообщение не будет отправлено: следующий статус того же вида не должен к нему приклеиваться"""
+        if item["coalesce_key"] is None:
+            return
+        key = (item["chat_id"], item["coalesce_key"])
+        if self.pending.get(key) is item:
+            self.pending.pop(key)
+
+    def _defer(self, item: Dict[str, Any], delay: float):
+        """Вернуть сообщение в очередь через delay секунд, не занимая обработчик"""
+        def requeue():
+            self.delayed.pop(handle, None)
+            if not self._put(item):
+                self._forget(item)
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self.delayed[handle] = item
+
+    async def _deliver(self, item: Dict[str, Any]):
+        chat_id = item["chat_id"]
+        wait = edit_scheduler.try_acquire(chat_id)
+        if wait > 0:
+            self.stats["deferred"] += 1
+            self._defer(item, wait)
+            return
+        item["attempts"] += 1
+        try:
+            # С этого момента текст не меняется - следующий статус уйдет отдельным сообщением
+            if item["coalesce_key"] is not None:
+                self.pending.pop((chat_id, item["coalesce_key"]), None)
+            await item["bot"].send_message(chat_id, item["text"], **item["kwargs"])
+            self.stats["sent"] += 1
+            metrics.TELEGRAM_OUTBOUND.labels("sent").inc()
+        except TelegramRetryAfter as e:
+            edit_scheduler.penalize(chat_id, e.retry_after)
+            if item["attempts"] >= OUTBOUND_MAX_ATTEMPTS:
+                self._failed(item, e)
+                return
+            self.stats["retried"] += 1
+            metrics.TELEGRAM_OUTBOUND.labels("retried").inc()
+            # Повтор вернется в очередь после паузы чата
+            self._defer(item, e.retry_after)
+        except Exception as e:
+            self._failed(item, e)
+
+    def _failed(self, item: Dict[str, Any], error: Exception):
+        self.stats["failed"] += 1
+        metrics.TELEGRAM_OUTBOUND.labels("failed").inc()
+        logger.warning(f"Не удалось отправить сообщение в чат {item['chat_id']}: {str(error)}")
+
+    async def _worker(self):
+        while True:
+            _, _, item = await self.queue.get()
+            try:
+                await self._deliver(item)
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        """Запускает обработчики исходящих сообщений"""
+        if self.workers:
+            return
+        for _ in range(self.workers_count):
+            self.workers.append(asyncio.create_task(self._worker()))
+
+    async def _drain(self):
+        """Ждет, пока опустеют и очередь, и отложенные сообщения"""
+        while True:
+            await self.queue.join()
+            if not self.delayed:
+                return
+            await asyncio.sleep(0.05)
+
+    async def stop(self, timeout: float = OUTBOUND_DRAIN_TIMEOUT):
+        """Дожидается отправки накопленного (не дольше timeout) и останавливает обработчики"""
+        if self.workers:
+            try:
+                await asyncio.wait_for(self._drain(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Не отправлено исходящих сообщений при остановке: {self.queue.qsize() + len(self.delayed)}"
+                )
+        for handle, item in self.delayed.items():
+            handle.cancel()
+            self._forget(item)
+        self.delayed.clear()
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "queued": self.queue.qsize(), "delayed": len(self.delayed)}
+
+
+# Общий отправитель на весь процесс
+outbound = OutboundDispatcher()
+
+metrics.register_gauge("bot_telegram_outbound_queue", "Служебных сообщений ждут отправки",
+                       lambda: outbound.queue.qsize())
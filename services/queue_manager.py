@@ -1,106 +1,480 @@
-from typing import Dict, List, Optional
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+from collections import deque
 import asyncio
+import heapq
+import logging
+import time
 from aiogram import Bot
 from aiogram.types import Message
 from datetime import datetime, timedelta
 
+from config import QUEUE_WORKERS, MODEL_CONCURRENCY
+from .outbound import outbound
+from .latency_stats import LatencyStats, format_wait
+from .rate_limiter import RateLimiter, rate_limiter as default_rate_limiter
+from .shared_limits import SharedSlots, SHARED_POLL_INTERVAL
+from . import metrics
+
+logger = logging.getLogger('telegram_bot')
+
+# Обработчик запроса: получает словарь запроса и выполняет всю работу по нему
+RequestHandler = Callable[[Dict], Awaitable[None]]
+
+
+class RankIndex:
+    """
+    Места запросов в очереди: дерево Фенвика по порядковым номерам запросов.
+    Добавление, удаление и место запроса - O(log n), без перебора очереди.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.offset = 0  # Порядковый номер, с которого начинается дерево
+        self.tree: List[int] = [0] * (capacity + 1)
+        self.live: Set[int] = set()
+
+    def _update(self, index: int, delta: int):
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, index: int) -> int:
+        """Сколько запросов с индексом не больше index"""
+        i = index + 1
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def _rebuild(self, first: int, capacity: int):
+        self.offset = first
+        self.tree = [0] * (capacity + 1)
+        for seq in self.live:
+            self._update(seq - first, 1)
+
+    def add(self, seq: int):
+        if not self.live:
+            # Очередь пуста - дерево нулевое, начинаем его с нового номера
+            self.offset = seq
+        elif seq - self.offset >= len(self.tree) - 1:
+            # Номер не помещается: сдвигаем начало к самому старому запросу и при нужде растем
+            first = min(self.live)
+            capacity = len(self.tree) - 1
+            while seq - first >= capacity:
+                capacity *= 2
+            self._rebuild(first, capacity)
+        self.live.add(seq)
+        self._update(seq - self.offset, 1)
+
+    def remove(self, seq: int):
+        if seq in self.live:
+            self.live.remove(seq)
+            self._update(seq - self.offset, -1)
+
+    def rank(self, seq: int) -> int:
+        """Место запроса в очереди, начиная с 1"""
+        return self._prefix(seq - self.offset)
+
+
 class QueueManager:
-    def __init__(self):
-        self.queue: List[Dict] = []
-        self.current_request: Optional[Dict] = None
+    def __init__(self, workers: int = QUEUE_WORKERS, model_limits: Optional[Dict[str, int]] = None,
+                 rate_limiter: Optional[RateLimiter] = None):
+        self.queue: Dict[int, Dict] = {}  # Ждущие запросы по порядковому номеру (в порядке постановки)
+        self.model_queues: Dict[str, Deque[Dict]] = {}  # Ждущие запросы по моделям
+        self.user_queued: Dict[int, List[Dict]] = {}  # Ждущие запросы по user_id
+        self.ranks = RankIndex()
+        self.next_seq = 0
+        self.active: Dict[int, Dict] = {}  # Запросы в обработке по user_id
+        self.model_active: Dict[str, int] = {}  # Количество запросов в обработке по моделям
         self.lock = asyncio.Lock()
-        self.processing = False
+        self.condition = asyncio.Condition(self.lock)
+        self.workers_count = workers
+        self.model_limits = model_limits if model_limits is not None else MODEL_CONCURRENCY
+        self.workers: List[asyncio.Task] = []
+        self.rate_limiter = rate_limiter or default_rate_limiter  # Лимиты OpenAI RPM/TPM по моделям
+        # Слоты, общие с другими процессами supervisor.py (None - процесс один)
+        self.shared_workers: Optional[SharedSlots] = None
+        self.shared_models: Dict[str, SharedSlots] = {}
+        self.latency = LatencyStats()  # Время обработки по моделям - для оценки ожидания
         self.last_notification_time: Dict[int, datetime] = {}  # Для отслеживания времени последнего уведомления
 
-    async def add_to_queue(self, message: Message) -> int:
-        """Добавляет запрос в очередь и возвращает позицию в очереди"""
-        async with self.lock:
-            position = len(self.queue) + 1
-            self.queue.append({
+    async def submit(self, message: Message, model: str, handler: RequestHandler,
+                     text: Optional[str] = None, max_tokens: Optional[int] = None) -> Tuple[int, asyncio.Future]:
+        """
+        Ставит запрос в очередь.
+        text - текст запроса, если он собран из нескольких сообщений (по умолчанию текст message),
+        max_tokens - лимит ответа (нужен для оценки времени обработки).
+        Возвращает позицию в очереди (0 - обработка начнется сразу) и future,
+        который завершится после обработки запроса.
+        """
+        future = asyncio.get_running_loop().create_future()
+        async with self.condition:
+            request = {
+                'seq': self.next_seq,
                 'user_id': message.from_user.id,
                 'message': message,
+                'text': text if text is not None else message.text,
                 'chat_id': message.chat.id,
                 'bot': message.bot,
-                'position': position,
+                'model': model,
+                'max_tokens': max_tokens,
+                'handler': handler,
+                'future': future,
                 'timestamp': datetime.now(),
+                'enqueued_at': time.monotonic(),
                 'last_notification': datetime.now()  # Время последнего уведомления
-            })
-            return position
+            }
+            self.next_seq += 1
+            self._enqueue(request)
+            # Место считается так же, как в последующих обновлениях позиции
+            position = self.ranks.rank(request['seq'])
+            if position <= self._free_slots(model) and request['user_id'] not in self.active:
+                # Свободный обработчик возьмет запрос сразу
+                position = 0
+            request['position'] = position
+            self.condition.notify_all()
+        return position, future
 
-    async def process_queue(self):
-        """Обрабатывает очередь запросов"""
-        if self.processing:
+    def _enqueue(self, request: Dict):
+        self.queue[request['seq']] = request
+        self.model_queues.setdefault(request['model'], deque()).append(request)
+        self.user_queued.setdefault(request['user_id'], []).append(request)
+        self.ranks.add(request['seq'])
+
+    def _dequeue(self, request: Dict):
+        """Убирает запрос из очереди. Из очереди модели он уйдет сам, когда дойдет до ее начала"""
+        del self.queue[request['seq']]
+        user_requests = self.user_queued[request['user_id']]
+        user_requests.remove(request)
+        if not user_requests:
+            del self.user_queued[request['user_id']]
+        self.ranks.remove(request['seq'])
+
+    def use_shared_slots(self, workers: SharedSlots, models: Dict[str, SharedSlots]):
+        """
+        Общие лимиты нескольких процессов: каждый процесс может занять все слоты,
+        но вместе процессы не превышают QUEUE_WORKERS и MODEL_CONCURRENCY
+        """
+        self.shared_workers = workers
+        self.shared_models = models
+
+    def _acquire_shared(self, model: str) -> bool:
+        """Занять общие слоты обработчика и модели (если процессов несколько)"""
+        if self.shared_workers is None:
+            return True
+        if not self.shared_workers.try_acquire():
+            return False
+        model_slots = self.shared_models.get(model)
+        if model_slots is not None and not model_slots.try_acquire():
+            self.shared_workers.release()
+            return False
+        return True
+
+    def _release_shared(self, model: str):
+        if self.shared_workers is None:
             return
-        
-        self.processing = True
-        try:
-            while self.queue:
-                async with self.lock:
-                    if not self.queue:
-                        break
-                    self.current_request = self.queue.pop(0)
-                
-                # Уведомляем пользователя, что его запрос начал обрабатываться
-                await self.current_request['bot'].send_message(
-                    self.current_request['chat_id'],
-                    "🔄 Ваш запрос начал обрабатываться!"
-                )
-                
-                # Возвращаем текущий запрос для обработки
-                yield self.current_request
-                
+        self.shared_workers.release()
+        model_slots = self.shared_models.get(model)
+        if model_slots is not None:
+            model_slots.release()
+
+    def _free_slots(self, model: str) -> int:
+        """Количество свободных обработчиков, которые могут взять запрос к модели"""
+        busy = sum(self.model_active.values())
+        free = self.workers_count - busy
+        limit = self.model_limits.get(model)
+        if limit is not None:
+            free = min(free, limit - self.model_active.get(model, 0))
+        return max(0, free)
+
+    def _model_candidate(self, model: str, requests: Deque[Dict]) -> Optional[Dict]:
+        """Первый запрос к модели, который можно взять (вызывать под lock)"""
+        # Уже взятые и удаленные запросы убираем из начала очереди модели
+        while requests and requests[0]['seq'] not in self.queue:
+            requests.popleft()
+        # Пропускаются только запросы пользователей, у которых что-то уже в обработке,
+        # так что просмотр ограничен числом активных запросов
+        for request in requests:
+            if request['seq'] in self.queue and request['user_id'] not in self.active:
+                return request
+        return None
+
+    def _next_request(self) -> Tuple[Optional[Dict], Optional[float]]:
+        """
+        Самый ранний запрос, который можно взять в обработку прямо сейчас (вызывать под lock).
+        Для него уже заняты общие слоты процессов. Вторым значением - через сколько секунд
+        проверить снова, если подходящие запросы ждут лимитов OpenAI или слотов других процессов
+        """
+        candidates = []
+        for model, requests in self.model_queues.items():
+            limit = self.model_limits.get(model)
+            if limit is not None and self.model_active.get(model, 0) >= limit:
+                continue
+            request = self._model_candidate(model, requests)
+            if request is not None:
+                candidates.append(request)
+
+        retry_in = None
+        for request in sorted(candidates, key=lambda candidate: candidate['seq']):
+            model = request['model']
+            wait = self.rate_limiter.wait_time(model, request['max_tokens'])
+            if wait <= 0 and not self._acquire_shared(model):
+                wait = SHARED_POLL_INTERVAL
+            if wait > 0:
+                if not request.get('throttled'):
+                    request['throttled'] = True
+                    self.rate_limiter.throttled(model)
+                retry_in = wait if retry_in is None else min(retry_in, wait)
+                continue
+            return request, None
+        return None, retry_in
+
+    async def _worker(self, worker_id: int):
+        """Обработчик очереди: берет подходящие запросы и выполняет их"""
+        while True:
+            async with self.condition:
+                request, retry_in = self._next_request()
+                while request is None:
+                    if retry_in is None:
+                        await self.condition.wait()
+                    else:
+                        # Запросы ждут лимитов OpenAI или слотов других процессов - проверим снова позже
+                        try:
+                            await asyncio.wait_for(self.condition.wait(), retry_in)
+                        except asyncio.TimeoutError:
+                            pass
+                    request, retry_in = self._next_request()
+                self._dequeue(request)
+                # Резерв лимитов OpenAI; обработчик уточняет его по реальному расходу
+                request['reservation'] = self.rate_limiter.acquire(request['model'], request['max_tokens'])
+                request['started'] = time.monotonic()
+                metrics.QUEUE_WAIT.labels(request['model']).observe(request['started'] - request['enqueued_at'])
+                self.active[request['user_id']] = request
+                self.model_active[request['model']] = self.model_active.get(request['model'], 0) + 1
+
+            try:
+                # Уведомляем пользователя, что его запрос начал обрабатываться (не дожидаясь отправки)
+                outbound.send(request['bot'], request['chat_id'], "🔄 Ваш запрос начал обрабатываться!",
+                              coalesce_key="status")
+
+                await request['handler'](request)
+
+                # Обработчик может положить в request['latency'] замеры стрима (ttft, output_tokens, generation_time)
+                service_time = time.monotonic() - request['started']
+                latency = request.get('latency', {})
+                self.latency.record(request['model'], service_time, **latency)
+                metrics.REQUEST_DURATION.labels(request['model']).observe(service_time)
+                if latency:
+                    metrics.OPENAI_TTFT.labels(request['model']).observe(latency['ttft'])
+                    if latency['generation_time'] > 0:
+                        metrics.OPENAI_TOKENS_PER_SECOND.labels(request['model']).observe(
+                            latency['output_tokens'] / latency['generation_time']
+                        )
+
                 # Уведомляем пользователя о завершении обработки
-                await self.current_request['bot'].send_message(
-                    self.current_request['chat_id'],
-                    "✅ Обработка вашего запроса завершена!"
-                )
-                
-                self.current_request = None
-        finally:
-            self.processing = False
+                outbound.send(request['bot'], request['chat_id'], "✅ Обработка вашего запроса завершена!",
+                              coalesce_key="status")
+                if not request['future'].done():
+                    request['future'].set_result(None)
+            except asyncio.CancelledError:
+                if not request['future'].done():
+                    request['future'].cancel()
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка в обработчике очереди #{worker_id}: {str(e)}")
+                if not request['future'].done():
+                    request['future'].set_exception(e)
+            finally:
+                if request['reservation'] is not None:
+                    request['reservation'].release()
+                self._release_shared(request['model'])
+                async with self.condition:
+                    self.active.pop(request['user_id'], None)
+                    self.model_active[request['model']] -= 1
+                    self.condition.notify_all()
+
+    def start_workers(self):
+        """Запускает обработчики очереди"""
+        if self.workers:
+            return
+        for worker_id in range(self.workers_count):
+            self.workers.append(asyncio.create_task(self._worker(worker_id)))
+        logger.info(f"🧵 Запущено обработчиков очереди: {self.workers_count}")
+
+    async def stop_workers(self):
+        """Останавливает обработчики очереди"""
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def _estimate_waits(self, until_seq: Optional[int] = None) -> Dict[int, float]:
+        """
+        Сколько секунд каждому ждущему запросу до начала обработки (вызывать под lock).
+        Очередь проигрывается на обработчиках и слотах моделей: каждый запрос занимает
+        тот, что освободится раньше, на ожидаемое для его модели и max_tokens время.
+        until_seq - проигрывать только до этого запроса (следующие на него не влияют)
+        """
+        # Оценка просматривает окно замеров, поэтому считается один раз на модель и max_tokens
+        estimates: Dict[Tuple[str, Optional[int]], float] = {}
+
+        def service_estimate(request: Dict) -> float:
+            key = (request['model'], request['max_tokens'])
+            if key not in estimates:
+                estimates[key] = self.latency.estimate(*key)
+            return estimates[key]
+
+        now = time.monotonic()
+        workers = [
+            max(0.0, request['started'] + service_estimate(request) - now)
+            for request in self.active.values()
+        ]
+        workers += [0.0] * max(0, self.workers_count - len(workers))
+        heapq.heapify(workers)
+
+        model_slots: Dict[str, List[float]] = {}
+        for model, limit in self.model_limits.items():
+            slots = [
+                max(0.0, request['started'] + service_estimate(request) - now)
+                for request in self.active.values() if request['model'] == model
+            ]
+            slots += [0.0] * max(0, limit - len(slots))
+            heapq.heapify(slots)
+            model_slots[model] = slots
+
+        waits = {}
+        for seq, request in self.queue.items():
+            slots = model_slots.get(request['model'])
+            start = workers[0] if workers else 0.0
+            if slots:
+                start = max(start, slots[0])
+            finish = start + service_estimate(request)
+            if workers:
+                heapq.heapreplace(workers, finish)
+            if slots:
+                heapq.heapreplace(slots, finish)
+            waits[seq] = start
+            if seq == until_seq:
+                break
+        return waits
+
+    async def estimate_wait(self, user_id: int) -> Optional[float]:
+        """Ожидаемое время до начала обработки запроса пользователя, сек."""
+        async with self.lock:
+            requests = self.user_queued.get(user_id)
+            if not requests:
+                return None
+            seq = requests[0]['seq']
+            return self._estimate_waits(until_seq=seq).get(seq)
+
+    async def get_latency_report(self) -> Dict[str, Any]:
+        """Статистика времени обработки и текущей очереди для админов"""
+        async with self.lock:
+            waits = self._estimate_waits()
+            return {
+                "models": self.latency.snapshot(),
+                "queued": len(self.queue),
+                "active": len(self.active),
+                "workers": self.workers_count,
+                "max_wait": max(waits.values(), default=0.0),
+                "rate_limits": self.rate_limiter.snapshot(),
+            }
 
     async def get_queue_position(self, user_id: int) -> Optional[int]:
         """Возвращает позицию пользователя в очереди"""
         async with self.lock:
-            for i, request in enumerate(self.queue):
-                if request['user_id'] == user_id:
-                    return i + 1
+            requests = self.user_queued.get(user_id)
+            return self.ranks.rank(requests[0]['seq']) if requests else None
+
+    def append_to_queued(self, user_id: int, text: str) -> Optional[int]:
+        """
+        Дописывает текст к запросу пользователя, который еще ждет в очереди.
+        Возвращает позицию этого запроса или None, если ждущего запроса нет.
+        Без await внутри - обработчик не может забрать запрос посреди изменения.
+        """
+        requests = self.user_queued.get(user_id)
+        if not requests:
             return None
+        request = requests[0]
+        if text:
+            request['text'] = f"{request['text']}\n\n{text}"
+        return self.ranks.rank(request['seq'])
 
     def is_user_in_queue(self, user_id: int) -> bool:
-        """Проверяет, есть ли пользователь в очереди"""
-        return any(request['user_id'] == user_id for request in self.queue)
+        """Проверяет, есть ли у пользователя запрос в очереди или в обработке"""
+        return user_id in self.active or user_id in self.user_queued
 
     async def remove_from_queue(self, user_id: int) -> bool:
         """Удаляет запрос пользователя из очереди"""
         async with self.lock:
-            for i, request in enumerate(self.queue):
-                if request['user_id'] == user_id:
-                    self.queue.pop(i)
-                    return True
+            requests = self.user_queued.get(user_id)
+            if not requests:
+                return False
+            request = requests[0]
+            self._dequeue(request)
+            if not request['future'].done():
+                request['future'].cancel()
+            self.condition.notify_all()
+            return True
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Ждет, пока очередь опустеет и доработают запросы в обработке (не дольше timeout).
+        Возвращает False, если к концу timeout что-то осталось
+        """
+        async def wait_idle():
+            async with self.condition:
+                await self.condition.wait_for(lambda: not self.queue and not self.active)
+
+        try:
+            await asyncio.wait_for(wait_idle(), timeout)
+            return True
+        except asyncio.TimeoutError:
             return False
 
+    def _notify_position(self, request: Dict, position: int, wait: float):
+        # Неотправленное старое уведомление о позиции заменяется новым
+        outbound.send(
+            request['bot'],
+            request['chat_id'],
+            f"⏳ Ваш запрос все еще в очереди. Текущая позиция: {position}\n"
+            f"Примерное время ожидания: {format_wait(wait)}",
+            coalesce_key="queue_position"
+        )
+
     async def send_queue_updates(self):
         """Отправляет обновления о статусе очереди"""
         while True:
             await asyncio.sleep(30)  # Проверяем каждые 30 секунд
-            
+
+            # Под lock только выбираем, кому писать: очередь не ждет Telegram
+            notifications = []
             async with self.lock:
                 current_time = datetime.now()
-                for request in self.queue:
+                waits = None
+                for position, request in enumerate(self.queue.values(), 1):
                     # Отправляем уведомление, если прошло более 1 минуты с последнего
                     if (current_time - request['last_notification']) > timedelta(minutes=1):
-                        position = self.queue.index(request) + 1
-                        await request['bot'].send_message(
-                            request['chat_id'],
-                            f"⏳ Ваш запрос все еще в очереди. Текущая позиция: {position}\n"
-                            f"Примерное время ожидания: {position * 2} минут"
-                        )
+                        if waits is None:
+                            waits = self._estimate_waits()
+                        notifications.append((request, position, waits[request['seq']]))
                         request['last_notification'] = current_time
 
+            for request, position, wait in notifications:
+                self._notify_position(request, position, wait)
+
 # Создаем глобальный экземпляр менеджера очереди
 queue_manager = QueueManager()
 
+metrics.register_gauge("bot_queue_depth", "Запросов в очереди", lambda: len(queue_manager.queue))
+metrics.register_gauge("bot_queue_active", "Запросов в обработке", lambda: len(queue_manager.active))
+
 # Запускаем задачу для отправки обновлений о статусе очереди
 async def start_queue_updates():
-    await queue_manager.send_queue_updates() 
\ No newline at end of file
+    await queue_manager.send_queue_updates()
+
+
+def start_queue_workers():
+    """Запускает обработчики глобальной очереди"""
+    queue_manager.start_workers()
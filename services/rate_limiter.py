@@ -0,0 +1,195 @@
+"""
+Лимиты OpenAI на запросы и токены в минуту (RPM/TPM) на стороне бота.
+
+Перед взятием запроса из очереди под него резервируется один запрос и
+оценка токенов: вход плюс max_tokens (так же считает и OpenAI). Когда
+корзины модели пусты, запросы к ней ждут в очереди, а не получают 429.
+После ответа резерв пересчитывается по реальному расходу, разница
+возвращается в корзину.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from config import MODEL_RATE_LIMITS, DEFAULT_MAX_TOKENS
+from .token_bucket import TokenBucket
+
+logger = logging.getLogger('telegram_bot')
+
+INPUT_WINDOW = 50  # По скольким последним запросам оценивать входные токены, пока запрос не собран
+
+
+class Reservation:
+    """Резерв лимитов под один запрос к модели"""
+
+    def __init__(self, limiter: "ModelRateLimiter", max_tokens: int, input_tokens: int):
+        self.limiter = limiter
+        self.max_tokens = max_tokens
+        self.tokens = input_tokens + max_tokens
+        self.sent = False  # Запрос ушел в OpenAI - лимит им уже израсходован
+        self.settled = False
+
+    def adjust(self, input_tokens: int):
+        """Запрос собран: уточняем резерв по посчитанным входным токенам"""
+        if self.settled:
+            return
+        tokens = input_tokens + self.max_tokens
+        self.limiter.tokens.take(tokens - self.tokens)
+        self.tokens = tokens
+
+    def settle(self, used_tokens: int, input_tokens: Optional[int] = None):
+        """Ответ получен: возвращаем в корзину то, что зарезервировали сверх реального расхода"""
+        if self.settled:
+            return
+        self.settled = True
+        refund = self.tokens - used_tokens
+        if refund > 0:
+            self.limiter.tokens.give(refund)
+            self.limiter.refunded += refund
+        else:
+            self.limiter.tokens.take(-refund)
+        if input_tokens is not None:
+            self.limiter.input_samples.append(input_tokens)
+
+    def release(self):
+        """
+        Обработка запроса закончилась без settle. Если запрос в OpenAI не уходил
+        (ответ из кэша, ошибка до запроса), лимиты возвращаются полностью,
+        иначе резерв остается израсходованным - реальный расход неизвестен.
+        """
+        if self.settled:
+            return
+        self.settled = True
+        if not self.sent:
+            self.limiter.requests.give(1)
+            self.limiter.tokens.give(self.tokens)
+
+
+class ModelRateLimiter:
+    """Корзины запросов и токенов одной модели"""
+
+    def __init__(self, rpm: float, tpm: float, buckets: Optional[Tuple[TokenBucket, TokenBucket]] = None):
+        if buckets is None:
+            buckets = (TokenBucket(rpm / 60, capacity=rpm), TokenBucket(tpm / 60, capacity=tpm))
+        self.requests, self.tokens = buckets
+        self.input_samples: Deque[int] = deque(maxlen=INPUT_WINDOW)
+        self.admitted = 0
+        self.throttled = 0  # Сколько раз запрос к модели ждал из-за лимитов
+        self.rate_limited = 0  # Ответов 429 от OpenAI
+        self.refunded = 0  # Токенов возвращено после ответов
+
+    def cost(self, max_tokens: int) -> int:
+        """Оценка токенов запроса до того, как собрана история: средний вход плюс max_tokens"""
+        average_input = sum(self.input_samples) / len(self.input_samples) if self.input_samples else 0
+        return int(average_input) + max_tokens
+
+    def wait_time(self, max_tokens: int, now: float) -> float:
+        return max(self.requests.wait_time(now), self.tokens.wait_time(now, self.cost(max_tokens)))
+
+
+class RateLimiter:
+    """Лимиты RPM/TPM по моделям. Модели без лимита в MODEL_RATE_LIMITS не ограничиваются"""
+
+    def __init__(self, limits: Optional[Dict[str, Dict[str, float]]] = None):
+        self.models: Dict[str, ModelRateLimiter] = {}
+        self.configure(limits if limits is not None else MODEL_RATE_LIMITS)
+
+    def configure(self, limits: Dict[str, Dict[str, float]],
+                  buckets: Optional[Dict[str, Tuple[TokenBucket, TokenBucket]]] = None):
+        """
+        Лимиты по моделям. buckets - готовые корзины (запросов, токенов), например общие
+        для процессов supervisor.py; для остальных моделей создаются свои
+        """
+        buckets = buckets or {}
+        self.models = {
+            model: ModelRateLimiter(limit["rpm"], limit["tpm"], buckets.get(model))
+            for model, limit in limits.items()
+        }
+
+    def wait_time(self, model: str, max_tokens: Optional[int] = None) -> float:
+        """Сколько секунд запросу к модели ждать лимитов (0 - можно отправлять)"""
+        limiter = self.models.get(model)
+        if limiter is None:
+            return 0.0
+        return limiter.wait_time(max_tokens or DEFAULT_MAX_TOKENS, time.monotonic())
+
+    def throttled(self, model: str):
+        """Запрос к модели не взят из очереди из-за лимитов"""
+        limiter = self.models.get(model)
+        if limiter is not None:
+            limiter.throttled += 1
+
+    def acquire(self, model: str, max_tokens: Optional[int] = None) -> Optional[Reservation]:
+        """Резервирует лимиты под запрос (проверять wait_time заранее). None - модель без лимитов"""
+        limiter = self.models.get(model)
+        if limiter is None:
+            return None
+        max_tokens = max_tokens or DEFAULT_MAX_TOKENS
+        reservation = Reservation(limiter, max_tokens, limiter.cost(max_tokens) - max_tokens)
+        limiter.requests.take(1)
+        limiter.tokens.take(reservation.tokens)
+        limiter.admitted += 1
+        return reservation
+
+    async def reserve(self, model: str, max_tokens: Optional[int] = None,
+                      input_tokens: Optional[int] = None) -> Optional[Reservation]:
+        """
+        Дождаться лимитов модели и зарезервировать их - для запросов, которые идут не через
+        очередь (резервная модель, служебные запросы). input_tokens - уже посчитанный вход
+        """
+        delay = self.wait_time(model, max_tokens)
+        if delay > 0:
+            self.throttled(model)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.wait_time(model, max_tokens)
+        reservation = self.acquire(model, max_tokens)
+        if reservation is not None and input_tokens is not None:
+            reservation.adjust(input_tokens)
+        return reservation
+
+    def penalize(self, model: str, retry_after: Optional[float] = None):
+        """OpenAI все-таки ответил 429: не отправляем запросы к модели retry_after секунд"""
+        limiter = self.models.get(model)
+        if limiter is None:
+            return
+        limiter.rate_limited += 1
+        pause = retry_after if retry_after is not None else 1.0
+        limiter.requests.pause(time.monotonic(), pause)
+        logger.warning(f"OpenAI ограничил запросы к {model}, пауза {pause:.1f} сек.")
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        result = {}
+        for model, limiter in self.models.items():
+            result[model] = {
+                "requests_available": limiter.requests.available(now),
+                "rpm": limiter.requests.capacity,
+                "tokens_available": limiter.tokens.available(now),
+                "tpm": limiter.tokens.capacity,
+                "admitted": limiter.admitted,
+                "throttled": limiter.throttled,
+                "rate_limited": limiter.rate_limited,
+                "refunded": limiter.refunded,
+            }
+        return result
+
+
+def retry_after_from_error(error: Exception) -> Optional[float]:
+    """Пауза из заголовка retry-after ответа 429, если он есть"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429
+
+
+# Общий ограничитель на весь процесс
+rate_limiter = RateLimiter()
@@ -0,0 +1,174 @@
+"""
+Устойчивость запросов к OpenAI: повторы с экспоненциальной паузой и джиттером,
+автомат-предохранитель (circuit breaker) на каждую модель и переход на
+резервную модель из MODEL_FALLBACKS, пока предохранитель основной открыт.
+"""
+import logging
+import random
+import time
+from typing import Any, Dict, Optional
+
+from openai import APIConnectionError
+
+from config import (
+    MODEL_FALLBACKS, OPENAI_RETRY_BASE_DELAY, OPENAI_RETRY_MAX_DELAY,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+)
+from . import metrics
+
+logger = logging.getLogger('telegram_bot')
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def is_retriable(error: Exception) -> bool:
+    """Временная ошибка, после которой запрос стоит повторить: сеть, таймаут, 408/409/429, 5xx"""
+    if isinstance(error, APIConnectionError):  # В том числе APITimeoutError
+        return True
+    status = getattr(error, "status_code", None)
+    return status is not None and (status in (408, 409, 429) or status >= 500)
+
+
+def is_server_failure(error: Exception) -> bool:
+    """Ошибка, говорящая о проблемах с моделью (учитывается предохранителем). 429 - это лимиты, а не сбой"""
+    return is_retriable(error) and getattr(error, "status_code", None) != 429
+
+
+def backoff_delay(attempt: int, base: float = OPENAI_RETRY_BASE_DELAY, cap: float = OPENAI_RETRY_MAX_DELAY) -> float:
+    """Пауза перед повтором attempt (с 0): случайная до base * 2^attempt, чтобы повторы не шли залпом"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Предохранитель модели: после threshold сбоев подряд запросы к ней не отправляются
+    reset_timeout секунд, затем пропускается один пробный запрос. Пробный запрос,
+    о котором за reset_timeout ничего не известно (например, его отменили), считается сбоем
+    """
+
+    def __init__(self, threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0  # Сбоев подряд
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.probe_started = 0.0
+        self.opens = 0
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос (в полуоткрытом состоянии - только один пробный)"""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self.probe_in_flight = False
+        if self.probe_in_flight:
+            if now - self.probe_started >= self.reset_timeout:
+                # Результата пробного запроса так и не дождались
+                self.record_failure()
+            return False
+        self.probe_in_flight = True
+        self.probe_started = now
+        return True
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self) -> bool:
+        """Учесть сбой. Возвращает True, если предохранитель только что открылся"""
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.opens += 1
+            return True
+        return False
+
+
+class Resilience:
+    """Предохранители и статистика сбоев по моделям"""
+
+    def __init__(self, fallbacks: Optional[Dict[str, str]] = None):
+        self.fallbacks = fallbacks if fallbacks is not None else MODEL_FALLBACKS
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker()
+        return breaker
+
+    def _count(self, model: str, field: str):
+        model_stats = self.stats.setdefault(model, {"retries": 0, "failures": 0, "fallbacks": 0, "partial": 0})
+        model_stats[field] += 1
+
+    def select_model(self, model: str) -> Optional[str]:
+        """
+        Модель для очередного запроса: сама model, а если ее предохранитель открыт -
+        первая доступная по цепочке резервных. None - недоступны все
+        """
+        seen = set()
+        current = model
+        while current is not None and current not in seen:
+            seen.add(current)
+            if self.breaker(current).allow():
+                if current != model:
+                    self._count(model, "fallbacks")
+                    metrics.OPENAI_FALLBACKS.labels(model, current).inc()
+                    logger.warning(f"🔀 Модель {model} недоступна, запрос уходит в {current}")
+                return current
+            current = self.fallbacks.get(current)
+        return None
+
+    def record_success(self, model: str):
+        self.breaker(model).record_success()
+
+    def record_failure(self, model: str, error: Exception):
+        """Запрос к модели не удался. Сбои сервера открывают предохранитель, остальное - нет"""
+        self._count(model, "failures")
+        breaker = self.breaker(model)
+        if not is_server_failure(error):
+            # Модель ответила (ошибкой запроса или лимитом) - она работает
+            breaker.record_success()
+            return
+        if breaker.record_failure():
+            logger.error(
+                f"⛔ Предохранитель модели {model} открыт на {breaker.reset_timeout:.0f} сек. "
+                f"после {breaker.failures} сбоев: {str(error)}"
+            )
+
+    def record_retry(self, model: str, error: Exception):
+        self._count(model, "retries")
+        reason = "rate_limit" if getattr(error, "status_code", None) == 429 else "error"
+        metrics.OPENAI_RETRIES.labels(model, reason).inc()
+
+    def record_partial(self, model: str, error: Exception):
+        """Стрим оборвался посреди ответа - пользователь получил его часть"""
+        self._count(model, "partial")
+        logger.error(f"⚠️ Стрим модели {model} оборвался: {str(error)}")
+        self.breaker(model).record_failure()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for model in set(self.breakers) | set(self.stats):
+            breaker = self.breaker(model)
+            result[model] = {
+                "state": breaker.state,
+                "opens": breaker.opens,
+                **self.stats.get(model, {"retries": 0, "failures": 0, "fallbacks": 0, "partial": 0}),
+            }
+        return result
+
+
+# Общие предохранители на весь процесс
+resilience = Resilience()
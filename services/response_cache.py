@@ -0,0 +1,61 @@
+import hashlib
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+from config import (
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_CONTEXT_MESSAGES,
+    DEFAULT_MAX_TOKENS
+)
+from database.operations import get_cached_response, save_cached_response
+
+logger = logging.getLogger('telegram_bot')
+
+_SPACES = re.compile(r"\s+")
+# Знаки препинания, которые не меняют смысл вопроса (математические знаки не трогаем)
+_PUNCTUATION = re.compile(r"[.,!?;:…\"'«»]")
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к виду, в котором почти одинаковые вопросы совпадают"""
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", text)).strip().casefold()
+
+
+def make_cache_key(model: str, messages: List[Dict[str, Any]], system_instruction: Optional[str] = None,
+                   max_tokens: Optional[int] = None) -> str:
+    """Ключ кэша: модель, лимит ответа, промпт и последние сообщения истории (включая новый вопрос)"""
+    recent = messages[-RESPONSE_CACHE_CONTEXT_MESSAGES:] if RESPONSE_CACHE_CONTEXT_MESSAGES > 0 else messages[-1:]
+    payload = [
+        model,
+        max_tokens or DEFAULT_MAX_TOKENS,
+        normalize_text(system_instruction or ""),
+        [[msg["role"], normalize_text(msg["content"])] for msg in recent],
+    ]
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+async def lookup(key: str) -> Optional[Dict[str, Any]]:
+    """Ответ из кэша или None (и None, если кэш выключен)"""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    try:
+        return await get_cached_response(key, RESPONSE_CACHE_TTL)
+    except Exception as e:
+        # Кэш - только оптимизация, при ошибке идем в OpenAI
+        logger.warning(f"Ошибка чтения кэша ответов: {str(e)}")
+        return None
+
+
+async def store(key: str, model: str, content: str, input_tokens: int, output_tokens: int, cost_usd: float) -> None:
+    """Сохранить ответ модели в кэш"""
+    if not RESPONSE_CACHE_ENABLED or not content.strip():
+        return
+    try:
+        await save_cached_response(
+            key, model, content, input_tokens, output_tokens, cost_usd,
+            RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES
+        )
+    except Exception as e:
+        logger.warning(f"Ошибка записи в кэш ответов: {str(e)}")
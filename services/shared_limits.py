@@ -0,0 +1,81 @@
+"""
+Лимиты, общие для всех процессов supervisor.py.
+
+Главный процесс создает счетчики и корзины в разделяемой памяти и передает их
+процессам-обработчикам при запуске, поэтому QUEUE_WORKERS, MODEL_CONCURRENCY и
+MODEL_RATE_LIMITS ограничивают бота целиком, а не каждый процесс, и запас лимитов
+не простаивает в процессах, где сейчас нет запросов. Занятые слоты учитываются по
+процессам: слоты упавшего процесса освобождаются при его перезапуске.
+"""
+from typing import Dict, Tuple
+
+from config import QUEUE_WORKERS, MODEL_CONCURRENCY, MODEL_RATE_LIMITS
+from .token_bucket import SharedTokenBucket
+
+SHARED_POLL_INTERVAL = 0.2  # Другие процессы не будят этот, поэтому занятые слоты проверяются так часто, сек.
+
+
+class SharedSlots:
+    """Общее на все процессы число одновременных запросов"""
+
+    def __init__(self, limit: int, counts):
+        self.limit = limit
+        self.counts = counts  # multiprocessing.Array('i', shards) - сколько занял каждый процесс
+        self.index = 0  # Номер текущего процесса
+
+    @classmethod
+    def create(cls, context, limit: int, shards: int) -> "SharedSlots":
+        return cls(limit, context.Array('i', shards))
+
+    def try_acquire(self) -> bool:
+        """Занять слот, если во всех процессах вместе занято меньше limit"""
+        with self.counts.get_lock():
+            counts = self.counts.get_obj()
+            if sum(counts) >= self.limit:
+                return False
+            counts[self.index] += 1
+            return True
+
+    def release(self):
+        with self.counts.get_lock():
+            self.counts.get_obj()[self.index] -= 1
+
+    def reset(self, index: int):
+        """Процесс index перезапускается - его слоты свободны"""
+        with self.counts.get_lock():
+            self.counts.get_obj()[index] = 0
+
+
+class SharedLimits:
+    """Все общие лимиты; создаются в главном процессе, устанавливаются в каждом обработчике"""
+
+    def __init__(self, context, shards: int):
+        self.workers = SharedSlots.create(context, QUEUE_WORKERS, shards)
+        self.models: Dict[str, SharedSlots] = {
+            model: SharedSlots.create(context, limit, shards) for model, limit in MODEL_CONCURRENCY.items()
+        }
+        # Корзины RPM/TPM по моделям: (запросы, токены)
+        self.rate_buckets: Dict[str, Tuple[SharedTokenBucket, SharedTokenBucket]] = {
+            model: (
+                SharedTokenBucket.create(context, limit["rpm"] / 60, limit["rpm"]),
+                SharedTokenBucket.create(context, limit["tpm"] / 60, limit["tpm"]),
+            )
+            for model, limit in MODEL_RATE_LIMITS.items()
+        }
+
+    def _slots(self):
+        return [self.workers, *self.models.values()]
+
+    def install(self, index: int):
+        """Подключить лимиты в процессе-обработчике index"""
+        from .queue_manager import queue_manager
+        from .rate_limiter import rate_limiter
+
+        for slots in self._slots():
+            slots.index = index
+        queue_manager.use_shared_slots(self.workers, self.models)
+        rate_limiter.configure(MODEL_RATE_LIMITS, self.rate_buckets)
+
+    def reset(self, index: int):
+        for slots in self._slots():
+            slots.reset(index)
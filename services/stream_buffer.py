@@ -0,0 +1,33 @@
+from typing import List
+
+
+class StreamBuffer:
+    """
+    Накопитель текста стрима: куски складываются в список,
+    длина и наличие видимого текста считаются по ходу,
+    а строка собирается только когда она действительно нужна.
+    """
+
+    def __init__(self):
+        self._chunks: List[str] = []
+        self.length = 0
+        self.version = 0  # Растет с каждым непустым куском, удобно сравнивать без сборки строки
+        self.has_visible = False  # Есть ли в тексте что-то кроме пробелов
+
+    def append(self, chunk: str):
+        if not chunk:
+            return
+        self._chunks.append(chunk)
+        self.length += len(chunk)
+        self.version += 1
+        if not self.has_visible and not chunk.isspace():
+            self.has_visible = True
+
+    def getvalue(self) -> str:
+        """Собрать текст (собранная строка запоминается, повторный вызов бесплатный)"""
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def __len__(self) -> int:
+        return self.length
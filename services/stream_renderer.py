@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_GROUP_RATE
+from .stream_buffer import StreamBuffer
+from .token_bucket import TokenBucket
+from . import metrics
+
+logger = logging.getLogger('telegram_bot')
+
+MAX_EDIT_LENGTH = 4000  # Длиннее этого ответ отправляется файлом
+FILE_NOTICE = "📄 Ответ слишком длинный, отправляю файлом..."
+EXPIRE_INTERVAL = 60.0  # Как часто забывать чаты, в которые давно ничего не отправляли, сек.
+
+
+class EditScheduler:
+    """
+    Планировщик отправок в Telegram: общий лимит бота, лимит на чат
+    и пауза после ответа 429 (retry_after)
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 group_rate: float = TELEGRAM_GROUP_RATE):
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.blocked_until: Dict[int, float] = {}
+        self.next_expire = time.monotonic() + EXPIRE_INTERVAL
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные ID - группы, у них лимит строже
+            bucket = TokenBucket(self.group_rate if chat_id < 0 else self.chat_rate)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _expire_idle(self, now: float):
+        """
+        Забыть чаты без недавних отправок: полная корзина ничем не отличается от новой,
+        поэтому ее можно удалить, даже если в чате еще идет стрим
+        """
+        if now < self.next_expire:
+            return
+        self.next_expire = now + EXPIRE_INTERVAL
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if bucket.available(now) >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+        for chat_id, until in list(self.blocked_until.items()):
+            if until <= now:
+                del self.blocked_until[chat_id]
+
+    def try_acquire(self, chat_id: int) -> float:
+        """Занять отправку в чат, если можно прямо сейчас. Возвращает 0 или сколько секунд ждать"""
+        now = time.monotonic()
+        self._expire_idle(now)
+        chat_bucket = self._chat_bucket(chat_id)
+        wait = max(
+            self.blocked_until.get(chat_id, 0.0) - now,
+            self.global_bucket.wait_time(now),
+            chat_bucket.wait_time(now)
+        )
+        if wait > 0:
+            return wait
+        self.global_bucket.take()
+        chat_bucket.take()
+        return 0.0
+
+    async def acquire(self, chat_id: int):
+        """Дождаться разрешения на отправку в чат"""
+        # Корзина чата берется заново на каждой попытке: пока ждали, простаивавшую могли удалить
+        wait = self.try_acquire(chat_id)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.try_acquire(chat_id)
+
+    def penalize(self, chat_id: int, retry_after: float):
+        """Telegram ответил 429: не трогаем чат retry_after секунд"""
+        self.blocked_until[chat_id] = time.monotonic() + retry_after
+        logger.warning(f"Flood control в чате {chat_id}, пауза {retry_after} сек.")
+
+
+# Общий планировщик на весь процесс
+edit_scheduler = EditScheduler()
+
+
+class StreamRenderer:
+    """
+    Показ стримящегося ответа правками одного сообщения.
+    Новые куски текста только копятся, а правка уходит, когда планировщик разрешит:
+    все куски, пришедшие за это время, попадают в одну правку.
+    """
+
+    def __init__(self, message: Message, scheduler: EditScheduler = edit_scheduler,
+                 max_length: int = MAX_EDIT_LENGTH):
+        self.message = message
+        self.chat_id = message.chat.id
+        self.scheduler = scheduler
+        self.max_length = max_length
+        self.buffer = StreamBuffer()
+        self.use_file = False  # Ответ не помещается в сообщение - отправим файлом
+        self._last_sent: Optional[str] = None
+        self._sent_version = -1  # Версия буфера, показанная в сообщении
+        self._dirty = asyncio.Event()
+        self._pump_task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "StreamRenderer":
+        self._pump_task = asyncio.create_task(self._pump())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._stop_pump()
+
+    @property
+    def text(self) -> str:
+        return self.buffer.getvalue()
+
+    def feed(self, delta: str):
+        """Добавить кусок ответа"""
+        self.buffer.append(delta)
+        if not self.use_file and self.buffer.length > self.max_length:
+            self.use_file = True
+        self._dirty.set()
+
+    def _has_changes(self) -> bool:
+        """Есть ли что показать, не собирая строку"""
+        if self.use_file:
+            return self._last_sent != FILE_NOTICE
+        return self.buffer.has_visible and self.buffer.version != self._sent_version
+
+    def _visible_text(self) -> str:
+        return FILE_NOTICE if self.use_file else self.buffer.getvalue()
+
+    async def _pump(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            if not self._has_changes():
+                continue
+            await self.scheduler.acquire(self.chat_id)
+            # Пока ждали, могли прийти новые куски - отправляем самый свежий текст
+            if not await self._edit(self._visible_text()):
+                self._dirty.set()
+
+    async def _edit(self, text: str) -> bool:
+        """Одна правка сообщения. False - правку нужно повторить позже"""
+        if text == self._last_sent or not text.strip():
+            return True
+        version = self.buffer.version
+        start = time.monotonic()
+        try:
+            await self.message.edit_text(text)
+            metrics.TELEGRAM_EDIT_DURATION.observe(time.monotonic() - start)
+            metrics.TELEGRAM_EDITS.labels("ok").inc()
+            self._last_sent = text
+            self._sent_version = version
+            return True
+        except TelegramRetryAfter as e:
+            metrics.TELEGRAM_EDITS.labels("retry_after").inc()
+            self.scheduler.penalize(self.chat_id, e.retry_after)
+            return False
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                metrics.TELEGRAM_EDITS.labels("not_modified").inc()
+                self._last_sent = text
+                self._sent_version = version
+                return True
+            metrics.TELEGRAM_EDITS.labels("error").inc()
+            logger.warning(f"Ошибка при обновлении сообщения: {str(e)}")
+            # При других ошибках переключаемся на файл
+            if not self.use_file:
+                self.use_file = True
+                return False
+            return True
+        except Exception as e:
+            metrics.TELEGRAM_EDITS.labels("error").inc()
+            logger.warning(f"Ошибка при обновлении сообщения: {str(e)}")
+            return True
+
+    async def _stop_pump(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            await asyncio.gather(self._pump_task, return_exceptions=True)
+            self._pump_task = None
+
+    async def finish(self, attempts: int = 3) -> bool:
+        """Показать итоговый текст. False - не удалось, ответ нужно отправить отдельно"""
+        await self._stop_pump()
+        if not self.use_file and not self.buffer.has_visible:
+            return True
+        for _ in range(attempts):
+            await self.scheduler.acquire(self.chat_id)
+            text = self._visible_text()
+            if await self._edit(text) and self._last_sent == text:
+                return True
+        return False
@@ -0,0 +1,92 @@
+import time
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float, amount: float = 1.0) -> float:
+        """Сколько ждать до появления amount токенов (больше capacity не ждем - хватит полной корзины)"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float = 1.0):
+        """Забрать токены; корзина может уйти в минус - тогда следующим придется подождать"""
+        self.tokens -= amount
+
+    def give(self, amount: float):
+        """Вернуть неиспользованные токены"""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return max(0.0, self.tokens)
+
+    def pause(self, now: float, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - self.rate * seconds)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Корзина, общая для процессов: запас и время пополнения лежат в разделяемой памяти
+    (time.monotonic в Linux общий для всех процессов)
+    """
+
+    def __init__(self, rate: float, capacity: float, state):
+        self.rate = rate
+        self.capacity = capacity
+        self.state = state  # multiprocessing.Array('d', [tokens, updated])
+
+    @classmethod
+    def create(cls, context, rate: float, capacity: float) -> "SharedTokenBucket":
+        return cls(rate, capacity, context.Array('d', [capacity, time.monotonic()]))
+
+    @property
+    def tokens(self) -> float:
+        return self.state.get_obj()[0]
+
+    @tokens.setter
+    def tokens(self, value: float):
+        self.state.get_obj()[0] = value
+
+    @property
+    def updated(self) -> float:
+        return self.state.get_obj()[1]
+
+    @updated.setter
+    def updated(self, value: float):
+        self.state.get_obj()[1] = value
+
+    def wait_time(self, now: float, amount: float = 1.0) -> float:
+        with self.state.get_lock():
+            return super().wait_time(now, amount)
+
+    def take(self, amount: float = 1.0):
+        with self.state.get_lock():
+            super().take(amount)
+
+    def give(self, amount: float):
+        with self.state.get_lock():
+            super().give(amount)
+
+    def available(self, now: float) -> float:
+        with self.state.get_lock():
+            return super().available(now)
+
+    def pause(self, now: float, seconds: float):
+        with self.state.get_lock():
+            super().pause(now, seconds)
@@ -1,36 +1,131 @@
 import tiktoken
-from typing import Dict, Any, List, Union
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Union
 
-from config import MODELS, USD_TO_RUB
+from config import MODELS, USD_TO_RUB, TOKEN_CACHE_SIZE, TOKEN_COUNT_THREADS
 
+# Энкодеры tiktoken по моделям (None - модель не поддерживается tiktoken)
+_encoders: Dict[str, Optional[Any]] = {}
 
-def get_token_count(text: str, model: str = "gpt-4.1") -> int:
-    """Подсчёт токенов в тексте"""
+# LRU-кэш: (модель, хэш текста) -> количество токенов
+_token_cache: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _get_encoder(model: str) -> Optional[Any]:
+    """Получить энкодер модели (создается один раз на процесс)"""
+    if model in _encoders:
+        return _encoders[model]
     try:
         encoder = tiktoken.encoding_for_model(model)
-        tokens = len(encoder.encode(text))
-        return tokens
+    except KeyError:
+        # Модель неизвестна tiktoken - запоминаем, чтобы не искать повторно
+        encoder = None
     except Exception:
+        # Например, не удалось скачать словарь - попробуем в следующий раз
+        return None
+    _encoders[model] = encoder
+    return encoder
+
+
+def _approximate_count(text: str) -> int:
+    # В среднем 1 токен ≈ 4 символа
+    return int(len(text) / 4)
+
+
+def _cache_key(text: str, model: str) -> Tuple[str, bytes]:
+    return model, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def _cache_get(key: Tuple[str, bytes]) -> Optional[int]:
+    with _cache_lock:
+        tokens = _token_cache.get(key)
+        if tokens is not None:
+            _token_cache.move_to_end(key)
+        return tokens
+
+
+def _cache_put(key: Tuple[str, bytes], tokens: int) -> None:
+    with _cache_lock:
+        _token_cache[key] = tokens
+        _token_cache.move_to_end(key)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+
+def get_token_count(text: str, model: str = "gpt-4.1") -> int:
+    """Подсчёт токенов в тексте"""
+    key = _cache_key(text, model)
+    tokens = _cache_get(key)
+    if tokens is not None:
+        return tokens
+
+    encoder = _get_encoder(model)
+    if encoder is None:
         # Если модель не поддерживается tiktoken, используем приблизительный подсчёт
-        return int(len(text) / 4)  # В среднем 1 токен ≈ 4 символа
+        return _approximate_count(text)
+
+    tokens = len(encoder.encode(text, disallowed_special=()))
+    _cache_put(key, tokens)
+    return tokens
+
 
+def count_tokens_many(texts: List[str], model: str = "gpt-4.1") -> List[int]:
+    """Подсчёт токенов для списка текстов (непосчитанные кодируются пакетно в нескольких потоках)"""
+    keys = [_cache_key(text, model) for text in texts]
+    result = [_cache_get(key) for key in keys]
+    missing = [i for i, tokens in enumerate(result) if tokens is None]
+    if not missing:
+        return result
 
-def calculate_cost(tokens: int, model: str, is_input: bool = True) -> float:
-    """Рассчитать стоимость токенов в USD"""
+    encoder = _get_encoder(model)
+    if encoder is None:
+        for i in missing:
+            result[i] = _approximate_count(texts[i])
+        return result
+
+    encoded = encoder.encode_batch(
+        [texts[i] for i in missing],
+        num_threads=TOKEN_COUNT_THREADS,
+        disallowed_special=()
+    )
+    for i, tokens in zip(missing, encoded):
+        result[i] = len(tokens)
+        _cache_put(keys[i], result[i])
+    return result
+
+
+def calculate_cost(tokens: int, model: str, is_input: bool = True, cached_tokens: int = 0) -> float:
+    """
+    Рассчитать стоимость токенов в USD
+    cached_tokens - сколько из входных токенов OpenAI взял из кэша (они дешевле)
+    """
+    rates = MODELS.get(model, {})
     rate_key = "input" if is_input else "output"
-    rate = MODELS.get(model, {}).get(rate_key, 0)
+    rate = rates.get(rate_key, 0)
     
     # Цена за миллион токенов -> цена за токен
     cost = (rate / 1_000_000) * tokens
+    if is_input and cached_tokens:
+        cached_rate = rates.get("cached_input", rate)
+        cost -= ((rate - cached_rate) / 1_000_000) * cached_tokens
     return cost
 
 
 def format_stats(tokens_input: int, tokens_output: int, 
-               model: str, total_input: int = 0, total_output: int = 0) -> str:
-    """Форматировать статистику для отображения пользователю"""
+               model: str, total_input: int = 0, total_output: int = 0,
+               saved_tokens: int = 0, cache_saved_input: int = 0, cache_saved_output: int = 0,
+               cached_tokens: int = 0, total_cost_usd: Optional[float] = None) -> str:
+    """
+    Форматировать статистику для отображения пользователю
+    cached_tokens - входные токены текущего запроса по цене кэша OpenAI,
+    total_cost_usd - реальная стоимость чата (иначе считается по полной цене токенов)
+    """
     
     # Расчет стоимости в рублях (без долларов)
-    cost_input_usd = calculate_cost(tokens_input, model, True)
+    cost_input_usd = calculate_cost(tokens_input, model, True, cached_tokens)
     cost_output_usd = calculate_cost(tokens_output, model, False)
     
     cost_input_rub = cost_input_usd * USD_TO_RUB
@@ -44,10 +139,30 @@ def format_stats(tokens_input: int, tokens_output: int,
     total_cost_input_rub = total_cost_input_usd * USD_TO_RUB
     total_cost_output_rub = total_cost_output_usd * USD_TO_RUB
     chat_total_cost_rub = total_cost_input_rub + total_cost_output_rub
+    if total_cost_usd is not None:
+        chat_total_cost_rub = total_cost_usd * USD_TO_RUB
     
     stats = (
         f"\n\n📊 Текущий запрос: {tokens_input + tokens_output} токенов ({tokens_input}⤵️/{tokens_output}⤴️) • {total_cost_rub:.2f}₽"
         f"\n💰 Весь чат: {total_input + total_output} токенов • {chat_total_cost_rub:.2f}₽"
     )
     
+    # Начало запроса совпало с предыдущим - OpenAI посчитал его по цене кэша
+    if cached_tokens > 0:
+        cached_saved_rub = (calculate_cost(cached_tokens, model, True)
+                            - calculate_cost(cached_tokens, model, True, cached_tokens)) * USD_TO_RUB
+        stats += f"\n🗄 Из кэша OpenAI: {cached_tokens} токенов входа • -{cached_saved_rub:.2f}₽"
+    
+    # Сколько токенов истории не отправили благодаря обрезке контекста
+    if saved_tokens > 0:
+        saved_cost_rub = calculate_cost(saved_tokens, model, True) * USD_TO_RUB
+        stats += f"\n✂️ Сэкономлено на истории: {saved_tokens} токенов • {saved_cost_rub:.2f}₽"
+    
+    # Ответ взят из кэша - запрос в OpenAI не отправлялся
+    if cache_saved_input or cache_saved_output:
+        cache_cost_rub = (calculate_cost(cache_saved_input, model, True)
+                          + calculate_cost(cache_saved_output, model, False)) * USD_TO_RUB
+        stats += (f"\n♻️ Ответ из кэша, сэкономлено: {cache_saved_input + cache_saved_output} токенов"
+                  f" • {cache_cost_rub:.2f}₽")
+    
     return stats
\ No newline at end of file
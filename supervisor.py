@@ -0,0 +1,248 @@
+"""
+Многопроцессный запуск бота.
+
+Главный процесс получает обновления от Telegram (long polling) и раскладывает их
+по BOT_WORKERS процессам-обработчикам по from_user.id. Все обновления одного
+пользователя попадают в один и тот же процесс, и их обработчики запускаются в
+порядке получения, поэтому очередь, FSM-кэш и лимиты на пользователя работают как в app.py.
+
+Запуск: python supervisor.py
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import TelegramObject, Update
+
+from config import (
+    TOKEN, OPENAI_API_KEY, BOT_WORKERS, TELEGRAM_GLOBAL_RATE, METRICS_PORT, SHUTDOWN_DRAIN_TIMEOUT
+)
+from services.shared_limits import SharedLimits
+
+logger = logging.getLogger('telegram_bot')
+
+POLL_TIMEOUT = 30  # Секунд long polling на один запрос getUpdates
+STOP_TIMEOUT = SHUTDOWN_DRAIN_TIMEOUT + 15  # Сколько ждать, пока обработчики доработают и запишут все в БД
+
+
+def update_user_id(update: Update) -> Optional[int]:
+    try:
+        user = getattr(update.event, "from_user", None)
+    except Exception:
+        user = None
+    return user.id if user else None
+
+
+def shard_for(update: Update, shards: int) -> int:
+    """Номер процесса для обновления: по пользователю, без пользователя - нулевой"""
+    user_id = update_user_id(update)
+    return user_id % shards if user_id is not None else 0
+
+
+async def mark_entered(handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+    """
+    Обновление дошло до обработчика: следующему обновлению пользователя можно начинать.
+    Обработчик до первого await успевает встать в очередь или в склейку сообщений,
+    поэтому порядок сохраняется, а следующее сообщение не ждет ответа модели
+    """
+    entered = data.get("update_entered")
+    if entered is not None:
+        entered.set()
+    return await handler(event, data)
+
+
+def apply_process_share(index: int, shards: int, shared: SharedLimits):
+    """
+    Общие лимиты процессов. QUEUE_WORKERS, MODEL_CONCURRENCY и лимиты OpenAI RPM/TPM
+    не делятся, а считаются в разделяемой памяти: свободный запас может взять любой процесс.
+    Лимит Telegram на бота делится поровну - правки и так расходятся по процессам равномерно
+    """
+    from services.stream_renderer import edit_scheduler
+    from services.token_bucket import TokenBucket
+
+    shared.install(index)
+    rate = TELEGRAM_GLOBAL_RATE / shards
+    edit_scheduler.global_bucket = TokenBucket(rate, capacity=rate)
+
+
+async def run_worker(index: int, shards: int, inbox: multiprocessing.Queue, shared: SharedLimits):
+    """Процесс-обработчик: получает обновления из очереди и передает их диспетчеру"""
+    from app import on_startup, on_shutdown, shutdown_time_left
+    from handlers import setup_routers
+    from services.fsm_storage import create_fsm_storage
+
+    # Таблицы и миграции уже подготовил главный процесс
+    apply_process_share(index, shards, shared)
+
+    bot = Bot(token=TOKEN)
+    dp = Dispatcher(storage=create_fsm_storage())
+    dp.include_router(setup_routers())
+    dp.message.middleware(mark_entered)
+    dp.callback_query.middleware(mark_entered)
+    # У каждого процесса свои метрики на своем порту
+    await on_startup(metrics_port=METRICS_PORT + index if METRICS_PORT else 0)
+    await dp.emit_startup(bot=bot)
+    logger.info(f"🧩 Обработчик #{index} запущен")
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    # Последнее обновление каждого пользователя: его событие срабатывает, когда оно дошло до обработчика
+    last_entered: Dict[int, asyncio.Event] = {}
+
+    async def feed(update: Update, user_id: Optional[int], previous: Optional[asyncio.Event],
+                   entered: asyncio.Event):
+        try:
+            # Задачи сами по себе перемешиваются на первом await (FSM, БД) - ждем предыдущее обновление
+            if previous is not None:
+                await previous.wait()
+            await dp.feed_update(bot, update, update_entered=entered)
+        finally:
+            entered.set()
+            if user_id is not None and last_entered.get(user_id) is entered:
+                del last_entered[user_id]
+
+    try:
+        while True:
+            data = await loop.run_in_executor(None, inbox.get)
+            if data is None:
+                break
+            update = Update.model_validate(data, context={"bot": bot})
+            user_id = update_user_id(update)
+            entered = asyncio.Event()
+            previous = last_entered.get(user_id) if user_id is not None else None
+            if user_id is not None:
+                last_entered[user_id] = entered
+            task = asyncio.create_task(feed(update, user_id, previous, entered))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        # Доделываем принятые обновления (в общий срок остановки) и останавливаемся
+        if tasks:
+            _, not_done = await asyncio.wait(tasks, timeout=shutdown_time_left())
+            if not_done:
+                logger.warning(f"⚠️ Обработчик #{index}: не дождались обработки обновлений: {len(not_done)}")
+        await dp.emit_shutdown(bot=bot)
+        await on_shutdown(bot, dp)
+        logger.info(f"🧩 Обработчик #{index} остановлен")
+
+
+def worker_main(index: int, shards: int, inbox: multiprocessing.Queue, shared: SharedLimits):
+    # Остановкой управляет главный процесс через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(run_worker(index, shards, inbox, shared))
+
+
+class Supervisor:
+    """Главный процесс: получение обновлений и раздача их обработчикам"""
+
+    def __init__(self, shards: int = BOT_WORKERS):
+        self.shards = max(1, shards)
+        self.context = multiprocessing.get_context("spawn")
+        self.inboxes: List[multiprocessing.Queue] = [self.context.Queue() for _ in range(self.shards)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * self.shards
+        self.shared = SharedLimits(self.context, self.shards)
+        self.stopping = asyncio.Event()
+
+    def _start_worker(self, index: int):
+        # Слоты, которые занимал прежний процесс с этим номером, свободны
+        self.shared.reset(index)
+        process = self.context.Process(
+            target=worker_main,
+            args=(index, self.shards, self.inboxes[index], self.shared),
+            name=f"bot-worker-{index}"
+        )
+        process.start()
+        self.processes[index] = process
+
+    def _check_workers(self):
+        """Перезапускаем упавшие обработчики (очередь обновлений у них сохраняется)"""
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.error(f"❌ Обработчик #{index} завершился с кодом {process.exitcode}, перезапускаем")
+                self._start_worker(index)
+
+    def dispatch(self, update: Update):
+        data: Dict[str, Any] = update.model_dump(mode="json", exclude_unset=True, by_alias=True)
+        self.inboxes[shard_for(update, self.shards)].put(data)
+
+    async def poll(self, bot: Bot, allowed_updates: List[str]):
+        """Long polling Telegram с раздачей обновлений"""
+        await bot.delete_webhook(drop_pending_updates=True)
+        offset = None
+        while not self.stopping.is_set():
+            self._check_workers()
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=allowed_updates)
+            except Exception as e:
+                logger.error(f"⚠️ Ошибка получения обновлений: {str(e)}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self.dispatch(update)
+
+    async def run(self):
+        from database.models import create_tables
+        from handlers import setup_routers
+
+        # Миграции делаются один раз до запуска обработчиков - параллельно они падают друг на друге
+        create_tables()
+
+        # Диспетчер нужен только чтобы узнать, какие типы обновлений обрабатываются
+        probe = Dispatcher()
+        probe.include_router(setup_routers())
+        allowed_updates = probe.resolve_used_update_types()
+
+        for index in range(self.shards):
+            self._start_worker(index)
+        logger.info(f"🚀 Supervisor запущен, обработчиков: {self.shards}")
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        bot = Bot(token=TOKEN)
+        poller = asyncio.create_task(self.poll(bot, allowed_updates))
+        try:
+            await self.stopping.wait()
+        finally:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+            await bot.session.close()
+            await self.stop()
+
+    async def stop(self):
+        logger.info("🛑 Остановка обработчиков")
+        for inbox in self.inboxes:
+            inbox.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"Обработчик {process.name} не остановился, завершаем принудительно")
+                process.terminate()
+
+
+async def main():
+    if not TOKEN:
+        logging.error("❌ КРИТИЧЕСКАЯ ОШИБКА: Переменная окружения BOT_TOKEN не установлена")
+        return
+
+    if not OPENAI_API_KEY:
+        logging.error("❌ КРИТИЧЕСКАЯ ОШИБКА: Переменная окружения OPENAI_API_KEY не установлена")
+        return
+
+    await Supervisor().run()
+
+
+if __name__ == "__main__":
+    # Логирование настраивается так же, как в app.py
+    import app  # noqa: F401
+    asyncio.run(main())